@@ -0,0 +1,90 @@
+"""
+Maintenance commands of the users.
+
+    python -m auth.commands import-users partner_users.csv
+    python -m auth.commands import-users partner_users.ndjson --resume
+"""
+import argparse
+import asyncio
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict
+
+from core.db import get_async_session_maker, dispose_engine
+from core.redis import get_redis, close_redis
+from .config import auth_settings
+from .user_import import UserImporter, ImportCheckpoint
+
+
+async def import_users(args: argparse.Namespace) -> None:
+    format = args.format or ("csv" if args.path.endswith(".csv") else "ndjson")
+    checkpoint_path = args.checkpoint or f"{args.path}.checkpoint.json"
+    errors_path = args.errors or f"{args.path}.errors.ndjson"
+    checkpoint = ImportCheckpoint.load(checkpoint_path) if args.resume else ImportCheckpoint()
+    if checkpoint.line:
+        print(f"Resuming after line {checkpoint.line}: {checkpoint.imported} imported, {checkpoint.failed} failed")
+
+    start = time.perf_counter()
+    rows_count = 0
+    with (
+        ProcessPoolExecutor(max_workers=args.workers) as executor,
+        open(args.path, newline="") as file,
+        open(errors_path, "a" if args.resume else "w") as errors_file,
+    ):
+        importer = UserImporter(get_async_session_maker(), get_redis(), executor)
+        async for batch in importer.import_file(file, format, args.batch_size, after_line=checkpoint.line):
+            for error in batch.errors:
+                errors_file.write(json.dumps(asdict(error)) + "\n")
+            errors_file.flush()
+            # Saved once the batch is committed, a crash in between makes the resumed import report its rows as taken
+            checkpoint.line = batch.last_line
+            checkpoint.imported += batch.imported
+            checkpoint.failed += len(batch.errors)
+            checkpoint.save(checkpoint_path)
+
+            rows_count += batch.imported + len(batch.errors)
+            elapsed_seconds = time.perf_counter() - start
+            print(
+                f"line {checkpoint.line}: {checkpoint.imported} imported, {checkpoint.failed} failed "
+                f"({rows_count / elapsed_seconds:.0f} rows/s)"
+            )
+
+    print(f"Imported {checkpoint.imported} users, {checkpoint.failed} rows failed, see {errors_path}")
+
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    import_users_parser = subparsers.add_parser(
+        "import-users", help="register users from a CSV or NDJSON file of email, password and referral_code"
+    )
+    import_users_parser.add_argument("path")
+    import_users_parser.add_argument(
+        "--format", choices=("csv", "ndjson"), help="format of the file, guessed from the extension by default"
+    )
+    import_users_parser.add_argument("--batch-size", type=int, default=auth_settings.USER_IMPORT_BATCH_SIZE)
+    import_users_parser.add_argument(
+        "--workers", type=int, help="password hashing processes, the number of CPUs by default"
+    )
+    import_users_parser.add_argument("--checkpoint", help="progress file, <path>.checkpoint.json by default")
+    import_users_parser.add_argument("--errors", help="NDJSON file of rejected rows, <path>.errors.ndjson by default")
+    import_users_parser.add_argument(
+        "--resume", action="store_true", help="continue after the last committed batch of the checkpoint"
+    )
+    import_users_parser.set_defaults(handler=import_users)
+
+    return parser
+
+
+async def run(args: argparse.Namespace) -> None:
+    try:
+        await args.handler(args)
+    finally:
+        await close_redis()
+        await dispose_engine()
+
+
+if __name__ == "__main__":
+    asyncio.run(run(get_parser().parse_args()))
@@ -10,6 +10,13 @@ class AuthSettings(BaseSettings):
     JWT_ACCESS_TOKEN_LIFETIME_SECONDS: int = 300
     JWT_REFRESH_TOKEN_LIFETIME_SECONDS: int = 2629746
     JWT_REFRESH_TOKEN_LENGTH: int = 64
+    JWT_REFRESH_USER_SNAPSHOT_LIFETIME_SECONDS: int = 3600
+    PRINCIPAL_CACHE_MAX_SIZE: int = 10000
+    PRINCIPAL_CACHE_TTL_SECONDS: int = 60
+    PASSWORD_HASHING_WORKERS: int = 4
+    PASSWORD_HASHING_MAX_QUEUE_DEPTH: int = 64
+    USER_IMPORT_BATCH_SIZE: int = 1000
+    USER_IMPORT_HASHING_CHUNK_SIZE: int = 25
 
     model_config = SettingsConfigDict(env_file=os.path.join(".env"), env_file_encoding="utf-8", extra="ignore")
 
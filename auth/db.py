@@ -1,18 +1,23 @@
+from datetime import datetime
+from typing import Any, Iterable, Optional
+
 from fastapi import Depends
 from fastapi_users_db_sqlalchemy import SQLAlchemyUserDatabase as SQLAlchemyBaseUserDatabase
-from sqlalchemy import select, exists, and_
+from sqlalchemy import select, exists, insert, func, literal, update, delete, union_all, or_, tuple_, Select, Row
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from auth.models import User
+from core.config import settings
 from core.db import get_async_session
-from referral_program.models import ReferralCode
+from referral_program.db import ReferralProgramRepository, add_referrer_stats_deltas
+from referral_program.models import ReferralCode, ReferralClosure, ReferrerStats
 
 
 class ReferralCodeMixin:
     async def check_referral_code_was_used(self, code):
-        check_used_query = exists(
-            select(ReferralCode).join(User, and_(ReferralCode.id == User.referrer_id, ReferralCode.code == code))
-        )
+        check_used_query = exists().where(ReferralCode.code == code, ReferralCode.used_at.is_not(None))
         return await self.session.scalar(select(check_used_query))
 
     async def get_referral_code(self, code: str):
@@ -21,19 +26,314 @@ class ReferralCodeMixin:
 
         return referral_code
 
-    async def fetch_referrals(self, id: int):
+    def get_referrals_query(self, id: int, after_id: Optional[int] = None):
         query = (
             select(User)
             .where(User.referrer_id.in_(select(ReferralCode.id).where(ReferralCode.referrer_id == id)))
             .order_by(User.id)
         )
-        return await self.session.scalars(query)
+        if after_id is not None:
+            query = query.where(User.id > after_id)
+        return query
+
+    async def fetch_referrals(self, id: int, after_id: Optional[int] = None, limit: Optional[int] = None):
+        return await self.session.scalars(self.get_referrals_query(id, after_id).limit(limit))
+
+    async def stream_referrals(self, id: int, after_id: Optional[int] = None, batch_size: int = 1000):
+        query = self.get_referrals_query(id, after_id).execution_options(yield_per=batch_size)
+        return await self.session.stream_scalars(query)
+
+    def get_referral_tree_query(self, id: int, depth: int) -> Select:
+        """Select (id, depth) of every referral of the user down to `depth` levels."""
+        if settings.REFERRAL_TREE_FROM_CLOSURE_TABLE:
+            return select(ReferralClosure.descendant_id.label("id"), ReferralClosure.depth).where(
+                ReferralClosure.ancestor_id == id, ReferralClosure.depth <= depth
+            )
+
+        tree = (
+            select(User.id, literal(1).label("depth"))
+            .join(ReferralCode, User.referrer_id == ReferralCode.id)
+            .where(ReferralCode.referrer_id == id)
+            .cte("referral_tree", recursive=True)
+        )
+        tree = tree.union_all(
+            select(User.id, tree.c.depth + 1)
+            .join(ReferralCode, User.referrer_id == ReferralCode.id)
+            .join(tree, ReferralCode.referrer_id == tree.c.id)
+            .where(tree.c.depth < depth)
+        )
+        return select(tree.c.id, tree.c.depth)
+
+    async def fetch_referral_tree(
+        self, id: int, depth: int, after: Optional[tuple[int, int]] = None, limit: Optional[int] = None
+    ):
+        """
+        Page of (user, depth, level count) rows of the referrals of the user ordered by depth and id,
+        starting after the (depth, id) cursor. Level count is the number of referrals at the depth in the whole tree,
+        counted over the same CTE.
+        """
+        tree = self.get_referral_tree_query(id, depth).subquery()
+        counted_tree = select(
+            tree.c.id, tree.c.depth, func.count().over(partition_by=tree.c.depth).label("level_count")
+        ).subquery()
+        query = (
+            select(User, counted_tree.c.depth, counted_tree.c.level_count)
+            .join(counted_tree, User.id == counted_tree.c.id)
+            .order_by(counted_tree.c.depth, User.id)
+            .limit(limit)
+        )
+        if after is not None:
+            query = query.where(tuple_(counted_tree.c.depth, User.id) > tuple_(*after))
+        return await self.session.execute(query)
+
+    async def add_to_referral_closure(self, user_id: int, referrer_id: int) -> None:
+        """Link the user to their referrer and to every ancestor of the referrer."""
+        ancestors_query = union_all(
+            select(literal(referrer_id), literal(user_id), literal(1)),
+            select(ReferralClosure.ancestor_id, literal(user_id), ReferralClosure.depth + 1).where(
+                ReferralClosure.descendant_id == referrer_id
+            ),
+        )
+        await self.session.execute(
+            insert(ReferralClosure).from_select(["ancestor_id", "descendant_id", "depth"], ancestors_query)
+        )
+
+    async def remove_from_referral_closure(self, user_id: int) -> None:
+        """
+        Detach the user and their subtree from the ancestors of the user,
+        as deleting the user or the referral code they were referred with cuts the chain of referral codes.
+        """
+        await self.session.execute(
+            delete(ReferralClosure).where(
+                ReferralClosure.ancestor_id.in_(
+                    select(ReferralClosure.ancestor_id).where(ReferralClosure.descendant_id == user_id)
+                ),
+                or_(
+                    ReferralClosure.descendant_id == user_id,
+                    ReferralClosure.descendant_id.in_(
+                        select(ReferralClosure.descendant_id).where(ReferralClosure.ancestor_id == user_id)
+                    ),
+                ),
+            )
+        )
+
+    async def create_with_referral_code(
+        self, create_dict: dict[str, Any], code: str
+    ) -> Optional[tuple[User, Optional[int]]]:
+        """
+        Insert user with a claimable referral code and mark the code as used by them.
+        The referral closure and the stats of the referrer are updated along with it.
+
+        Returns the user with the id of their referrer, or None if the email is taken
+        or the code doesn't exist, is expired or was already used.
+        Concurrent claims of the same code are rejected by the `used_at IS NULL` guard of the update
+        and by the unique constraint on user.referrer_id.
+        """
+        if self.session.get_bind().dialect.name != "postgresql":
+            return await self.create_with_referral_code_in_savepoint(create_dict, code)
+
+        # A single statement of data-modifying CTEs: the user id is reserved from the sequence, so the claim
+        # can set used_by_id, and the user, the closure rows and the stats are inserted from the claimed code.
+        # Foreign keys are checked at the end of the statement, once the user exists.
+        used_at = datetime.utcnow()
+        id_sequence = func.pg_get_serial_sequence(f'"{User.__tablename__}"', "id")
+        user_id = select(select(func.nextval(id_sequence).label("id")).cte("new_user").c.id).scalar_subquery()
+        claimed_referral_code = (
+            update(ReferralCode)
+            .where(
+                ReferralCode.code == code,
+                ReferralCode.expired_at >= used_at,
+                ReferralCode.used_at.is_(None),
+                ~exists().where(func.lower(User.email) == func.lower(create_dict["email"])),
+            )
+            .values(used_at=used_at, used_by_id=user_id)
+            .returning(ReferralCode.id, ReferralCode.referrer_id)
+            .cte("claimed_referral_code")
+        )
+        add_to_referral_closure = insert(ReferralClosure).from_select(
+            ["ancestor_id", "descendant_id", "depth"],
+            union_all(
+                select(claimed_referral_code.c.referrer_id, user_id, literal(1)).where(
+                    claimed_referral_code.c.referrer_id.is_not(None)
+                ),
+                select(ReferralClosure.ancestor_id, user_id, ReferralClosure.depth + 1).join(
+                    claimed_referral_code, ReferralClosure.descendant_id == claimed_referral_code.c.referrer_id
+                ),
+            ),
+        )
+        update_referrer_stats = add_referrer_stats_deltas(
+            postgresql.insert(ReferrerStats).from_select(
+                ["referrer_id", "referrals_count", "last_referral_at"],
+                select(claimed_referral_code.c.referrer_id, literal(1), literal(used_at)).where(
+                    claimed_referral_code.c.referrer_id.is_not(None)
+                ),
+            )
+        )
+        insert_user_query = (
+            insert(User)
+            .from_select(
+                ["id", *create_dict.keys(), "referrer_id"],
+                select(user_id, *map(literal, create_dict.values()), claimed_referral_code.c.id),
+            )
+            .add_cte(add_to_referral_closure.cte("referral_closure_rows"))
+            .add_cte(update_referrer_stats.cte("referrer_stats_rows"))
+            .returning(User, select(claimed_referral_code.c.referrer_id).scalar_subquery())
+        )
+
+        try:
+            created = (await self.session.execute(insert_user_query)).first()
+        except IntegrityError:
+            # Only a concurrent registration with the same email gets here, before anything else was written
+            await self.session.rollback()
+            return None
+        return tuple(created) if created is not None else None
+
+    async def create_with_referral_code_in_savepoint(
+        self, create_dict: dict[str, Any], code: str
+    ) -> Optional[tuple[User, Optional[int]]]:
+        """
+        `create_with_referral_code` for databases without data-modifying CTEs, statement by statement.
+        The statements run in a savepoint, so a failed claim leaves the rest of the unit of work intact.
+        """
+        claimable_referral_code_query = select(*map(literal, create_dict.values()), ReferralCode.id).where(
+            ReferralCode.code == code,
+            ReferralCode.expired_at >= datetime.utcnow(),
+            ReferralCode.used_at.is_(None),
+            ~exists().where(func.lower(User.email) == func.lower(create_dict["email"])),
+        )
+        insert_user_query = (
+            insert(User)
+            .from_select([*create_dict.keys(), "referrer_id"], claimable_referral_code_query)
+            .returning(User)
+        )
+
+        try:
+            async with self.session.begin_nested() as savepoint:
+                user = await self.session.scalar(insert_user_query)
+                if user is None:
+                    return None
+
+                used_at = datetime.utcnow()
+                claim_referral_code_query = (
+                    update(ReferralCode)
+                    .where(ReferralCode.id == user.referrer_id, ReferralCode.used_at.is_(None))
+                    .values(used_at=used_at, used_by_id=user.id)
+                    .returning(ReferralCode.id, ReferralCode.referrer_id)
+                )
+                claimed_referral_code = (await self.session.execute(claim_referral_code_query)).first()
+                if claimed_referral_code is None:
+                    await savepoint.rollback()
+                    return None
+                if claimed_referral_code.referrer_id is not None:
+                    await self.add_to_referral_closure(user.id, claimed_referral_code.referrer_id)
+                    await ReferralProgramRepository(self.session).update_referrer_stats(
+                        claimed_referral_code.referrer_id,
+                        referrals_count=1,
+                        last_referral_at=used_at,
+                    )
+        except IntegrityError:
+            return None
+
+        return user, claimed_referral_code.referrer_id
+
+    async def fetch_referral_codes(self, codes: Iterable[str], lock: bool = False) -> dict[str, Row]:
+        """
+        Fetch (id, code, referrer_id, expired_at, used_at) rows of the existing codes by code.
+        With `lock` they're locked until the end of the transaction, so a concurrent registration can't claim them.
+        """
+        query = select(
+            ReferralCode.id, ReferralCode.code, ReferralCode.referrer_id, ReferralCode.expired_at, ReferralCode.used_at
+        ).where(ReferralCode.code.in_(list(codes)))
+        if lock:
+            query = query.with_for_update()
+        return {row.code: row for row in await self.session.execute(query)}
+
+    async def claim_referral_codes(self, user_ids_by_code_id: dict[int, int], used_at: datetime) -> None:
+        """Mark the locked codes as used by the users, with a single executemany UPDATE by primary key."""
+        await self.session.execute(
+            update(ReferralCode),
+            [
+                {"id": code_id, "used_at": used_at, "used_by_id": user_id}
+                for code_id, user_id in user_ids_by_code_id.items()
+            ],
+        )
+
+    async def bulk_add_to_referral_closure(self, user_ids: list[int]) -> None:
+        """
+        Link the new users to their referrers and to every ancestor of the referrers in one statement.
+        The users must not have referrals of their own yet.
+        """
+        referrals = (
+            select(User.id, ReferralCode.referrer_id)
+            .join(ReferralCode, User.referrer_id == ReferralCode.id)
+            .where(User.id.in_(user_ids), ReferralCode.referrer_id.is_not(None))
+            .subquery()
+        )
+        ancestors_query = union_all(
+            select(referrals.c.referrer_id, referrals.c.id, literal(1)),
+            select(ReferralClosure.ancestor_id, referrals.c.id, ReferralClosure.depth + 1).join(
+                referrals, ReferralClosure.descendant_id == referrals.c.referrer_id
+            ),
+        )
+        await self.session.execute(
+            insert(ReferralClosure).from_select(["ancestor_id", "descendant_id", "depth"], ancestors_query)
+        )
 
 
 class SQLAlchemyUserDatabase(ReferralCodeMixin, SQLAlchemyBaseUserDatabase):
+    """User database flushing its changes instead of committing them, the commit is made once per request."""
+
+    async def create(self, create_dict: dict[str, Any]) -> User:
+        user = self.user_table(**create_dict)
+        self.session.add(user)
+        await self.session.flush()
+        return user
+
+    async def update(self, user: User, update_dict: dict[str, Any]) -> User:
+        for key, value in update_dict.items():
+            setattr(user, key, value)
+        self.session.add(user)
+        await self.session.flush()
+        return user
+
+    async def delete(self, user: User) -> None:
+        await self.remove_from_referral_closure(user.id)
+        await self.session.delete(user)
+        await self.session.flush()
+
     async def check_whether_user_exists(self, id: int) -> bool:
         return await self.session.scalar(exists(select(User).where(User.id == id)).select())
 
+    async def fetch_existing_emails(self, emails: list[str]) -> set[str]:
+        """Lowercased emails of the given ones which are already registered."""
+        lowercased_emails = [email.lower() for email in emails]
+        query = select(func.lower(User.email)).where(func.lower(User.email).in_(lowercased_emails))
+        return set(await self.session.scalars(query))
+
+    async def bulk_create(self, create_dicts: list[dict[str, Any]]) -> list[int]:
+        """
+        Insert users with the same set of columns, returns their ids in the order of the dicts.
+
+        PostgreSQL gets the rows with COPY, ids are reserved from the sequence beforehand as COPY returns nothing.
+        Other databases get a multi-row INSERT ... RETURNING.
+        """
+        if self.session.get_bind().dialect.name != "postgresql":
+            query = insert(User).returning(User.id, sort_by_parameter_order=True)
+            return list(await self.session.scalars(query, create_dicts))
+
+        id_sequence = func.pg_get_serial_sequence(f'"{User.__tablename__}"', "id")
+        reserve_ids_query = select(func.nextval(id_sequence)).select_from(func.generate_series(1, len(create_dicts)))
+        # Also begins the transaction of the driver connection, so COPY runs in it
+        ids = list(await self.session.scalars(reserve_ids_query))
+
+        connection = await (await self.session.connection()).get_raw_connection()
+        await connection.driver_connection.copy_records_to_table(
+            User.__tablename__,
+            columns=["id", *create_dicts[0].keys()],
+            records=[(id, *create_dict.values()) for id, create_dict in zip(ids, create_dicts)],
+        )
+        return ids
+
 
 async def get_user_db(session: AsyncSession = Depends(get_async_session)):
     yield SQLAlchemyUserDatabase(session, User)
@@ -1,5 +1,3 @@
-from typing import Type
-
 from fastapi import APIRouter
 from fastapi_users import FastAPIUsers
 
@@ -9,14 +7,6 @@ from auth.manager import get_user_manager
 from auth.models import User
 from auth.views import get_auth_router
 
-try:
-    from httpx_oauth.oauth2 import BaseOAuth2
-
-    from fastapi_users.router import get_oauth_router
-    from fastapi_users.router.oauth import get_oauth_associate_router
-except ModuleNotFoundError:  # pragma: no cover
-    BaseOAuth2 = Type  # type: ignore
-
 
 class RefreshTokenFastAPIUsers(FastAPIUsers[User, int]):
     def get_auth_router(
@@ -43,3 +33,4 @@ fastapi_users = RefreshTokenFastAPIUsers(
 )
 
 get_current_user = fastapi_users.current_user()
+get_current_superuser = fastapi_users.current_user(active=True, superuser=True)
@@ -1,30 +1,78 @@
 from datetime import datetime
-from typing import Optional
+from functools import partial
+from typing import Any, NoReturn, Optional
 
+import aioredis
 from fastapi import Depends, Request, HTTPException
+from fastapi.security import OAuth2PasswordRequestForm
 from fastapi_users import BaseUserManager, IntegerIDMixin, schemas, models, exceptions
 from starlette import status
 
+from core.db import add_after_commit_callback
 from core.enums import ErrorDetails
+from core.metrics import Counter
+from core.redis import get_redis
+from referral_program.cache import ReferralCodeCache, get_referral_code_cache
+from referral_program.issued_codes import IssuedReferralCodes
+from referral_program.leaderboard import Leaderboard
 from .config import auth_settings
 from .db import get_user_db
 from .models import User
+from .password import password_hashing_pool
+from .principal import invalidate_principal
+from .strategy import revoke_user_snapshots
+
+signups = Counter(
+    "signups_total", "Registered users by whether they used a referral code.", labelnames=("referral_code",)
+)
+referral_code_validation_failures = Counter(
+    "referral_code_validation_failures_total",
+    "Registrations rejected because of the referral code, by reason.",
+    labelnames=("reason",),
+)
+
+
+def raise_referral_code_error(reason: ErrorDetails) -> NoReturn:
+    referral_code_validation_failures.labels(reason.name).inc()
+    raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=reason)
 
 
 class UserManager(IntegerIDMixin, BaseUserManager[User, int]):
     reset_password_token_secret = auth_settings.RESET_PASSWORD_TOKEN_SECRET
     verification_token_secret = auth_settings.VERIFICATION_TOKEN_SECRET
 
+    def __init__(self, user_db, referral_code_cache: ReferralCodeCache, redis: aioredis.Redis, *args, **kwargs):
+        super().__init__(user_db, *args, **kwargs)
+        self.referral_code_cache = referral_code_cache
+        self.redis = redis
+        self.leaderboard = Leaderboard(redis)
+        self.issued_referral_codes = IssuedReferralCodes(redis)
+        self.password_hashing_pool = password_hashing_pool
+
+    async def reject_referral_code(self, referral_code: str, reason: ErrorDetails) -> NoReturn:
+        # Repeated attempts with the same code are rejected from Redis for a while
+        await self.issued_referral_codes.reject(referral_code, reason)
+        raise_referral_code_error(reason)
+
     async def validate_referral_code(self, referral_code: str) -> None:
         referral_code_instance = await self.user_db.get_referral_code(referral_code)
         if not referral_code_instance:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=ErrorDetails.REFERRAL_CODE_DOESNT_EXIST)
+            await self.reject_referral_code(referral_code, ErrorDetails.REFERRAL_CODE_DOESNT_EXIST)
         if referral_code_instance.expired_at < datetime.utcnow():
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=ErrorDetails.EXPIRED_REFERRAL_CODE)
+            await self.reject_referral_code(referral_code, ErrorDetails.EXPIRED_REFERRAL_CODE)
+
+        if referral_code_instance.used_at is not None:
+            await self.reject_referral_code(referral_code, ErrorDetails.REFERRAL_CODE_ALREADY_USED)
+
+    async def raise_registration_error(self, user_create: schemas.UC, referral_code: str) -> None:
+        existing_user = await self.user_db.get_by_email(user_create.email)
+        if existing_user is not None:
+            raise exceptions.UserAlreadyExists()
 
-        check_referral_code_was_used = await self.user_db.check_referral_code_was_used(referral_code)
-        if check_referral_code_was_used:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=ErrorDetails.REFERRAL_CODE_ALREADY_USED)
+        await self.validate_referral_code(referral_code)
+        # Referral code was valid on re-check, so the claim lost a race to a registration which isn't committed yet
+        # or failed for another reason. It isn't cached as rejected, as the code may still be claimable.
+        raise_referral_code_error(ErrorDetails.REFERRAL_CODE_ALREADY_USED)
 
     async def create(
         self,
@@ -34,27 +82,82 @@ class UserManager(IntegerIDMixin, BaseUserManager[User, int]):
     ) -> models.UP:
         await self.validate_password(user_create.password, user_create)
 
-        existing_user = await self.user_db.get_by_email(user_create.email)
-        if existing_user is not None:
-            raise exceptions.UserAlreadyExists()
-
         user_dict = user_create.create_update_dict() if safe else user_create.create_update_dict_superuser()
-
         referral_code = user_dict.pop("referral_code", None)
-        password = user_dict.pop("password")
-        user_dict["hashed_password"] = self.password_helper.hash(password)
 
         if referral_code:
-            await self.validate_referral_code(referral_code)
-            referral_code_model = await self.user_db.get_referral_code(referral_code)
-            user_dict["referrer_id"] = referral_code_model.id
+            # Guessed and recently rejected codes are turned down before hashing the password and querying the database
+            rejection_reason = await self.issued_referral_codes.check(referral_code)
+            if rejection_reason is not None:
+                raise_referral_code_error(rejection_reason)
+        else:
+            existing_user = await self.user_db.get_by_email(user_create.email)
+            if existing_user is not None:
+                raise exceptions.UserAlreadyExists()
 
-        created_user = await self.user_db.create(user_dict)
+        password = user_dict.pop("password")
+        user_dict["hashed_password"] = await self.password_hashing_pool.run(self.password_helper.hash, password)
+
+        if referral_code:
+            created = await self.user_db.create_with_referral_code(user_dict, referral_code)
+            if created is None:
+                await self.raise_registration_error(user_create, referral_code)
+            created_user, referrer_id = created
+            add_after_commit_callback(
+                self.user_db.session, partial(self.referral_code_cache.invalidate_by_code, referral_code)
+            )
+            if referrer_id is not None:
+                add_after_commit_callback(
+                    self.user_db.session, partial(self.leaderboard.increment, referrer_id, datetime.utcnow())
+                )
+        else:
+            created_user = await self.user_db.create(user_dict)
 
         await self.on_after_register(created_user, request)
 
         return created_user
 
+    async def authenticate(self, credentials: OAuth2PasswordRequestForm) -> Optional[models.UP]:
+        try:
+            user = await self.get_by_email(credentials.username)
+        except exceptions.UserNotExists:
+            # Hash anyway, so response time doesn't tell whether the email is registered
+            await self.password_hashing_pool.run(self.password_helper.hash, credentials.password)
+            return None
+
+        verified, updated_password_hash = await self.password_hashing_pool.run(
+            self.password_helper.verify_and_update, credentials.password, user.hashed_password
+        )
+        if not verified:
+            return None
+        if updated_password_hash is not None:
+            await self.user_db.update(user, {"hashed_password": updated_password_hash})
+
+        return user
+
+    async def on_after_register(self, user: User, request: Optional[Request] = None) -> None:
+        signups.labels(str(user.referrer_id is not None).lower()).inc()
+
+    def schedule_user_snapshots_revocation(self, user: User) -> None:
+        add_after_commit_callback(self.user_db.session, partial(revoke_user_snapshots, self.redis, user.id))
+        add_after_commit_callback(self.user_db.session, partial(invalidate_principal, self.redis, user.id))
+
+    async def on_after_update(self, user: User, update_dict: dict[str, Any], request: Optional[Request] = None) -> None:
+        self.schedule_user_snapshots_revocation(user)
+
+    async def on_after_verify(self, user: User, request: Optional[Request] = None) -> None:
+        self.schedule_user_snapshots_revocation(user)
+
+    async def on_after_reset_password(self, user: User, request: Optional[Request] = None) -> None:
+        self.schedule_user_snapshots_revocation(user)
+
+    async def on_after_delete(self, user: User, request: Optional[Request] = None) -> None:
+        self.schedule_user_snapshots_revocation(user)
+
 
-async def get_user_manager(user_db=Depends(get_user_db)):
-    yield UserManager(user_db)
+async def get_user_manager(
+    user_db=Depends(get_user_db),
+    referral_code_cache: ReferralCodeCache = Depends(get_referral_code_cache),
+    redis: aioredis.Redis = Depends(get_redis),
+):
+    yield UserManager(user_db, referral_code_cache, redis)
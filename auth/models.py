@@ -1,7 +1,7 @@
 from typing import Optional
 
 from fastapi_users_db_sqlalchemy import SQLAlchemyBaseUserTable
-from sqlalchemy import ForeignKey
+from sqlalchemy import ForeignKey, Index, func
 from sqlalchemy.orm import mapped_column, Mapped, relationship
 
 from core.models import Base
@@ -10,9 +10,13 @@ from core.models import Base
 class User(SQLAlchemyBaseUserTable[int], Base):
     id: Mapped[int] = mapped_column(primary_key=True)
     referrer_id: Mapped[Optional[int]] = mapped_column(
-        ForeignKey("referral_code.id", ondelete="SET NULL", use_alter=True), nullable=True, default=None
+        ForeignKey("referral_code.id", ondelete="SET NULL", use_alter=True), nullable=True, default=None, unique=True
     )
 
     referral_codes = relationship(
         "ReferralCode", back_populates="referrer", primaryjoin="User.id == ReferralCode.referrer_id"
     )
+
+
+# Emails are looked up case-insensitively, by fastapi-users and by the referral code lookup
+Index("ix_user_email_lower", func.lower(User.email))
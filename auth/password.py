@@ -0,0 +1,80 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional, TypeVar
+
+from fastapi import HTTPException, status
+
+from core.enums import ErrorDetails
+from core.metrics import Counter, Gauge, Histogram
+from .config import auth_settings
+
+T = TypeVar("T")
+
+password_hashing_pending = Gauge(
+    "password_hashing_pending", "Password hashing operations running or waiting for a worker."
+)
+password_hashing_rejected = Counter(
+    "password_hashing_rejected_total",
+    "Password hashing operations rejected because the queue was full, by operation.",
+    labelnames=("operation",),
+)
+password_hashing_duration_seconds = Histogram(
+    "password_hashing_duration_seconds",
+    "Time from submitting a password hashing operation to its result, by operation.",
+    labelnames=("operation",),
+)
+
+
+class PasswordHashingPool:
+    """
+    Runs password hashing and verification in worker threads, so they don't block the event loop.
+    Both argon2 and bcrypt release the GIL while hashing.
+
+    At most `workers + max_queue_depth` operations are pending, further ones are rejected with 503
+    instead of queueing without limit.
+
+    The threads are started on first use and stopped by `shutdown`, after which the next use starts them again.
+    """
+
+    def __init__(
+        self,
+        workers: int = auth_settings.PASSWORD_HASHING_WORKERS,
+        max_queue_depth: int = auth_settings.PASSWORD_HASHING_MAX_QUEUE_DEPTH,
+    ):
+        self.workers = workers
+        self.max_pending = workers + max_queue_depth
+        self.pending = 0
+        self.executor: Optional[ThreadPoolExecutor] = None
+
+    def get_executor(self) -> ThreadPoolExecutor:
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="password-hashing")
+        return self.executor
+
+    async def run(self, operation: Callable[..., T], *args) -> T:
+        if self.pending >= self.max_pending:
+            password_hashing_rejected.labels(operation.__name__).inc()
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail=ErrorDetails.PASSWORD_HASHING_OVERLOADED,
+                headers={"Retry-After": "1"},
+            )
+
+        self.pending += 1
+        password_hashing_pending.inc()
+        start = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.get_executor(), operation, *args)
+        finally:
+            self.pending -= 1
+            password_hashing_pending.dec()
+            password_hashing_duration_seconds.labels(operation.__name__).observe(time.perf_counter() - start)
+
+    def shutdown(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+
+password_hashing_pool = PasswordHashingPool()
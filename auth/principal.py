@@ -0,0 +1,122 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+
+import aioredis
+from fastapi_users import models
+
+from core.metrics import Counter
+from .config import auth_settings
+
+logger = logging.getLogger(__name__)
+
+PRINCIPAL_INVALIDATION_CHANNEL = "user_principal_invalidation"
+
+principal_cache_lookups = Counter(
+    "user_principal_cache_lookups_total", "Lookups of authenticated users in the in-process cache.", ("result",)
+)
+principal_cache_hits = principal_cache_lookups.labels("hit")
+principal_cache_misses = principal_cache_lookups.labels("miss")
+
+
+@dataclass(frozen=True)
+class UserPrincipal:
+    """Fields of the authenticated user needed by the routes, without a database row behind them."""
+
+    id: int
+    email: str
+    is_active: bool
+    is_superuser: bool
+    is_verified: bool
+
+    @classmethod
+    def from_user(cls, user: models.UP) -> "UserPrincipal":
+        return cls(
+            id=user.id,
+            email=user.email,
+            is_active=user.is_active,
+            is_superuser=user.is_superuser,
+            is_verified=user.is_verified,
+        )
+
+
+class PrincipalCache:
+    """
+    LRU cache of principals by user id, entries live at most `ttl_seconds`.
+    The TTL is capped by the access token lifetime, so a cached principal never outlives the token it was read for.
+    """
+
+    def __init__(
+        self,
+        max_size: int = auth_settings.PRINCIPAL_CACHE_MAX_SIZE,
+        ttl_seconds: float = min(
+            auth_settings.PRINCIPAL_CACHE_TTL_SECONDS, auth_settings.JWT_ACCESS_TOKEN_LIFETIME_SECONDS
+        ),
+    ):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.entries: OrderedDict[int, tuple[float, UserPrincipal]] = OrderedDict()
+        # Bumped by every invalidation, so a principal read from the database before it isn't cached after it
+        self.invalidations = 0
+
+    def get(self, user_id: int) -> Optional[UserPrincipal]:
+        entry = self.entries.get(user_id)
+        if entry is None or entry[0] <= time.monotonic():
+            principal_cache_misses.inc()
+            return None
+        self.entries.move_to_end(user_id)
+        principal_cache_hits.inc()
+        return entry[1]
+
+    def set(self, principal: UserPrincipal, invalidations: int) -> None:
+        """Cache the principal read when the cache had seen `invalidations` invalidations."""
+        if invalidations != self.invalidations:
+            return
+        self.entries[principal.id] = (time.monotonic() + self.ttl_seconds, principal)
+        self.entries.move_to_end(principal.id)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, user_id: int) -> None:
+        self.invalidations += 1
+        self.entries.pop(user_id, None)
+
+    def clear(self) -> None:
+        self.invalidations += 1
+        self.entries.clear()
+
+
+principal_cache = PrincipalCache()
+
+
+async def invalidate_principal(redis: aioredis.Redis, user_id: int) -> None:
+    """Drop the cached principal of the user in this process and, through pub/sub, in the other workers."""
+    principal_cache.invalidate(user_id)
+    await redis.publish(PRINCIPAL_INVALIDATION_CHANNEL, user_id)
+
+
+async def listen_for_principal_invalidations(
+    redis: aioredis.Redis, reconnect_delay_seconds: float = 1, poll_timeout_seconds: float = 1
+) -> None:
+    """
+    Apply invalidations published by the other workers until cancelled.
+    The cache is cleared whenever the subscription is (re)established, as messages published meanwhile are lost.
+    """
+    while True:
+        pubsub = redis.pubsub(ignore_subscribe_messages=True)
+        try:
+            await pubsub.subscribe(PRINCIPAL_INVALIDATION_CHANNEL)
+            principal_cache.clear()
+            while True:
+                # Polled rather than blocked on, so an idle subscription doesn't hit the socket timeout
+                message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=poll_timeout_seconds)
+                if message is not None:
+                    principal_cache.invalidate(int(message["data"]))
+        except aioredis.RedisError:
+            logger.warning("Lost subscription to user principal invalidations, reconnecting", exc_info=True)
+            await asyncio.sleep(reconnect_delay_seconds)
+        finally:
+            await pubsub.close()
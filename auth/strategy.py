@@ -1,25 +1,104 @@
-from typing import Optional
+import time
+from dataclasses import dataclass
+from typing import Optional, Union
 
+import aioredis
+import jwt
+from aioredis.exceptions import ResponseError
 from fastapi_users import BaseUserManager, models, exceptions
 from fastapi_users.authentication import RedisStrategy, JWTStrategy
+from fastapi_users.jwt import decode_jwt
 
 from auth.config import auth_settings
-from core.redis import redis
+from auth.principal import UserPrincipal, PrincipalCache, principal_cache
+from core.redis import get_redis
 from core.utils import generate_random_string
 
+USER_SNAPSHOT_VERSION_KEY_PREFIX = "user_snapshot_version:"
+
+# Stores user snapshot under the refresh token, stamped with the current snapshot version of the user
+WRITE_TOKEN_SCRIPT = """
+local version = redis.call('GET', KEYS[2]) or '0'
+redis.call('SET', KEYS[1], ARGV[1] .. ':' .. version, 'EX', ARGV[2])
+"""
+
+# Reads the refresh token, destroys it and stores its value under a new token in one atomic call,
+# so a refresh token can't be replayed by concurrent requests. Returns the value.
+# Tokens written before the switch to plain string values are hashes with the user_id field.
+ROTATE_TOKEN_SCRIPT = """
+local value
+if redis.call('TYPE', KEYS[1])['ok'] == 'hash' then
+    value = redis.call('HGET', KEYS[1], 'user_id')
+else
+    value = redis.call('GET', KEYS[1])
+end
+if not value then
+    return nil
+end
+redis.call('DEL', KEYS[1])
+redis.call('SET', KEYS[2], value, 'EX', ARGV[1])
+return value
+"""
+
+
+@dataclass
+class UserSnapshot:
+    """Fields of the user needed to mint an access token, stored along with the refresh token."""
+
+    id: int
+    is_active: bool
+    is_verified: bool
+    written_at: int = 0
+    version: int = 0
+
+    @classmethod
+    def from_user(cls, user: models.UP) -> "UserSnapshot":
+        return cls(id=user.id, is_active=user.is_active, is_verified=user.is_verified, written_at=int(time.time()))
+
+    @classmethod
+    def parse(cls, value: bytes) -> Optional["UserSnapshot"]:
+        try:
+            id, is_active, is_verified, written_at, version = value.decode().split(":")
+            return cls(int(id), is_active == "1", is_verified == "1", int(written_at), int(version))
+        except ValueError:
+            return None
+
+    def dump(self) -> str:
+        """Encode snapshot without version, which is appended by WRITE_TOKEN_SCRIPT."""
+        return f"{self.id}:{self.is_active:d}:{self.is_verified:d}:{self.written_at}"
+
+    def is_fresh(self, version: int) -> bool:
+        age = time.time() - self.written_at
+        return self.version == version and age < auth_settings.JWT_REFRESH_USER_SNAPSHOT_LIFETIME_SECONDS
+
+
+def get_user_snapshot_version_key(user_id: int) -> str:
+    return f"{USER_SNAPSHOT_VERSION_KEY_PREFIX}{user_id}"
+
+
+async def revoke_user_snapshots(redis: aioredis.Redis, user_id: int) -> None:
+    """Make snapshots of the user stale, so the next refresh re-reads them from the database."""
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.incr(get_user_snapshot_version_key(user_id))
+        # Outlives every token written with a previous version, so an expired counter can't be matched again
+        pipe.expire(get_user_snapshot_version_key(user_id), auth_settings.JWT_REFRESH_TOKEN_LIFETIME_SECONDS)
+        await pipe.execute()
+
 
 class RefreshRedisStrategy(RedisStrategy):
     REFRESH_TOKEN_LENGTH: int = auth_settings.JWT_REFRESH_TOKEN_LENGTH
 
-    def get_hset_name(self, token) -> str:
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.write_token_script = self.redis.register_script(WRITE_TOKEN_SCRIPT)
+        self.rotate_token_script = self.redis.register_script(ROTATE_TOKEN_SCRIPT)
+
+    def get_token_key(self, token) -> str:
         return f"{self.key_prefix}{token}"
 
-    async def read_token(
-        self, token: Optional[str], user_manager: BaseUserManager[models.UP, models.ID]
+    async def get_user(
+        self, user_id: Optional[bytes], user_manager: BaseUserManager[models.UP, models.ID]
     ) -> Optional[models.UP]:
-        if token is None:
-            return None
-        user_id = await self.redis.hget(self.get_hset_name(token), "user_id")
         if user_id is None:
             return None
 
@@ -29,24 +108,126 @@ class RefreshRedisStrategy(RedisStrategy):
         except (exceptions.UserNotExists, exceptions.InvalidID):
             return
 
+    async def read_token(
+        self, token: Optional[str], user_manager: BaseUserManager[models.UP, models.ID]
+    ) -> Optional[models.UP]:
+        if token is None:
+            return None
+
+        try:
+            value = await self.redis.get(self.get_token_key(token))
+        except ResponseError:
+            value = await self.redis.hget(self.get_token_key(token), "user_id")
+        if value is None:
+            return None
+
+        return await self.get_user(value.split(b":", 1)[0], user_manager)
+
+    async def write_snapshot(self, token: str, snapshot: UserSnapshot) -> None:
+        await self.write_token_script(
+            keys=[self.get_token_key(token), get_user_snapshot_version_key(snapshot.id)],
+            args=[snapshot.dump(), self.lifetime_seconds],
+        )
+
     async def write_token(self, user: models.UP) -> str:
         token = generate_random_string(length=self.REFRESH_TOKEN_LENGTH)
-        await self.redis.hset(self.get_hset_name(token), mapping={"user_id": str(user.id)})
-        await self.redis.expire(self.get_hset_name(token), self.lifetime_seconds)
+        await self.write_snapshot(token, UserSnapshot.from_user(user))
         return token
 
+    async def rotate_token(
+        self, token: Optional[str], user_manager: BaseUserManager[models.UP, models.ID]
+    ) -> tuple[Optional[Union[UserSnapshot, models.UP]], Optional[str]]:
+        """
+        Replace refresh token with a new one of the same user. Returns the user and the new token.
+
+        The user is taken from the snapshot stored with the token, and is only read from the database
+        when the snapshot is older than JWT_REFRESH_USER_SNAPSHOT_LIFETIME_SECONDS or was revoked.
+        Tokens of inactive users are not rotated.
+        """
+        if token is None:
+            return None, None
+
+        new_token = generate_random_string(length=self.REFRESH_TOKEN_LENGTH)
+        value = await self.rotate_token_script(
+            keys=[self.get_token_key(token), self.get_token_key(new_token)], args=[self.lifetime_seconds]
+        )
+        if value is None:
+            return None, None
+
+        user = UserSnapshot.parse(value)
+        version = None
+        if user is not None:
+            # Key of the version is known only from the value, so it's read after the script rather than by it
+            version = await self.redis.get(get_user_snapshot_version_key(user.id))
+        if user is None or not user.is_fresh(int(version or 0)):
+            user = await self.get_user(value.split(b":", 1)[0], user_manager)
+            if user is not None:
+                await self.write_snapshot(new_token, UserSnapshot.from_user(user))
+
+        if user is None or not user.is_active:
+            await self.destroy_token(new_token, user)
+            return None, None
+
+        return user, new_token
+
     async def destroy_token(self, token: str, user: models.UP) -> None:
-        await self.redis.expire(self.get_hset_name(token), 0)
+        await self.redis.delete(self.get_token_key(token))
+
+
+class CachedJWTStrategy(JWTStrategy):
+    """
+    JWT strategy returning a UserPrincipal of the token user, which is only read from the database
+    when it isn't in the in-process cache.
+    """
+
+    def __init__(self, *args, cache: PrincipalCache = principal_cache, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cache = cache
+
+    async def read_token(
+        self, token: Optional[str], user_manager: BaseUserManager[models.UP, models.ID]
+    ) -> Optional[UserPrincipal]:
+        if token is None:
+            return None
+
+        try:
+            user_id = decode_jwt(token, self.decode_key, self.token_audience, algorithms=[self.algorithm]).get("sub")
+            if user_id is None:
+                return None
+            parsed_id = user_manager.parse_id(user_id)
+        except (jwt.PyJWTError, exceptions.InvalidID):
+            return None
+
+        principal = self.cache.get(parsed_id)
+        if principal is not None:
+            return principal
+
+        invalidations = self.cache.invalidations
+        try:
+            user = await user_manager.get(parsed_id)
+        except exceptions.UserNotExists:
+            return None
+        principal = UserPrincipal.from_user(user)
+        self.cache.set(principal, invalidations)
+        return principal
 
 
 def get_jwt_strategy() -> JWTStrategy:
-    return JWTStrategy(
+    return CachedJWTStrategy(
         secret=auth_settings.JWT_SECRET,
         lifetime_seconds=auth_settings.JWT_ACCESS_TOKEN_LIFETIME_SECONDS,
     )
 
 
-def get_refresh_redis_strategy() -> RedisStrategy:
-    return RefreshRedisStrategy(
-        key_prefix="", redis=redis, lifetime_seconds=auth_settings.JWT_REFRESH_TOKEN_LIFETIME_SECONDS
-    )
+refresh_redis_strategy: Optional[RefreshRedisStrategy] = None
+
+
+def get_refresh_redis_strategy() -> RefreshRedisStrategy:
+    """Strategy shared by all requests, rebuilt only when the Redis client is replaced."""
+    global refresh_redis_strategy
+    redis = get_redis()
+    if refresh_redis_strategy is None or refresh_redis_strategy.redis is not redis:
+        refresh_redis_strategy = RefreshRedisStrategy(
+            key_prefix="", redis=redis, lifetime_seconds=auth_settings.JWT_REFRESH_TOKEN_LIFETIME_SECONDS
+        )
+    return refresh_redis_strategy
@@ -1,14 +1,37 @@
+import asyncio
+import json
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
 import pytest
 from fastapi import status
+from fastapi_users.password import PasswordHelper
+from fastapi_users.router.common import ErrorCode
 from fastapi_users.schemas import BaseUser
 from httpx import AsyncClient, Response
-from sqlalchemy import select
+from sqlalchemy import event, select
 
+from auth.db import SQLAlchemyUserDatabase
+from auth.manager import referral_code_validation_failures, signups
 from auth.models import User
-from conftest import DateTimeBetweenKwargs
+from auth.password import password_hashing_pool, password_hashing_duration_seconds, password_hashing_rejected
+from auth.principal import (
+    PRINCIPAL_INVALIDATION_CHANNEL,
+    listen_for_principal_invalidations,
+    principal_cache,
+    UserPrincipal,
+)
+from auth.strategy import revoke_user_snapshots
+from auth.user_import import UserImporter, ImportCheckpoint
+from auth.views import login_rate_limiter
+from conftest import DateTimeBetweenKwargs, test_redis, test_engine, test_session
 from core.enums import ErrorDetails
+from core.rate_limit import RateLimit, rate_limited_requests
 from factories import TestUser
-from referral_program.models import ReferralCode
+from referral_program.db import ReferralProgramRepository
+from referral_program.issued_codes import IssuedReferralCodes, rebuild_issued_referral_codes
+from referral_program.leaderboard import Leaderboard, LeaderboardPeriod
+from referral_program.models import ReferralCode, ReferralClosure
 from referral_program.services import generate_referral_code
 
 
@@ -16,6 +39,7 @@ class TestAuth:
     async def test_register_with_referral_code(
         self, auth_client: AsyncClient, get_test_async_session, referral_code: ReferralCode
     ):
+        referral_signups = signups.labels("true").value
         response = await auth_client.post(
             "/auth/register", json=TestUser(referral_code=referral_code.code).model_dump()
         )
@@ -25,15 +49,40 @@ class TestAuth:
         assert referral_code.referrer.id == await get_test_async_session.scalar(
             select(User.referrer_id).where(User.id == registered_user_id)
         )
+        assert registered_user_id == await get_test_async_session.scalar(
+            select(ReferralCode.used_by_id).where(ReferralCode.id == referral_code.id, ReferralCode.used_at != None)
+        )
+        assert signups.labels("true").value == referral_signups + 1
+
+    async def test_register_with_referral_code_commits_once(
+        self, auth_client: AsyncClient, referral_code: ReferralCode
+    ):
+        commits = []
+
+        def on_commit(conn):
+            commits.append(conn)
+
+        event.listen(test_engine.sync_engine, "commit", on_commit)
+        try:
+            response = await auth_client.post(
+                "/auth/register", json=TestUser(referral_code=referral_code.code).model_dump()
+            )
+        finally:
+            event.remove(test_engine.sync_engine, "commit", on_commit)
+
+        assert response.status_code == status.HTTP_201_CREATED
+        assert len(commits) == 1
 
     @pytest.mark.parametrize("referral_code", [DateTimeBetweenKwargs(start_date="-10d", end_date="-1d")], indirect=True)
     async def test_register_with_expired_referral_code(self, auth_client: AsyncClient, referral_code: ReferralCode):
+        failures = referral_code_validation_failures.labels(ErrorDetails.EXPIRED_REFERRAL_CODE.name).value
         response = await auth_client.post(
             "/auth/register", json=TestUser(referral_code=referral_code.code).model_dump()
         )
 
         assert response.status_code == status.HTTP_400_BAD_REQUEST
         assert response.json()["detail"] == ErrorDetails.EXPIRED_REFERRAL_CODE
+        assert referral_code_validation_failures.labels(ErrorDetails.EXPIRED_REFERRAL_CODE.name).value == failures + 1
 
     async def test_register_with_used_referral_code(
         self, auth_client: AsyncClient, get_test_async_session, referral_code: ReferralCode
@@ -48,6 +97,45 @@ class TestAuth:
         assert second_response.status_code == status.HTTP_400_BAD_REQUEST
         assert second_response.json()["detail"] == ErrorDetails.REFERRAL_CODE_ALREADY_USED
 
+    async def test_claim_referral_code(self, get_test_user_db: SQLAlchemyUserDatabase, referral_code: ReferralCode):
+        def get_create_dict():
+            return {
+                "email": TestUser().email,
+                "hashed_password": "hashed_password",
+                "is_active": True,
+                "is_superuser": False,
+                "is_verified": False,
+            }
+
+        claimed_after = datetime.utcnow()
+        user, referrer_id = await get_test_user_db.create_with_referral_code(get_create_dict(), referral_code.code)
+        second_claim = await get_test_user_db.create_with_referral_code(get_create_dict(), referral_code.code)
+        claimed_referral_code = await get_test_user_db.get_referral_code(referral_code.code)
+        await get_test_user_db.session.refresh(claimed_referral_code)
+
+        assert referrer_id == referral_code.referrer_id
+        assert claimed_referral_code.used_by_id == user.id
+        assert claimed_after <= claimed_referral_code.used_at <= datetime.utcnow()
+        assert second_claim is None
+        assert await get_test_user_db.check_referral_code_was_used(referral_code.code)
+
+    async def test_register_with_failed_claim_of_valid_referral_code(
+        self, auth_client: AsyncClient, referral_code: ReferralCode, monkeypatch
+    ):
+        async def create_with_referral_code(self, create_dict, code):
+            return None
+
+        # The failed request rolls back the shared session, which expires the fixture
+        code = referral_code.code
+        with monkeypatch.context() as patch:
+            patch.setattr(SQLAlchemyUserDatabase, "create_with_referral_code", create_with_referral_code)
+            failed_response = await auth_client.post("/auth/register", json=TestUser(referral_code=code).model_dump())
+        response = await auth_client.post("/auth/register", json=TestUser(referral_code=code).model_dump())
+
+        assert failed_response.status_code == status.HTTP_400_BAD_REQUEST
+        assert await IssuedReferralCodes(test_redis).check(code) is None
+        assert response.status_code == status.HTTP_201_CREATED
+
     async def test_register_with_non_existing_referral_code(self, auth_client: AsyncClient, get_test_async_session):
         response = await auth_client.post(
             "/auth/register", json=TestUser(referral_code=generate_referral_code()).model_dump()
@@ -56,6 +144,136 @@ class TestAuth:
         assert response.status_code == status.HTTP_400_BAD_REQUEST
         assert response.json()["detail"] == ErrorDetails.REFERRAL_CODE_DOESNT_EXIST
 
+    async def test_register_with_not_issued_referral_code_skips_database(
+        self, auth_client: AsyncClient, referral_code: ReferralCode
+    ):
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        assert await rebuild_issued_referral_codes(test_redis, test_session) == 1
+        event.listen(test_engine.sync_engine, "before_cursor_execute", before_cursor_execute)
+        try:
+            response = await auth_client.post(
+                "/auth/register", json=TestUser(referral_code=generate_referral_code()).model_dump()
+            )
+        finally:
+            event.remove(test_engine.sync_engine, "before_cursor_execute", before_cursor_execute)
+        issued_code_response = await auth_client.post(
+            "/auth/register", json=TestUser(referral_code=referral_code.code).model_dump()
+        )
+
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+        assert response.json()["detail"] == ErrorDetails.REFERRAL_CODE_DOESNT_EXIST
+        assert not any("referral_code" in statement for statement in statements)
+        assert issued_code_response.status_code == status.HTTP_201_CREATED
+
+    async def test_register_after_issued_referral_codes_evicted(
+        self, auth_client: AsyncClient, referral_code: ReferralCode
+    ):
+        code = referral_code.code
+        assert await rebuild_issued_referral_codes(test_redis, test_session) == 1
+        await test_redis.delete(IssuedReferralCodes.SET_KEY)
+
+        assert await IssuedReferralCodes(test_redis).check(code) is None
+        response = await auth_client.post("/auth/register", json=TestUser(referral_code=code).model_dump())
+
+        assert response.status_code == status.HTTP_201_CREATED
+
+    @pytest.mark.parametrize("referral_code", [DateTimeBetweenKwargs(start_date="-10d", end_date="-1d")], indirect=True)
+    async def test_register_with_recently_rejected_referral_code(
+        self, auth_client: AsyncClient, referral_code: ReferralCode
+    ):
+        statements = []
+        code = referral_code.code
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        await auth_client.post("/auth/register", json=TestUser(referral_code=code).model_dump())
+        event.listen(test_engine.sync_engine, "before_cursor_execute", before_cursor_execute)
+        try:
+            response = await auth_client.post("/auth/register", json=TestUser(referral_code=code).model_dump())
+        finally:
+            event.remove(test_engine.sync_engine, "before_cursor_execute", before_cursor_execute)
+
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+        assert response.json()["detail"] == ErrorDetails.EXPIRED_REFERRAL_CODE
+        assert not any("referral_code" in statement for statement in statements)
+
+    async def test_register_existing_email_with_referral_code(
+        self, auth_client: AsyncClient, user: BaseUser, referral_code: ReferralCode
+    ):
+        response = await auth_client.post(
+            "/auth/register", json=TestUser(email=user.email, referral_code=referral_code.code).model_dump()
+        )
+
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+        assert response.json()["detail"] == ErrorCode.REGISTER_USER_ALREADY_EXISTS
+
+    async def test_login(self, auth_client: AsyncClient):
+        test_user = TestUser()
+        await auth_client.post("/auth/register", json=test_user.model_dump())
+        verifications = password_hashing_duration_seconds.labels("verify_and_update").count
+
+        response = await auth_client.post(
+            "/auth/login", data={"username": test_user.email, "password": test_user.password}
+        )
+        wrong_password_response = await auth_client.post(
+            "/auth/login", data={"username": test_user.email, "password": test_user.password + "wrong"}
+        )
+
+        assert response.status_code == status.HTTP_204_NO_CONTENT
+        assert wrong_password_response.status_code == status.HTTP_400_BAD_REQUEST
+        assert wrong_password_response.json()["detail"] == ErrorCode.LOGIN_BAD_CREDENTIALS
+        assert password_hashing_duration_seconds.labels("verify_and_update").count == verifications + 2
+        assert password_hashing_pool.pending == 0
+
+    async def test_login_is_rate_limited_by_email(self, auth_client: AsyncClient, user: BaseUser, monkeypatch):
+        monkeypatch.setattr(login_rate_limiter, "limits", (RateLimit("ip", 10, 60), RateLimit("email", 2, 60)))
+        rate_limited = rate_limited_requests.labels("login", "email").value
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        credentials = {"username": user.email.upper(), "password": "wrong"}
+        for _ in range(2):
+            await auth_client.post("/auth/login", data=credentials)
+        event.listen(test_engine.sync_engine, "before_cursor_execute", before_cursor_execute)
+        try:
+            response = await auth_client.post("/auth/login", data=credentials)
+        finally:
+            event.remove(test_engine.sync_engine, "before_cursor_execute", before_cursor_execute)
+        other_email_response = await auth_client.post(
+            "/auth/login", data={"username": "other@example.com", "password": "wrong"}
+        )
+
+        assert response.status_code == status.HTTP_429_TOO_MANY_REQUESTS
+        assert response.json()["detail"] == ErrorDetails.TOO_MANY_REQUESTS
+        assert statements == []
+        assert rate_limited_requests.labels("login", "email").value == rate_limited + 1
+        assert other_email_response.status_code == status.HTTP_400_BAD_REQUEST
+
+    async def test_register_when_password_hashing_is_overloaded(self, auth_client: AsyncClient, monkeypatch):
+        rejections = password_hashing_rejected.labels("hash").value
+        monkeypatch.setattr(password_hashing_pool, "max_pending", 0)
+
+        response = await auth_client.post("/auth/register", json=TestUser().model_dump())
+
+        assert response.status_code == status.HTTP_503_SERVICE_UNAVAILABLE
+        assert response.json()["detail"] == ErrorDetails.PASSWORD_HASHING_OVERLOADED
+        assert response.headers["Retry-After"] == "1"
+        assert password_hashing_rejected.labels("hash").value == rejections + 1
+
+    async def test_register_after_password_hashing_pool_shutdown(self, auth_client: AsyncClient):
+        password_hashing_pool.shutdown()
+        response = await auth_client.post("/auth/register", json=TestUser().model_dump())
+
+        assert response.status_code == status.HTTP_201_CREATED
+        assert password_hashing_pool.executor is not None
+
     async def test_logout(self, auth_client: AsyncClient):
         response = await auth_client.post("/auth/logout")
 
@@ -71,3 +289,139 @@ class TestAuth:
         assert response.status_code == status.HTTP_204_NO_CONTENT
         assert response.cookies.get("access_token") is not None
         assert response.cookies.get("refresh_token") != old_refresh_token
+
+    async def test_refresh_token_cannot_be_reused(self, auth_client: AsyncClient):
+        auth_client.cookies.pop("access_token", None)
+        old_refresh_token = auth_client.cookies.get("refresh_token")
+        await auth_client.post("/auth/refresh")
+        response: Response = await auth_client.post("/auth/refresh", cookies={"refresh_token": old_refresh_token})
+
+        assert response.status_code == status.HTTP_401_UNAUTHORIZED
+        assert response.json()["detail"] == ErrorDetails.INVALID_REFRESH_TOKEN
+
+    async def test_refresh_legacy_hash_token(self, auth_client: AsyncClient, user: BaseUser):
+        await test_redis.hset("legacy_refresh_token", mapping={"user_id": str(user.id)})
+        response: Response = await auth_client.post("/auth/refresh", cookies={"refresh_token": "legacy_refresh_token"})
+
+        assert response.status_code == status.HTTP_204_NO_CONTENT
+        assert await test_redis.exists("legacy_refresh_token") == 0
+
+    async def test_refresh_token_doesnt_read_user_while_snapshot_is_fresh(
+        self, auth_client: AsyncClient, get_test_user_db: SQLAlchemyUserDatabase, user: BaseUser
+    ):
+        await get_test_user_db.update(user, {"is_active": False})
+        response: Response = await auth_client.post("/auth/refresh")
+
+        assert response.status_code == status.HTTP_204_NO_CONTENT
+
+    async def test_refresh_token_with_revoked_user_snapshot(
+        self, auth_client: AsyncClient, get_test_user_db: SQLAlchemyUserDatabase, user: BaseUser
+    ):
+        await get_test_user_db.update(user, {"is_active": False})
+        await revoke_user_snapshots(test_redis, user.id)
+        response: Response = await auth_client.post("/auth/refresh")
+
+        assert response.status_code == status.HTTP_401_UNAUTHORIZED
+
+    async def test_authenticated_user_is_read_from_principal_cache(self, auth_client: AsyncClient, user: BaseUser):
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        first_response: Response = await auth_client.get("/leaderboard/all_time")
+        event.listen(test_engine.sync_engine, "before_cursor_execute", before_cursor_execute)
+        try:
+            second_response: Response = await auth_client.get("/leaderboard/all_time")
+        finally:
+            event.remove(test_engine.sync_engine, "before_cursor_execute", before_cursor_execute)
+
+        assert first_response.status_code == second_response.status_code == status.HTTP_200_OK
+        assert statements == []
+        assert principal_cache.get(user.id) == UserPrincipal.from_user(user)
+
+    async def test_principal_is_invalidated_by_other_workers(self, auth_client: AsyncClient, user: BaseUser):
+        listener = asyncio.create_task(listen_for_principal_invalidations(test_redis))
+        try:
+            while not (await test_redis.pubsub_numsub(PRINCIPAL_INVALIDATION_CHANNEL))[0][1]:
+                await asyncio.sleep(0.01)
+            await auth_client.get("/leaderboard/all_time")
+            assert principal_cache.get(user.id) is not None
+
+            await test_redis.publish(PRINCIPAL_INVALIDATION_CHANNEL, user.id)
+            for _ in range(100):
+                if user.id not in principal_cache.entries:
+                    break
+                await asyncio.sleep(0.01)
+        finally:
+            listener.cancel()
+
+        assert principal_cache.get(user.id) is None
+
+
+class TestUserImport:
+    async def test_import_users(self, get_test_async_session, referral_code: ReferralCode, user: BaseUser, tmp_path):
+        rows = [
+            {"email": "referred@example.com", "password": "password", "referral_code": referral_code.code},
+            {"email": "plain@example.com", "password": "password"},
+            {"email": user.email.upper(), "password": "password"},
+            {"email": "second@example.com", "password": "password", "referral_code": referral_code.code},
+            {"email": "unknown@example.com", "password": "password", "referral_code": "unknown"},
+            {"email": "not an email", "password": "password"},
+        ]
+        path = tmp_path / "users.ndjson"
+        path.write_text("\n".join(json.dumps(row) for row in rows) + "\n{broken\n")
+
+        with ProcessPoolExecutor(max_workers=1) as executor, open(path) as file:
+            importer = UserImporter(test_session, test_redis, executor)
+            batches = [batch async for batch in importer.import_file(file, "ndjson", batch_size=10)]
+
+        assert [(batch.last_line, batch.imported) for batch in batches] == [(7, 2)]
+        errors = [(error.line, error.error) for error in batches[0].errors]
+        assert errors[:3] == [
+            (3, ErrorCode.REGISTER_USER_ALREADY_EXISTS),
+            (4, ErrorDetails.REFERRAL_CODE_ALREADY_USED),
+            (5, ErrorDetails.REFERRAL_CODE_DOESNT_EXIST),
+        ]
+        assert errors[3][0] == 6 and errors[3][1].startswith("value is not a valid email address")
+        assert errors[4] == (7, "Malformed row.")
+        referred = await get_test_async_session.scalar(select(User).where(User.email == "referred@example.com"))
+        assert referred.referrer_id == referral_code.id
+        assert PasswordHelper().verify_and_update("password", referred.hashed_password)[0]
+        assert referred.id == await get_test_async_session.scalar(
+            select(ReferralCode.used_by_id).where(ReferralCode.id == referral_code.id)
+        )
+        stats = await ReferralProgramRepository(get_test_async_session).fetch_referrer_stats(user.id)
+        await get_test_async_session.refresh(stats)
+        assert stats.referrals_count == 1
+        assert (
+            await get_test_async_session.scalar(
+                select(ReferralClosure.depth).where(
+                    ReferralClosure.ancestor_id == user.id, ReferralClosure.descendant_id == referred.id
+                )
+            )
+            == 1
+        )
+        assert await Leaderboard(test_redis).rank(LeaderboardPeriod.ALL_TIME, user.id) == (0, 1)
+
+    async def test_import_users_resumes_after_checkpoint(self, get_test_async_session, tmp_path):
+        path = tmp_path / "users.csv"
+        path.write_text(
+            "email,password,referral_code\n" + "".join(f"user{number}@example.com,password,\n" for number in range(5))
+        )
+        checkpoint_path = str(tmp_path / "users.csv.checkpoint.json")
+        ImportCheckpoint(line=3, imported=2).save(checkpoint_path)
+
+        checkpoint = ImportCheckpoint.load(checkpoint_path)
+        with ProcessPoolExecutor(max_workers=1) as executor, open(path, newline="") as file:
+            importer = UserImporter(test_session, test_redis, executor)
+            batches = [
+                batch async for batch in importer.import_file(file, "csv", batch_size=2, after_line=checkpoint.line)
+            ]
+
+        assert [(batch.last_line, batch.imported, batch.errors) for batch in batches] == [(5, 2, []), (6, 1, [])]
+        assert set(await get_test_async_session.scalars(select(User.email))) == {
+            "user2@example.com",
+            "user3@example.com",
+            "user4@example.com",
+        }
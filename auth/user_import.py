@@ -0,0 +1,311 @@
+"""
+Bulk import of users from CSV or NDJSON files, e.g. when migrating the user base of a partner.
+
+Rows carry the email, the password and an optional referral code of a user, the same fields as the registration.
+They are imported in batches, each committed on its own: a batch resolves all its emails and referral codes
+with one query each, hashes the passwords in a process pool and inserts the users at once.
+Rows which the registration would reject are reported with the reason instead of failing the batch.
+"""
+import asyncio
+import csv
+import json
+import os
+from collections import Counter
+from concurrent.futures import Executor
+from dataclasses import dataclass, asdict
+from datetime import datetime
+from functools import partial
+from itertools import chain
+from typing import AsyncIterator, Iterator, Literal, Optional, TextIO, Union
+
+import aioredis
+from fastapi_users.password import PasswordHelper
+from fastapi_users.router.common import ErrorCode
+from pydantic import ValidationError
+from sqlalchemy import Row
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from core.db import unit_of_work, add_after_commit_callback
+from core.enums import ErrorDetails
+from referral_program.cache import ReferralCodeCache
+from referral_program.db import ReferralProgramRepository
+from referral_program.leaderboard import Leaderboard
+from .config import auth_settings
+from .db import SQLAlchemyUserDatabase
+from .models import User
+from .schema import UserCreate
+
+ImportFormat = Literal["csv", "ndjson"]
+
+# Inserting a batch is retried when a concurrent registration takes one of its emails after they were checked
+INSERT_ATTEMPTS = 3
+
+password_helper = PasswordHelper()
+
+
+def hash_passwords(passwords: list[str]) -> list[str]:
+    """Runs in the worker processes, the same helper as UserManager uses."""
+    return [password_helper.hash(password) for password in passwords]
+
+
+@dataclass
+class ImportRow:
+    line: int
+    email: str
+    password: str
+    referral_code: Optional[str]
+
+
+@dataclass
+class RowError:
+    line: int
+    email: Optional[str]
+    error: str
+
+
+@dataclass
+class BatchResult:
+    last_line: int
+    imported: int
+    errors: list[RowError]
+
+
+@dataclass
+class ImportCheckpoint:
+    """Progress of an import saved after every committed batch, so an interrupted import can be resumed."""
+
+    line: int = 0
+    imported: int = 0
+    failed: int = 0
+
+    @classmethod
+    def load(cls, path: str) -> "ImportCheckpoint":
+        if not os.path.exists(path):
+            return cls()
+        with open(path) as checkpoint_file:
+            return cls(**json.load(checkpoint_file))
+
+    def save(self, path: str) -> None:
+        # Replaced atomically, so a crash never leaves a truncated checkpoint behind
+        with open(f"{path}.tmp", "w") as checkpoint_file:
+            json.dump(asdict(self), checkpoint_file)
+        os.replace(f"{path}.tmp", path)
+
+
+def read_rows(file: TextIO, format: ImportFormat) -> Iterator[tuple[int, Optional[dict]]]:
+    """Yield (line number, fields) of every row, fields are None if the line can't be parsed."""
+    if format == "csv":
+        reader = csv.DictReader(file)
+        for fields in reader:
+            yield reader.line_num, fields
+        return
+
+    for line, text in enumerate(file, start=1):
+        if not text.strip():
+            continue
+        try:
+            fields = json.loads(text)
+        except json.JSONDecodeError:
+            fields = None
+        yield line, fields if isinstance(fields, dict) else None
+
+
+def parse_row(line: int, fields: Optional[dict]) -> Union[ImportRow, RowError]:
+    if fields is None:
+        return RowError(line, None, "Malformed row.")
+    try:
+        # Empty CSV cells mean no referral code
+        user_create = UserCreate.model_validate({**fields, "referral_code": fields.get("referral_code") or None})
+    except ValidationError as error:
+        return RowError(line, fields.get("email"), error.errors()[0]["msg"])
+    return ImportRow(line, user_create.email, user_create.password, user_create.referral_code)
+
+
+def get_referral_code_rejection_reason(referral_code: Optional[Row], now: datetime) -> Optional[ErrorDetails]:
+    """Same checks as UserManager.validate_referral_code."""
+    if referral_code is None:
+        return ErrorDetails.REFERRAL_CODE_DOESNT_EXIST
+    if referral_code.expired_at < now:
+        return ErrorDetails.EXPIRED_REFERRAL_CODE
+    if referral_code.used_at is not None:
+        return ErrorDetails.REFERRAL_CODE_ALREADY_USED
+    return None
+
+
+class UserImporter:
+    def __init__(
+        self,
+        session_maker: async_sessionmaker[AsyncSession],
+        redis: aioredis.Redis,
+        executor: Executor,
+        hashing_chunk_size: int = auth_settings.USER_IMPORT_HASHING_CHUNK_SIZE,
+    ):
+        self.session_maker = session_maker
+        self.executor = executor
+        self.hashing_chunk_size = hashing_chunk_size
+        self.referral_code_cache = ReferralCodeCache(redis)
+        self.leaderboard = Leaderboard(redis)
+
+    async def hash_passwords(self, passwords: list[str]) -> list[str]:
+        """Hash in chunks spread over the workers, so every process gets work without a round trip per password."""
+        loop = asyncio.get_running_loop()
+        chunks = [
+            passwords[start : start + self.hashing_chunk_size]
+            for start in range(0, len(passwords), self.hashing_chunk_size)
+        ]
+        hashed_chunks = await asyncio.gather(
+            *(loop.run_in_executor(self.executor, hash_passwords, chunk) for chunk in chunks)
+        )
+        return list(chain.from_iterable(hashed_chunks))
+
+    async def validate(
+        self, user_db: SQLAlchemyUserDatabase, rows: list[ImportRow], lock: bool = False
+    ) -> tuple[list[tuple[ImportRow, Optional[Row]]], list[RowError]]:
+        """
+        Split the rows into the accepted ones, paired with their referral code, and the rejected ones.
+        Emails are looked up with a single query, and so are the referral codes, locked if `lock` is set.
+        """
+        existing_emails = await user_db.fetch_existing_emails([row.email for row in rows])
+        referral_codes = await user_db.fetch_referral_codes(
+            {row.referral_code for row in rows if row.referral_code}, lock=lock
+        )
+        now = datetime.utcnow()
+
+        accepted, errors = [], []
+        seen_emails, claimed_code_ids = set(), set()
+        for row in rows:
+            if row.email.lower() in existing_emails or row.email.lower() in seen_emails:
+                errors.append(RowError(row.line, row.email, ErrorCode.REGISTER_USER_ALREADY_EXISTS))
+                continue
+            referral_code = None
+            if row.referral_code:
+                referral_code = referral_codes.get(row.referral_code)
+                rejection_reason = get_referral_code_rejection_reason(referral_code, now)
+                if rejection_reason is None and referral_code.id in claimed_code_ids:
+                    rejection_reason = ErrorDetails.REFERRAL_CODE_ALREADY_USED
+                if rejection_reason is not None:
+                    errors.append(RowError(row.line, row.email, rejection_reason))
+                    continue
+                claimed_code_ids.add(referral_code.id)
+            seen_emails.add(row.email.lower())
+            accepted.append((row, referral_code))
+
+        return accepted, errors
+
+    async def insert(
+        self, session: AsyncSession, rows: list[ImportRow], hashed_passwords: dict[int, str]
+    ) -> tuple[int, list[RowError]]:
+        """
+        Insert the rows still valid under the lock of their referral codes along with the referral bookkeeping
+        of the registration: claimed codes, referral closure and referrer stats.
+        Returns the number of users with the errors of the rows taken by concurrent registrations meanwhile.
+        """
+        user_db = SQLAlchemyUserDatabase(session, User)
+        accepted, errors = await self.validate(user_db, rows, lock=True)
+        if not accepted:
+            return 0, errors
+
+        user_ids = await user_db.bulk_create(
+            [
+                {
+                    "email": row.email,
+                    "hashed_password": hashed_passwords[row.line],
+                    "is_active": True,
+                    "is_superuser": False,
+                    "is_verified": False,
+                    "referrer_id": referral_code.id if referral_code is not None else None,
+                }
+                for row, referral_code in accepted
+            ]
+        )
+
+        referrals = [
+            (user_id, referral_code)
+            for user_id, (_, referral_code) in zip(user_ids, accepted)
+            if referral_code is not None
+        ]
+        if referrals:
+            used_at = datetime.utcnow()
+            await user_db.claim_referral_codes(
+                {referral_code.id: user_id for user_id, referral_code in referrals}, used_at
+            )
+            await user_db.bulk_add_to_referral_closure([user_id for user_id, _ in referrals])
+
+            referrals_counts = Counter(
+                referral_code.referrer_id for _, referral_code in referrals if referral_code.referrer_id is not None
+            )
+            if referrals_counts:
+                await ReferralProgramRepository(session).update_referrers_stats(
+                    [
+                        {
+                            "referrer_id": referrer_id,
+                            "referrals_count": referrals_count,
+                            "last_referral_at": used_at,
+                        }
+                        for referrer_id, referrals_count in referrals_counts.items()
+                    ]
+                )
+
+            add_after_commit_callback(
+                session,
+                partial(self.referral_code_cache.invalidate_by_codes, *(code.code for _, code in referrals)),
+            )
+            for referrer_id, referrals_count in referrals_counts.items():
+                add_after_commit_callback(
+                    session, partial(self.leaderboard.increment, referrer_id, used_at, referrals_count)
+                )
+
+        return len(user_ids), errors
+
+    async def import_batch(self, rows: list[ImportRow]) -> tuple[int, list[RowError]]:
+        """
+        Import the rows, returns the number of imported users with the errors of the rejected rows.
+
+        Rows are validated before hashing, so rejected ones don't cost a hash, and validated again under
+        the lock of the referral codes in the transaction inserting them, which doesn't wait for the hashing.
+        """
+        async with self.session_maker() as session:
+            accepted, errors = await self.validate(SQLAlchemyUserDatabase(session, User), rows)
+        rows = [row for row, _ in accepted]
+        if not rows:
+            return 0, errors
+        hashed_passwords = dict(
+            zip((row.line for row in rows), await self.hash_passwords([row.password for row in rows]))
+        )
+
+        for attempt in range(1, INSERT_ATTEMPTS + 1):
+            try:
+                async with self.session_maker() as session, unit_of_work(session):
+                    imported, rejected = await self.insert(session, rows, hashed_passwords)
+                break
+            except IntegrityError:
+                if attempt == INSERT_ATTEMPTS:
+                    raise
+
+        return imported, errors + rejected
+
+    async def import_file(
+        self, file: TextIO, format: ImportFormat, batch_size: int, after_line: int = 0
+    ) -> AsyncIterator[BatchResult]:
+        """Import the rows of the file following `after_line`, yielding the result of every committed batch."""
+        rows: list[ImportRow] = []
+        errors: list[RowError] = []
+        last_line = after_line
+        for line, fields in read_rows(file, format):
+            if line <= after_line:
+                continue
+            last_line = line
+            row = parse_row(line, fields)
+            if isinstance(row, RowError):
+                errors.append(row)
+            else:
+                rows.append(row)
+            if len(rows) >= batch_size:
+                imported, batch_errors = await self.import_batch(rows)
+                yield BatchResult(last_line, imported, sorted(errors + batch_errors, key=lambda error: error.line))
+                rows, errors = [], []
+
+        if rows or errors:
+            imported, batch_errors = await self.import_batch(rows) if rows else (0, [])
+            yield BatchResult(last_line, imported, sorted(errors + batch_errors, key=lambda error: error.line))
@@ -6,7 +6,7 @@ from fastapi import Cookie
 from fastapi.security import OAuth2PasswordRequestForm
 from fastapi_users import models
 from fastapi_users.authentication import Authenticator, Strategy
-from fastapi_users.authentication import RedisStrategy, JWTStrategy
+from fastapi_users.authentication import JWTStrategy
 from fastapi_users.manager import BaseUserManager, UserManagerDependency
 from fastapi_users.openapi import OpenAPIResponseType
 from fastapi_users.router.common import ErrorCode, ErrorModel
@@ -17,8 +17,20 @@ from auth.backend import (
     AuthenticationRefreshJWTBackend,
 )
 from auth.manager import get_user_manager
+from auth.strategy import RefreshRedisStrategy
 from auth.transport import RefreshCookieTransport, get_refresh_cookie_transport
+from core.config import settings
 from core.enums import ErrorDetails
+from core.rate_limit import RateLimiter, RateLimit
+
+login_rate_limiter = RateLimiter(
+    "login",
+    RateLimit("ip", settings.RATE_LIMIT_LOGIN_PER_IP, settings.RATE_LIMIT_PERIOD_SECONDS),
+    RateLimit("email", settings.RATE_LIMIT_LOGIN_PER_EMAIL, settings.RATE_LIMIT_PERIOD_SECONDS),
+)
+register_rate_limiter = RateLimiter(
+    "register", RateLimit("ip", settings.RATE_LIMIT_REGISTER_PER_IP, settings.RATE_LIMIT_PERIOD_SECONDS)
+)
 
 
 def get_auth_router(
@@ -49,6 +61,32 @@ def get_auth_router(
                 }
             },
         },
+        status.HTTP_503_SERVICE_UNAVAILABLE: {
+            "model": ErrorModel,
+            "content": {
+                "application/json": {
+                    "examples": {
+                        ErrorDetails.PASSWORD_HASHING_OVERLOADED: {
+                            "summary": ErrorDetails.PASSWORD_HASHING_OVERLOADED,
+                            "value": {"detail": ErrorDetails.PASSWORD_HASHING_OVERLOADED},
+                        },
+                    }
+                }
+            },
+        },
+        status.HTTP_429_TOO_MANY_REQUESTS: {
+            "model": ErrorModel,
+            "content": {
+                "application/json": {
+                    "examples": {
+                        ErrorDetails.TOO_MANY_REQUESTS: {
+                            "summary": ErrorDetails.TOO_MANY_REQUESTS,
+                            "value": {"detail": ErrorDetails.TOO_MANY_REQUESTS},
+                        },
+                    }
+                }
+            },
+        },
         **backend.transport.get_openapi_login_responses_success(),
     }
 
@@ -56,6 +94,7 @@ def get_auth_router(
         "/login",
         name=f"auth:{backend.name}.login",
         responses=login_responses,
+        dependencies=[Depends(login_rate_limiter)],
     )
     async def login(
         request: Request,
@@ -113,20 +152,18 @@ def get_auth_router(
         },
     )
     async def refresh_jwt(
-        refresh_strategy: Annotated[RedisStrategy, Depends(get_refresh_redis_strategy)],
+        refresh_strategy: Annotated[RefreshRedisStrategy, Depends(get_refresh_redis_strategy)],
         strategy: Annotated[JWTStrategy, Depends(get_jwt_strategy)],
         refresh_token: Annotated[str, Cookie()],
         user_manager: Annotated[BaseUserManager, Depends(get_user_manager)],
         transport: Annotated[RefreshCookieTransport, Depends(get_refresh_cookie_transport)],
     ):
-        user = await refresh_strategy.read_token(refresh_token, user_manager)
+        user, new_refresh_token = await refresh_strategy.rotate_token(refresh_token, user_manager)
 
         if user is None:
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail=ErrorDetails.INVALID_REFRESH_TOKEN)
 
         token = await strategy.write_token(user)
-        await refresh_strategy.destroy_token(refresh_token, user)
-        new_refresh_token = await refresh_strategy.write_token(user)
         return await transport.get_login_response(token, new_refresh_token)
 
     return router
@@ -0,0 +1,350 @@
+"""
+Load benchmark of the auth and referral endpoints.
+
+Drives the app of main in process through httpx.ASGITransport at the given concurrency and reports
+latency percentiles, requests per second and database queries per request of every endpoint.
+The app runs against a seeded SQLite file by default, which serializes database access,
+or a throwaway schema of PostgreSQL with --database-url, and against the Redis configured by REDIS_* settings, so point REDIS_DB
+at a scratch database.
+
+    REDIS_DB=3 python -m benchmarks.load --flush-redis --users 2000 --requests 500 --output bench_load.json
+    REDIS_DB=3 python -m benchmarks.load --flush-redis --baseline bench_load.json --max-regression 0.25
+"""
+import argparse
+import asyncio
+import contextvars
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Optional
+
+from fastapi_users.password import PasswordHelper
+from httpx import ASGITransport, AsyncClient, Response
+from sqlalchemy import event, insert, text, update
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
+
+from auth.models import User
+from auth.strategy import get_jwt_strategy
+from core.config import settings
+from core.db import get_async_session, get_async_session_maker, unit_of_work
+from core.models import Base
+from core.redis import get_redis, close_redis
+from main import create_app
+from referral_program.models import ReferralCode
+
+PASSWORD = "benchmark-password"
+BASE_URL = "https://benchmark"
+REFERRERS_SHARE = 10
+# Regressions of these metrics fail the comparison with the baseline, higher is worse unless listed as lower
+COMPARED_METRICS = ("p95_ms", "rps", "queries_per_request")
+LOWER_IS_WORSE = {"rps"}
+
+app = create_app()
+
+
+@dataclass
+class QueryCounter:
+    count: int = 0
+
+
+current_query_counter: contextvars.ContextVar[Optional[QueryCounter]] = contextvars.ContextVar(
+    "current_query_counter", default=None
+)
+
+
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    # The app runs in the task of the client, so the counter of the request in flight is visible here
+    counter = current_query_counter.get()
+    if counter is not None:
+        counter.count += 1
+
+
+@dataclass
+class Dataset:
+    """Ids of the seeded rows. Owners have an active code each, the first of them have referrals."""
+
+    users: int
+    requests: int
+    fresh_user_ids: list[int] = field(default_factory=list)
+    access_tokens: dict[int, str] = field(default_factory=dict)
+
+    def owner_email(self, index: int) -> str:
+        return f"owner{index % self.users + 1}@benchmark.example.com"
+
+    def owner_code(self, index: int) -> str:
+        return f"owner{index % self.users + 1:011d}"
+
+    def referrer_id(self, index: int) -> int:
+        return index % max(self.users // REFERRERS_SHARE, 1) + 1
+
+
+async def seed(engine: AsyncEngine, users: int, requests: int) -> Dataset:
+    dataset = Dataset(users=users, requests=requests)
+    hashed_password = PasswordHelper().hash(PASSWORD)
+    now = datetime.utcnow()
+    referrers_count = max(users // REFERRERS_SHARE, 1)
+
+    def user_row(id: int, email: str, referrer_id: Optional[int] = None) -> dict[str, Any]:
+        return {
+            "id": id,
+            "email": email,
+            "hashed_password": hashed_password,
+            "is_active": True,
+            "is_superuser": False,
+            "is_verified": False,
+            "referrer_id": referrer_id,
+        }
+
+    owners = [user_row(id, f"owner{id}@benchmark.example.com") for id in range(1, users + 1)]
+    owner_codes = [
+        {"id": id, "referrer_id": id, "code": f"owner{id:011d}", "created_at": now, "expired_at": now + timedelta(30)}
+        for id in range(1, users + 1)
+    ]
+    # Every owner gets a referral, grouped under the first owners, so they have REFERRERS_SHARE referrals each
+    referral_codes = [
+        {
+            "id": users + index,
+            "referrer_id": (index - 1) % referrers_count + 1,
+            "code": f"used{index:012d}",
+            "created_at": now,
+            "expired_at": now + timedelta(30),
+            "used_at": now,
+        }
+        for index in range(1, users + 1)
+    ]
+    referrals = [
+        user_row(users + index, f"referral{index}@benchmark.example.com", referrer_id=users + index)
+        for index in range(1, users + 1)
+    ]
+    dataset.fresh_user_ids = list(range(2 * users + 1, 2 * users + requests + 1))
+    fresh_users = [user_row(id, f"fresh{id}@benchmark.example.com") for id in dataset.fresh_user_ids]
+
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.execute(insert(User), owners + fresh_users)
+        await conn.execute(insert(ReferralCode), owner_codes + referral_codes)
+        await conn.execute(insert(User), referrals)
+        await conn.execute(
+            update(ReferralCode)
+            .where(ReferralCode.id > users)
+            .values(used_by_id=ReferralCode.id)
+            .execution_options(synchronize_session=False)
+        )
+        if engine.dialect.name == "postgresql":
+            await conn.execute(text("""SELECT setval(pg_get_serial_sequence('"user"', 'id'), max(id)) FROM "user\""""))
+            await conn.execute(
+                text("SELECT setval(pg_get_serial_sequence('referral_code', 'id'), max(id)) FROM referral_code")
+            )
+
+    strategy = get_jwt_strategy()
+    for id in [*range(1, referrers_count + 1), *dataset.fresh_user_ids]:
+        dataset.access_tokens[id] = await strategy.write_token(User(id=id))
+    return dataset
+
+
+@dataclass
+class Scenario:
+    name: str
+    send: Callable[[AsyncClient, int], Awaitable[Response]]
+    # Run once per worker before the timed requests, e.g. to log in
+    prepare: Optional[Callable[[AsyncClient, int], Awaitable[None]]] = None
+
+
+def get_scenarios(dataset: Dataset) -> list[Scenario]:
+    def access_cookie(id: int) -> dict[str, str]:
+        return {"Cookie": f"access_token={dataset.access_tokens[id]}"}
+
+    async def login(client: AsyncClient, index: int) -> None:
+        response = await client.post("/auth/login", data={"username": dataset.owner_email(index), "password": PASSWORD})
+        response.raise_for_status()
+
+    return [
+        Scenario(
+            "get_referral_code_by_email",
+            lambda client, index: client.get("/referral_code/", params={"email": dataset.owner_email(index)}),
+        ),
+        Scenario(
+            "get_referrals_by_referrer_id",
+            lambda client, index: client.get(
+                f"/referral_code/referrals/{dataset.referrer_id(index)}", headers=access_cookie(1)
+            ),
+        ),
+        Scenario(
+            "create_referral_code",
+            lambda client, index: client.post(
+                "/referral_code/", json={}, headers=access_cookie(dataset.fresh_user_ids[index])
+            ),
+        ),
+        Scenario(
+            "login",
+            lambda client, index: client.post(
+                "/auth/login", data={"username": dataset.owner_email(index), "password": PASSWORD}
+            ),
+        ),
+        # Refresh tokens are single use, so every worker keeps rotating its own one in the cookie jar
+        Scenario("refresh", lambda client, index: client.post("/auth/refresh"), prepare=login),
+        Scenario(
+            "register",
+            lambda client, index: client.post(
+                "/auth/register", json={"email": f"new{index}@benchmark.example.com", "password": PASSWORD}
+            ),
+        ),
+        Scenario(
+            "register_with_referral_code",
+            lambda client, index: client.post(
+                "/auth/register",
+                json={
+                    "email": f"invited{index}@benchmark.example.com",
+                    "password": PASSWORD,
+                    "referral_code": dataset.owner_code(index),
+                },
+            ),
+        ),
+    ]
+
+
+async def run_scenario(scenario: Scenario, requests: int, concurrency: int) -> dict[str, Any]:
+    latencies: list[float] = []
+    errors = 0
+    queries = QueryCounter()
+    indexes = iter(range(requests))
+
+    async def worker(worker_index: int) -> None:
+        nonlocal errors
+        async with AsyncClient(transport=ASGITransport(app=app), base_url=BASE_URL) as client:
+            if scenario.prepare is not None:
+                await scenario.prepare(client, worker_index)
+            for index in indexes:
+                token = current_query_counter.set(queries)
+                start = time.perf_counter()
+                try:
+                    response = await scenario.send(client, index)
+                finally:
+                    current_query_counter.reset(token)
+                latencies.append((time.perf_counter() - start) * 1000)
+                if response.is_error:
+                    errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(worker_index) for worker_index in range(concurrency)))
+    elapsed_seconds = time.perf_counter() - start
+
+    quantiles = statistics.quantiles(latencies, n=100)
+    return {
+        "requests": requests,
+        "errors": errors,
+        "rps": round(requests / elapsed_seconds, 2),
+        "p50_ms": round(quantiles[49], 3),
+        "p95_ms": round(quantiles[94], 3),
+        "p99_ms": round(quantiles[98], 3),
+        "queries_per_request": round(queries.count / requests, 2),
+    }
+
+
+def compare(report: dict[str, dict[str, Any]], baseline: dict[str, dict[str, Any]], max_regression: float) -> bool:
+    """Print the change of every compared metric, returns False if any of them regressed beyond the threshold."""
+    passed = True
+    for name, result in report.items():
+        if name not in baseline:
+            continue
+        for metric in COMPARED_METRICS:
+            before, after = baseline[name][metric], result[metric]
+            change = (after - before) / before if before else float(after > before)
+            if metric == "queries_per_request":
+                # Query counts are deterministic, so any increase is a regression
+                failed = after > before
+            else:
+                failed = (-change if metric in LOWER_IS_WORSE else change) > max_regression
+            passed = passed and not failed
+            print(f"{'FAIL' if failed else 'ok':>4} {name}.{metric}: {before} -> {after} ({change:+.1%})")
+    return passed
+
+
+async def main(args: argparse.Namespace) -> int:
+    if args.requests > args.users:
+        raise SystemExit("--requests must not exceed --users, every referral registration uses its own code")
+
+    database_path = None
+    if args.database_url is None:
+        database_fd, database_path = tempfile.mkstemp(suffix=".sqlite3")
+        os.close(database_fd)
+        # SQLite allows a single writer, so requests share one connection instead of failing with "database is locked"
+        engine = create_async_engine(
+            f"sqlite+aiosqlite:///{database_path}", pool_size=1, max_overflow=0, pool_timeout=60
+        )
+    else:
+        engine = create_async_engine(
+            args.database_url,
+            connect_args={"server_settings": {"search_path": args.schema}},
+            pool_size=args.concurrency,
+        )
+        async with engine.begin() as conn:
+            await conn.execute(text(f"DROP SCHEMA IF EXISTS {args.schema} CASCADE"))
+            await conn.execute(text(f"CREATE SCHEMA {args.schema}"))
+
+    session_maker = async_sessionmaker(engine, expire_on_commit=False)
+    # All requests come from the same client, so rate limits would reject most of them
+    settings.RATE_LIMIT_ENABLED = False
+
+    async def get_benchmark_session() -> AsyncSession:
+        async with session_maker() as session, unit_of_work(session):
+            yield session
+
+    app.dependency_overrides.update(
+        {get_async_session: get_benchmark_session, get_async_session_maker: lambda: session_maker}
+    )
+    try:
+        if args.flush_redis:
+            await get_redis().flushdb()
+        print(f"Seeding {args.users} owners, {args.users} referrals and {args.requests} fresh users...")
+        dataset = await seed(engine, args.users, args.requests)
+        event.listen(engine.sync_engine, "before_cursor_execute", count_query)
+
+        report: dict[str, dict[str, Any]] = {}
+        for scenario in get_scenarios(dataset):
+            if args.scenarios and scenario.name not in args.scenarios:
+                continue
+            report[scenario.name] = result = await run_scenario(scenario, args.requests, args.concurrency)
+            print(
+                f"{scenario.name}: {result['rps']} rps, p50={result['p50_ms']}ms p95={result['p95_ms']}ms "
+                f"p99={result['p99_ms']}ms, {result['queries_per_request']} queries/request, {result['errors']} errors"
+            )
+
+        if args.output:
+            with open(args.output, "w") as output:
+                json.dump(report, output, indent=2)
+            print(f"Report saved to {args.output}")
+
+        if args.baseline:
+            with open(args.baseline) as baseline:
+                return 0 if compare(report, json.load(baseline), args.max_regression) else 1
+        return 0
+    finally:
+        app.dependency_overrides.clear()
+        if database_path is None:
+            async with engine.begin() as conn:
+                await conn.execute(text(f"DROP SCHEMA IF EXISTS {args.schema} CASCADE"))
+        await engine.dispose()
+        await close_redis()
+        if database_path is not None:
+            os.remove(database_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", help="PostgreSQL URL, a temporary SQLite file is used by default")
+    parser.add_argument("--schema", default="load_benchmark", help="PostgreSQL schema that is dropped and recreated")
+    parser.add_argument("--users", type=int, default=2000, help="number of seeded referral code owners")
+    parser.add_argument("--requests", type=int, default=500, help="requests per endpoint")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--flush-redis", action="store_true", help="flush REDIS_DB first, so caches start cold")
+    parser.add_argument("--scenarios", nargs="*", help="run only these endpoints")
+    parser.add_argument("--output", help="save the report as JSON")
+    parser.add_argument("--baseline", help="report to compare with, exits with 1 on regression")
+    parser.add_argument("--max-regression", type=float, default=0.25, help="allowed relative change of latency and rps")
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,203 @@
+"""
+Benchmark of the referral repository queries before and after the indexes on referral_code.
+
+Seeds a throwaway schema of a PostgreSQL database with millions of rows, then for every repository
+method records the EXPLAIN (ANALYZE, BUFFERS) plan and latency percentiles without the indexes and with them.
+
+    python -m benchmarks.referral_queries --users 1000000 --codes 2000000 --output bench_referral_queries.json
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import statistics
+import time
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable
+
+from sqlalchemy import event, text
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession, AsyncEngine
+
+from auth.db import SQLAlchemyUserDatabase
+from auth.models import User
+from core.config import settings
+from core.models import Base
+from referral_program.db import ReferralProgramRepository
+from referral_program.models import ReferralCode
+
+BENCHMARKED_INDEXES = {
+    "ix_referral_code_active": "CREATE INDEX ix_referral_code_active "
+    "ON referral_code (referrer_id, expired_at) WHERE used_at IS NULL",
+    "ix_referral_code_referrer_id_created_at": "CREATE INDEX ix_referral_code_referrer_id_created_at "
+    "ON referral_code (referrer_id, created_at DESC)",
+}
+
+SEED_STATEMENTS = (
+    """
+    INSERT INTO "user" (id, email, hashed_password, is_active, is_superuser, is_verified)
+    SELECT g, 'user' || g || '@example.com', 'hashed_password', true, false, false
+    FROM generate_series(1, :users) g
+    """,
+    # Every user gets codes created over the last ~40 days, about a third of them already expired
+    """
+    INSERT INTO referral_code (id, referrer_id, code, created_at, expired_at)
+    SELECT g,
+           1 + (g % :users),
+           substr(md5(g::text), 1, 16),
+           now() - (g % 1000) * interval '1 hour',
+           now() + ((g % 30) - 10) * interval '1 day'
+    FROM generate_series(1, :codes) g
+    """,
+    # Second half of the users registered with the first codes, so half of the referrers have referrals
+    """
+    UPDATE "user" SET referrer_id = id - :users / 2 WHERE id > :users / 2
+    """,
+    """
+    UPDATE referral_code SET used_at = now(), used_by_id = "user".id
+    FROM "user" WHERE "user".referrer_id = referral_code.id
+    """,
+    """SELECT setval(pg_get_serial_sequence('"user"', 'id'), :users)""",
+    "SELECT setval(pg_get_serial_sequence('referral_code', 'id'), :codes)",
+)
+
+
+class StatementRecorder:
+    """Captures statements emitted by the engine, so they can be EXPLAINed with the same parameters."""
+
+    def __init__(self, engine: AsyncEngine):
+        self.engine = engine
+        self.statements: list[tuple[str, Any]] = []
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append((statement, parameters))
+
+    @contextmanager
+    def record(self):
+        self.statements.clear()
+        event.listen(self.engine.sync_engine, "before_cursor_execute", self.before_cursor_execute)
+        try:
+            yield self.statements
+        finally:
+            event.remove(self.engine.sync_engine, "before_cursor_execute", self.before_cursor_execute)
+
+
+def get_repository_methods(users: int) -> dict[str, Callable[[AsyncSession], Awaitable[Any]]]:
+    referrer_id = users // 4
+    referral_code_id = referrer_id
+    referral_code = ReferralCode(id=referral_code_id)
+    # Same expression as the seeding statement, so lookups by code hit an existing row
+    code = hashlib.md5(str(referral_code_id).encode()).hexdigest()[:16]
+
+    return {
+        "ReferralProgramRepository.check_whether_active_referral_code_exists": lambda session: (
+            ReferralProgramRepository(session).check_whether_active_referral_code_exists(referrer_id)
+        ),
+        "ReferralProgramRepository.fetch_referral_code_by_email": lambda session: (
+            ReferralProgramRepository(session).fetch_referral_code_by_email(f"user{referrer_id}@example.com")
+        ),
+        "ReferralProgramRepository.check_whether_referral_code_was_used": lambda session: (
+            ReferralProgramRepository(session).check_whether_referral_code_was_used(referral_code)
+        ),
+        "SQLAlchemyUserDatabase.get_referral_code": lambda session: (
+            SQLAlchemyUserDatabase(session, User).get_referral_code(code)
+        ),
+        "SQLAlchemyUserDatabase.check_referral_code_was_used": lambda session: (
+            SQLAlchemyUserDatabase(session, User).check_referral_code_was_used(code)
+        ),
+        "SQLAlchemyUserDatabase.fetch_referrals": lambda session: (
+            SQLAlchemyUserDatabase(session, User).fetch_referrals(referrer_id, limit=settings.REFERRALS_PAGE_SIZE)
+        ),
+    }
+
+
+async def seed(engine: AsyncEngine, users: int, codes: int) -> None:
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        for statement in SEED_STATEMENTS:
+            await conn.execute(text(statement), {"users": users, "codes": codes})
+    async with engine.connect() as conn:
+        await conn.execution_options(isolation_level="AUTOCOMMIT")
+        await conn.execute(text("VACUUM ANALYZE"))
+
+
+async def set_indexes(engine: AsyncEngine, enabled: bool) -> None:
+    async with engine.begin() as conn:
+        for name, create_statement in BENCHMARKED_INDEXES.items():
+            await conn.execute(text(f"DROP INDEX IF EXISTS {name}"))
+            if enabled:
+                await conn.execute(text(create_statement))
+        await conn.execute(text("ANALYZE referral_code"))
+
+
+async def measure(
+    engine: AsyncEngine, recorder: StatementRecorder, method: Callable[[AsyncSession], Awaitable[Any]], iterations: int
+) -> dict[str, Any]:
+    session_maker = async_sessionmaker(engine, expire_on_commit=False)
+    latencies = []
+    async with session_maker() as session:
+        for _ in range(iterations):
+            start = time.perf_counter()
+            await method(session)
+            latencies.append((time.perf_counter() - start) * 1000)
+
+        with recorder.record() as statements:
+            await method(session)
+
+        plans = []
+        for statement, parameters in statements:
+            connection = await session.connection()
+            result = await connection.exec_driver_sql(
+                f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {statement}", parameters
+            )
+            plans.append({"statement": statement, "plan": result.scalar()})
+
+    quantiles = statistics.quantiles(latencies, n=100)
+    return {
+        "p50_ms": round(quantiles[49], 3),
+        "p95_ms": round(quantiles[94], 3),
+        "p99_ms": round(quantiles[98], 3),
+        "plans": plans,
+    }
+
+
+async def main(args: argparse.Namespace) -> None:
+    engine = create_async_engine(
+        args.database_url, connect_args={"server_settings": {"search_path": args.schema}}, pool_size=1
+    )
+    async with engine.begin() as conn:
+        await conn.execute(text(f"DROP SCHEMA IF EXISTS {args.schema} CASCADE"))
+        await conn.execute(text(f"CREATE SCHEMA {args.schema}"))
+
+    try:
+        print(f"Seeding {args.users} users and {args.codes} referral codes into schema {args.schema}...")
+        await seed(engine, args.users, args.codes)
+
+        recorder = StatementRecorder(engine)
+        report: dict[str, dict[str, Any]] = {}
+        for phase, indexes_enabled in (("before", False), ("after", True)):
+            await set_indexes(engine, indexes_enabled)
+            for name, method in get_repository_methods(args.users).items():
+                result = await measure(engine, recorder, method, args.iterations)
+                report.setdefault(name, {})[phase] = result
+                print(f"{phase:>6} {name}: p50={result['p50_ms']}ms p95={result['p95_ms']}ms")
+
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2, default=str)
+        print(f"Report saved to {args.output}")
+    finally:
+        if not args.keep:
+            async with engine.begin() as conn:
+                await conn.execute(text(f"DROP SCHEMA IF EXISTS {args.schema} CASCADE"))
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", default=settings.DATABASE_URL)
+    parser.add_argument("--schema", default="referral_benchmark", help="schema that is dropped and recreated")
+    parser.add_argument("--users", type=int, default=1_000_000)
+    parser.add_argument("--codes", type=int, default=2_000_000)
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--output", default="bench_referral_queries.json")
+    parser.add_argument("--keep", action="store_true", help="keep seeded schema after the run")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,154 @@
+"""
+Benchmark of the worker cold start.
+
+Boots fresh interpreters that create the app of main under -X importtime, run its lifespan startup and serve
+the first request through httpx.ASGITransport, and reports the median time of every phase together with
+the packages that take the longest to import. The lifespan connects to the Redis and database
+configured by settings, so start them first for realistic numbers.
+
+    python -m benchmarks.startup --runs 10 --output bench_startup.json
+    python -m benchmarks.startup --baseline bench_startup.json --max-regression 0.2
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import subprocess
+import sys
+import time
+from collections import Counter
+from typing import Any
+
+PHASES = ("interpreter_ms", "import_ms", "lifespan_startup_ms", "first_request_ms", "boot_to_first_request_ms")
+
+
+async def serve_first_request(path: str) -> None:
+    """Runs in the child interpreter, prints timings of its phases as JSON."""
+    import_started_at = time.perf_counter()
+    from main import create_app
+
+    app = create_app()
+
+    from httpx import ASGITransport, AsyncClient
+
+    app_imported_at = time.perf_counter()
+    async with app.router.lifespan_context(app):
+        started_up_at = time.perf_counter()
+        async with AsyncClient(transport=ASGITransport(app=app), base_url="http://benchmark") as client:
+            response = await client.get(path)
+        responded_at = time.perf_counter()
+        responded_wall_time = time.time()
+
+    print(
+        json.dumps(
+            {
+                "status_code": response.status_code,
+                "import_ms": (app_imported_at - import_started_at) * 1000,
+                "lifespan_startup_ms": (started_up_at - app_imported_at) * 1000,
+                "first_request_ms": (responded_at - started_up_at) * 1000,
+                # Wall clock times, so the parent process can measure from the moment it spawned the worker
+                "responded_at": responded_wall_time,
+                "import_started_at": responded_wall_time - (responded_at - import_started_at),
+            }
+        )
+    )
+
+
+def parse_importtime(stderr: str) -> Counter:
+    """Self import time in milliseconds by top level package."""
+    packages: Counter = Counter()
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, _, name = line[len("import time:") :].split("|")
+        packages[name.strip().split(".")[0]] += int(self_us) / 1000
+    return packages
+
+
+def boot_worker(path: str) -> tuple[dict[str, float], Counter]:
+    spawned_at = time.time()
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-m", "benchmarks.startup", "--child", "--path", path],
+        capture_output=True,
+        text=True,
+    )
+    if process.returncode != 0:
+        raise SystemExit(f"Worker failed to boot:\n{process.stderr}")
+    child = json.loads(process.stdout.strip().splitlines()[-1])
+    if child["status_code"] >= 400:
+        raise SystemExit(f"First request to {path} failed with {child['status_code']}")
+
+    timings = {
+        "interpreter_ms": (child["import_started_at"] - spawned_at) * 1000,
+        "import_ms": child["import_ms"],
+        "lifespan_startup_ms": child["lifespan_startup_ms"],
+        "first_request_ms": child["first_request_ms"],
+        "boot_to_first_request_ms": (child["responded_at"] - spawned_at) * 1000,
+    }
+    return timings, parse_importtime(process.stderr)
+
+
+def compare(report: dict[str, Any], baseline: dict[str, Any], max_regression: float) -> bool:
+    """Print the change of every phase, returns False if any of them regressed beyond the threshold."""
+    passed = True
+    for phase in PHASES:
+        before, after = baseline["phases"][phase], report["phases"][phase]
+        change = (after - before) / before if before else float(after > before)
+        failed = change > max_regression
+        passed = passed and not failed
+        print(f"{'FAIL' if failed else 'ok':>4} {phase}: {before} -> {after} ({change:+.1%})")
+    return passed
+
+
+def main(args: argparse.Namespace) -> int:
+    # The first boot writes the bytecode caches, a restarted worker in production finds them in place
+    boot_worker(args.path)
+
+    runs, imports = [], []
+    for _ in range(args.runs):
+        timings, packages = boot_worker(args.path)
+        runs.append(timings)
+        imports.append(packages)
+
+    all_packages = set().union(*imports)
+    package_medians = {package: statistics.median(run[package] for run in imports) for package in all_packages}
+    report = {
+        "runs": args.runs,
+        "phases": {phase: round(statistics.median(run[phase] for run in runs), 2) for phase in PHASES},
+        "slowest_imports_ms": {
+            package: round(duration, 2)
+            for package, duration in sorted(package_medians.items(), key=lambda item: item[1], reverse=True)[: args.top]
+        },
+    }
+
+    for phase, duration in report["phases"].items():
+        print(f"{phase}: {duration}ms")
+    print("Slowest imports by package (self time):")
+    for package, duration in report["slowest_imports_ms"].items():
+        print(f"  {package}: {duration}ms")
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+        print(f"Report saved to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            return 0 if compare(report, json.load(baseline), args.max_regression) else 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=10, help="number of measured worker boots")
+    parser.add_argument("--path", default="/metrics", help="path of the first request")
+    parser.add_argument("--top", type=int, default=15, help="number of the slowest imported packages to report")
+    parser.add_argument("--output", help="save the report as JSON")
+    parser.add_argument("--baseline", help="report to compare with, exits with 1 on regression")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="allowed relative slowdown of every phase")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        asyncio.run(serve_first_request(args.path))
+    else:
+        sys.exit(main(args))
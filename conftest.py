@@ -14,20 +14,25 @@ from auth.config import auth_settings
 from auth.db import SQLAlchemyUserDatabase
 from auth.manager import get_user_manager
 from auth.models import User
+from auth.principal import principal_cache
 from auth.schema import UserCreate
 from auth.strategy import get_jwt_strategy, get_refresh_redis_strategy, RefreshRedisStrategy
 from core.config import settings
-from core.db import get_async_session
+from core.db import get_async_session, get_async_session_maker, unit_of_work
 from core.models import Base
+from core.redis import get_redis, create_redis
 from factories import TestUser, TestUserWithoutReferralCode
-from main import app
+from main import create_app
+from referral_program.cache import ReferralCodeCache
 from referral_program.db import ReferralProgramRepository
 from referral_program.models import ReferralCode
 from tests_utils import TokenCookies, async_partial, DateTimeBetweenKwargs, dependencies_overrider
 
 
+app = create_app()
+
 TEST_REDIS_URL = settings.REDIS_URL.replace(str(settings.REDIS_DB), str(settings.TEST_REDIS_DB))
-test_redis = aioredis.from_url(TEST_REDIS_URL)
+test_redis = create_redis(TEST_REDIS_URL)
 
 
 def get_test_refresh_redis_strategy():
@@ -56,6 +61,12 @@ async def clear_redis():
     await test_redis.flushdb()
 
 
+@pytest.fixture(autouse=True)
+def clear_principal_cache():
+    # User ids are reused by every test database
+    principal_cache.clear()
+
+
 async def create_tables():
     async with test_engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
@@ -83,9 +94,15 @@ async def get_test_user_db(get_test_async_session):
 
 @pytest.fixture
 async def auth_client(user: BaseUser, get_test_async_session) -> AsyncGenerator[AsyncClient, None]:
+    async def get_test_unit_of_work():
+        async with unit_of_work(get_test_async_session):
+            yield get_test_async_session
+
     overridden_dependencies = {
-        get_async_session: lambda: get_test_async_session,
+        get_async_session: get_test_unit_of_work,
         get_refresh_redis_strategy: get_test_refresh_redis_strategy,
+        get_redis: lambda: test_redis,
+        get_async_session_maker: lambda: test_session,
     }
 
     with dependencies_overrider(app, overridden_dependencies) as test_app:
@@ -101,21 +118,30 @@ async def auth_client(user: BaseUser, get_test_async_session) -> AsyncGenerator[
 
 @pytest.fixture
 async def user(get_test_user_db):
-    user_manager = await anext(get_user_manager(get_test_user_db))
+    user_manager = await anext(get_user_manager(get_test_user_db, ReferralCodeCache(test_redis), test_redis))
     created_user = await user_manager.create(UserCreate(**TestUser().model_dump()))
+    await get_test_user_db.session.commit()
     return created_user
 
 
+@pytest.fixture
+async def superuser(user, get_test_user_db):
+    updated_user = await get_test_user_db.update(user, {"is_superuser": True})
+    await get_test_user_db.session.commit()
+    return updated_user
+
+
 @pytest.fixture
 async def get_referral_user(get_test_user_db):
     return async_partial(create_user, get_test_user_db)
 
 
 async def create_user(get_test_user_db, referral_code=None):
-    user_manager = await anext(get_user_manager(get_test_user_db))
-    created_user = await user_manager.create(
-        UserCreate(**TestUserWithoutReferralCode().model_dump(), referral_code=referral_code)
-    )
+    user_manager = await anext(get_user_manager(get_test_user_db, ReferralCodeCache(test_redis), test_redis))
+    async with unit_of_work(get_test_user_db.session):
+        created_user = await user_manager.create(
+            UserCreate(**TestUserWithoutReferralCode().model_dump(), referral_code=referral_code)
+        )
     return created_user
 
 
@@ -130,4 +156,5 @@ async def referral_code(request, get_test_referral_program_repository: ReferralP
 
     referral_code: ReferralCode = ReferralCode(referrer_id=user.id, expired_at=fake.date_time_between(**kwargs))
     await get_test_referral_program_repository.create_referral_code(referral_code)
+    await get_test_referral_program_repository.session.commit()
     return referral_code
@@ -9,11 +9,63 @@ class Settings(BaseSettings):
     DB_HOST: str = "localhost"
     DB_PORT: int = 5438
     DB_NAME: str = "postgres"
+    DB_ECHO: bool = False
+    DB_POOL_SIZE: int = 20
+    DB_MAX_OVERFLOW: int = 10
+    DB_POOL_TIMEOUT: float = 5
+    DB_POOL_RECYCLE: int = 1800
+    DB_POOL_PRE_PING: bool = True
+    DB_STATEMENT_CACHE_SIZE: int = 500
+    N_PLUS_ONE_THRESHOLD: int = 5
+    SERVER_TIMING_ENABLED: bool = True
 
     REDIS_HOST: str = "localhost"
     REDIS_PORT: int = 6379
     REDIS_DB: int = 0
     TEST_REDIS_DB: int = 1
+    REDIS_MAX_CONNECTIONS: int = 50
+    REDIS_POOL_TIMEOUT_SECONDS: float = 1
+    REDIS_SOCKET_TIMEOUT_SECONDS: float = 1
+    REDIS_SOCKET_CONNECT_TIMEOUT_SECONDS: float = 1
+    REDIS_HEALTH_CHECK_INTERVAL_SECONDS: float = 30
+    REDIS_RETRIES: int = 2
+    REDIS_RETRY_BACKOFF_BASE_SECONDS: float = 0.05
+    REDIS_RETRY_BACKOFF_CAP_SECONDS: float = 0.5
+    REDIS_READINESS_TIMEOUT_SECONDS: float = 0.5
+    REDIS_READINESS_MAX_SATURATION: float = 0.9
+
+    RATE_LIMIT_ENABLED: bool = True
+    RATE_LIMIT_PERIOD_SECONDS: float = 60
+    RATE_LIMIT_LOGIN_PER_IP: int = 30
+    RATE_LIMIT_LOGIN_PER_EMAIL: int = 5
+    RATE_LIMIT_REGISTER_PER_IP: int = 10
+    RATE_LIMIT_REFERRAL_CODE_LOOKUP_PER_IP: int = 60
+
+    REFERRAL_CODE_CACHE_TTL_SECONDS: int = 300
+    REFERRALS_PAGE_SIZE: int = 100
+    REFERRALS_MAX_PAGE_SIZE: int = 1000
+    REFERRALS_STREAM_BATCH_SIZE: int = 1000
+    REFERRAL_CODES_BULK_MAX_COUNT: int = 50000
+    REFERRAL_CODES_BULK_BATCH_SIZE: int = 1000
+    REFERRAL_CODE_POOL_TARGET_SIZE: int = 10000
+    REFERRAL_CODE_POOL_LOW_WATER: int = 1000
+    REFERRAL_CODE_POOL_FILL_BATCH_SIZE: int = 1000
+    REFERRAL_CODE_POOL_FILL_INTERVAL_SECONDS: float = 10
+    REFERRAL_CODE_REJECTION_TTL_SECONDS: int = 60
+    REFERRAL_CODE_ISSUED_REBUILD_BATCH_SIZE: int = 10000
+    REFERRAL_CODE_ISSUED_REBUILD_LOCK_SECONDS: int = 600
+    REFERRAL_TREE_MAX_DEPTH: int = 10
+    REFERRAL_TREE_PAGE_SIZE: int = 100
+    REFERRAL_TREE_MAX_PAGE_SIZE: int = 1000
+    REFERRAL_TREE_FROM_CLOSURE_TABLE: bool = False
+    LEADERBOARD_PAGE_SIZE: int = 10
+    LEADERBOARD_MAX_PAGE_SIZE: int = 100
+    LEADERBOARD_REBUILD_BATCH_SIZE: int = 1000
+    LEADERBOARD_REBUILD_INTERVAL_SECONDS: float = 3600
+    REFERRAL_CODES_SWEEP_BATCH_SIZE: int = 1000
+    REFERRAL_CODES_SWEEP_PAUSE_SECONDS: float = 0.1
+    REFERRAL_CODES_SWEEP_INTERVAL_SECONDS: float = 300
+    REFERRAL_CODES_SWEEP_ARCHIVE: bool = False
 
     @property
     def REDIS_URL(self) -> str:
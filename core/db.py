@@ -1,13 +1,130 @@
-from typing import AsyncGenerator
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncGenerator, Awaitable, Callable, Optional
 
-from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from sqlalchemy import event, exc
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession, AsyncEngine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
 from core.config import settings
+from core.metrics import Counter, Gauge, Histogram
+from core.request_stats import current_request_stats
 
-engine = create_async_engine(url=settings.DATABASE_URL, echo=True)
-async_session_maker = async_sessionmaker(engine, expire_on_commit=False)
+
+class InstrumentedAsyncAdaptedQueuePool(AsyncAdaptedQueuePool):
+    """Queue pool reporting how long requests wait for a connection and how saturated the pool is."""
+
+    checkout_wait_seconds = Histogram(
+        "db_pool_checkout_wait_seconds",
+        "Time spent waiting for a database connection from the pool.",
+        buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0),
+    )
+    checkout_timeouts = Counter("db_pool_checkout_timeouts_total", "Pool checkouts failed by pool timeout.")
+
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            return super().connect()
+        except exc.TimeoutError:
+            self.checkout_timeouts.inc()
+            raise
+        finally:
+            self.checkout_wait_seconds.observe(time.perf_counter() - start)
+
+    def saturation(self) -> float:
+        return self.checkedout() / (self.size() + max(self._max_overflow, 0))
+
+
+db_query_duration_seconds = Histogram("db_query_duration_seconds", "Time spent executing SQL statements.")
+
+
+# Listening on the Engine class covers every engine, including the ones made by tests and benchmarks
+@event.listens_for(Engine, "before_cursor_execute")
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    context.query_started_at = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def record_query(conn, cursor, statement, parameters, context, executemany):
+    duration = time.perf_counter() - context.query_started_at
+    db_query_duration_seconds.observe(duration)
+    request_stats = current_request_stats.get()
+    if request_stats is not None:
+        request_stats.record_query(statement, duration)
+
+
+# Created on first use rather than on import, so importing the app doesn't load the database driver
+engine: Optional[AsyncEngine] = None
+async_session_maker: Optional[async_sessionmaker[AsyncSession]] = None
+
+
+def get_engine() -> AsyncEngine:
+    global engine, async_session_maker
+    if engine is None:
+        engine = create_async_engine(
+            url=settings.DATABASE_URL,
+            echo=settings.DB_ECHO,
+            poolclass=InstrumentedAsyncAdaptedQueuePool,
+            pool_size=settings.DB_POOL_SIZE,
+            max_overflow=settings.DB_MAX_OVERFLOW,
+            pool_timeout=settings.DB_POOL_TIMEOUT,
+            pool_recycle=settings.DB_POOL_RECYCLE,
+            pool_pre_ping=settings.DB_POOL_PRE_PING,
+            connect_args={"prepared_statement_cache_size": settings.DB_STATEMENT_CACHE_SIZE},
+        )
+        async_session_maker = async_sessionmaker(engine, expire_on_commit=False)
+    return engine
+
+
+async def dispose_engine() -> None:
+    global engine, async_session_maker
+    if engine is not None:
+        await engine.dispose()
+        engine = async_session_maker = None
+
+
+def get_pool_metric(name: str) -> Callable[[], float]:
+    return lambda: getattr(engine.pool, name)() if engine is not None else 0
+
+
+Gauge("db_pool_size", "Number of persistent connections of the pool.", function=get_pool_metric("size"))
+Gauge("db_pool_checked_out", "Number of connections currently checked out.", function=get_pool_metric("checkedout"))
+Gauge("db_pool_overflow", "Number of overflow connections currently opened.", function=get_pool_metric("overflow"))
+Gauge(
+    "db_pool_saturation", "Checked out connections to the pool capacity ratio.", function=get_pool_metric("saturation")
+)
+
+
+AFTER_COMMIT_CALLBACKS_KEY = "after_commit_callbacks"
+
+
+def add_after_commit_callback(session: AsyncSession, callback: Callable[[], Awaitable[None]]) -> None:
+    """Schedule side effect outside the database, e.g. cache invalidation, to run once the unit of work commits."""
+    session.info.setdefault(AFTER_COMMIT_CALLBACKS_KEY, []).append(callback)
+
+
+@asynccontextmanager
+async def unit_of_work(session: AsyncSession) -> AsyncGenerator[AsyncSession, None]:
+    """Commit everything done through the session at once, or roll it back if the block raises."""
+    try:
+        yield session
+    except Exception:
+        session.info.pop(AFTER_COMMIT_CALLBACKS_KEY, None)
+        await session.rollback()
+        raise
+
+    await session.commit()
+    for callback in session.info.pop(AFTER_COMMIT_CALLBACKS_KEY, []):
+        await callback()
 
 
 async def get_async_session() -> AsyncGenerator[AsyncSession, None]:
-    async with async_session_maker() as session:
+    """Request-scoped session shared by every dependency of the request and committed once at its end."""
+    async with get_async_session_maker()() as session, unit_of_work(session):
         yield session
+
+
+def get_async_session_maker() -> async_sessionmaker[AsyncSession]:
+    get_engine()
+    return async_session_maker
@@ -9,3 +9,5 @@ class ErrorDetails(str, enum.Enum):
     REFERRAL_CODE_ALREADY_USED = "Referral code was already used."
     INVALID_REFRESH_TOKEN = "Invalid refresh token. Please try login again."
     ACTIVE_REFERRAL_CODE_ALREADY_EXISTS = "Active referral code already exists"
+    PASSWORD_HASHING_OVERLOADED = "Too many login and registration attempts at once. Please try again later."
+    TOO_MANY_REQUESTS = "Too many requests. Please try again later."
@@ -0,0 +1,182 @@
+"""
+Minimal in-process metrics in the Prometheus text exposition format.
+
+Updates are plain attribute arithmetic on pre-created values, so instrumenting hot paths costs
+no more than a dict lookup; the exposition text is only built when /metrics is scraped.
+"""
+import math
+from typing import Callable, Iterable, Optional
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics: dict[str, "Metric"] = {}
+
+    def register(self, metric: "Metric") -> None:
+        if metric.name in self.metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self.metrics[metric.name] = metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+
+def escape_label_value(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labels: dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label_value(value)}"' for name, value in labels.items()) + "}"
+
+
+def format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+class CounterValue:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+
+class GaugeValue(CounterValue):
+    __slots__ = ()
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def dec(self, amount: float = 1) -> None:
+        self.value -= amount
+
+
+class HistogramValue:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.sum += value
+        self.count += 1
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+
+
+class Metric:
+    """
+    Metric family. Labelled values are created on first use of labels(...) and should be kept
+    by hot paths; metrics without labels proxy inc/set/observe to their single value.
+    A metric built with `function` has no values of its own and reports the function result when scraped.
+    """
+
+    type: str
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Iterable[str] = (),
+        function: Optional[Callable[[], float]] = None,
+        metrics_registry: MetricsRegistry = registry,
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.function = function
+        self.values: dict[tuple[str, ...], object] = {}
+        if not self.labelnames:
+            self.value = self.values[()] = self.create_value()
+        metrics_registry.register(self)
+
+    def create_value(self):
+        raise NotImplementedError
+
+    def labels(self, *values: str):
+        value = self.values.get(values)
+        if value is None:
+            value = self.values[values] = self.create_value()
+        return value
+
+    def samples(self) -> Iterable[tuple[str, dict[str, str], float]]:
+        if self.function is not None:
+            yield self.name, {}, self.function()
+            return
+        for label_values, value in self.values.items():
+            yield self.name, dict(zip(self.labelnames, label_values)), value.value
+
+    def render(self) -> Iterable[str]:
+        for name, labels, value in self.samples():
+            yield f"{name}{format_labels(labels)} {format_value(value)}"
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def create_value(self) -> CounterValue:
+        return CounterValue()
+
+    def inc(self, amount: float = 1) -> None:
+        self.value.inc(amount)
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def create_value(self) -> GaugeValue:
+        return GaugeValue()
+
+    def set(self, value: float) -> None:
+        self.value.set(value)
+
+    def inc(self, amount: float = 1) -> None:
+        self.value.inc(amount)
+
+    def dec(self, amount: float = 1) -> None:
+        self.value.dec(amount)
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, *args, buckets: Iterable[float] = DEFAULT_BUCKETS, **kwargs):
+        self.buckets = (*sorted(buckets), math.inf)
+        super().__init__(*args, **kwargs)
+
+    def create_value(self) -> HistogramValue:
+        return HistogramValue(self.buckets)
+
+    def observe(self, value: float) -> None:
+        self.value.observe(value)
+
+    def render(self) -> Iterable[str]:
+        for label_values, value in self.values.items():
+            labels = dict(zip(self.labelnames, label_values))
+            cumulative_count = 0
+            for bound, count in zip(value.buckets, value.counts):
+                cumulative_count += count
+                yield f"{self.name}_bucket{format_labels({**labels, 'le': format_value(bound)})} {cumulative_count}"
+            yield f"{self.name}_sum{format_labels(labels)} {format_value(value.sum)}"
+            yield f"{self.name}_count{format_labels(labels)} {value.count}"
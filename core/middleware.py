@@ -0,0 +1,102 @@
+import logging
+import time
+
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from core.config import settings
+from core.metrics import Counter, Gauge, Histogram
+from core.request_stats import RequestStats, current_request_stats
+
+logger = logging.getLogger(__name__)
+
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+request_duration_seconds = Histogram(
+    "http_request_duration_seconds",
+    "Time from receiving a request to sending the last byte of the response.",
+    labelnames=("route", "method", "status"),
+)
+requests_in_flight = Gauge("http_requests_in_flight", "Requests currently being handled.")
+
+request_db_queries = Histogram(
+    "http_request_db_queries", "SQL statements executed per request.", labelnames=("route",), buckets=COUNT_BUCKETS
+)
+request_db_seconds = Histogram("http_request_db_seconds", "Time spent in SQL per request.", labelnames=("route",))
+request_redis_commands = Histogram(
+    "http_request_redis_commands", "Redis commands executed per request.", labelnames=("route",), buckets=COUNT_BUCKETS
+)
+request_redis_seconds = Histogram(
+    "http_request_redis_seconds", "Time spent in Redis per request.", labelnames=("route",)
+)
+request_n_plus_one = Counter(
+    "http_request_n_plus_one_total",
+    "Requests executing the same SQL statement N_PLUS_ONE_THRESHOLD times or more.",
+    labelnames=("route",),
+)
+
+
+def format_server_timing(request_stats: RequestStats, total_seconds: float) -> str:
+    return ", ".join(
+        (
+            f'db;dur={request_stats.db_seconds * 1000:.2f};desc="{request_stats.db_queries} queries"',
+            f'redis;dur={request_stats.redis_seconds * 1000:.2f};desc="{request_stats.redis_commands} commands"',
+            f"total;dur={total_seconds * 1000:.2f}",
+        )
+    )
+
+
+class RequestStatsMiddleware:
+    """
+    Measures every request: its latency and SQL and Redis work are reported in metrics by route name,
+    and the work done before the headers are sent also in the Server-Timing header.
+    Requests repeating a statement are logged, as it usually means an N+1 query pattern.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_stats = RequestStats()
+        token = current_request_stats.set(request_stats)
+        status_code = 500
+        start = time.perf_counter()
+        requests_in_flight.inc()
+
+        async def send_with_server_timing(message: Message) -> None:
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                if settings.SERVER_TIMING_ENABLED:
+                    headers = MutableHeaders(scope=message)
+                    headers.append("Server-Timing", format_server_timing(request_stats, time.perf_counter() - start))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_server_timing)
+        finally:
+            requests_in_flight.dec()
+            current_request_stats.reset(token)
+            self.record(scope, status_code, time.perf_counter() - start, request_stats)
+
+    def record(self, scope: Scope, status_code: int, duration: float, request_stats: RequestStats) -> None:
+        route = scope.get("route")
+        route_name = route.name if route is not None else "unmatched"
+
+        request_duration_seconds.labels(route_name, scope["method"], str(status_code)).observe(duration)
+        request_db_queries.labels(route_name).observe(request_stats.db_queries)
+        request_db_seconds.labels(route_name).observe(request_stats.db_seconds)
+        request_redis_commands.labels(route_name).observe(request_stats.redis_commands)
+        request_redis_seconds.labels(route_name).observe(request_stats.redis_seconds)
+
+        repeated_statements = request_stats.repeated_statements()
+        if repeated_statements:
+            request_n_plus_one.labels(route_name).inc()
+            for statement, count in repeated_statements:
+                logger.warning(
+                    "Possible N+1 query on %s %s: executed %d times: %s", scope["method"], route_name, count, statement
+                )
@@ -0,0 +1,120 @@
+import time
+from dataclasses import dataclass
+from typing import Annotated, Optional
+
+import aioredis
+from aioredis.client import Script
+from fastapi import Depends, HTTPException, Request, status
+
+from core.config import settings
+from core.enums import ErrorDetails
+from core.metrics import Counter
+from core.redis import get_redis
+
+# Token buckets stored as hashes of the tokens left and the time they were counted at.
+# KEYS are the buckets, ARGV[1] is the current time, followed by the capacity and refill period of every bucket.
+# Tokens are taken from all buckets or from none, returns the number of the first exhausted bucket
+# and the seconds until it has a token again, or 0.
+TOKEN_BUCKET_SCRIPT = """
+local now = tonumber(ARGV[1])
+local tokens = {}
+for index, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[index * 2])
+    local period = tonumber(ARGV[index * 2 + 1])
+    local bucket = redis.call('HMGET', key, 'tokens', 'updated_at')
+    local available = capacity
+    if bucket[1] then
+        available = math.min(capacity, tonumber(bucket[1]) + (now - tonumber(bucket[2])) * capacity / period)
+    end
+    if available < 1 then
+        return {index, tostring((1 - available) * period / capacity)}
+    end
+    tokens[index] = available
+end
+for index, key in ipairs(KEYS) do
+    redis.call('HSET', key, 'tokens', tostring(tokens[index] - 1), 'updated_at', ARGV[1])
+    redis.call('PEXPIRE', key, math.ceil(tonumber(ARGV[index * 2 + 1]) * 1000))
+end
+return {0, '0'}
+"""
+
+rate_limit_checks = Counter(
+    "rate_limit_checks_total", "Requests checked against rate limits, by limiter.", labelnames=("limiter",)
+)
+rate_limited_requests = Counter(
+    "rate_limited_requests_total",
+    "Requests rejected by rate limits, by limiter and the scope of the exhausted limit.",
+    labelnames=("limiter", "scope"),
+)
+
+
+@dataclass(frozen=True)
+class RateLimit:
+    """`requests` per `period_seconds` for every client ip or email, bursts of up to `requests` are allowed."""
+
+    scope: str
+    requests: int
+    period_seconds: float
+
+
+async def get_request_email(request: Request) -> Optional[str]:
+    """Email from the query, the login form or the JSON body, read without validating the request."""
+    email = request.query_params.get("email")
+    content_type = request.headers.get("content-type", "")
+    if email is None and content_type.startswith(("application/x-www-form-urlencoded", "multipart/form-data")):
+        email = (await request.form()).get("username")
+    elif email is None and content_type.startswith("application/json"):
+        try:
+            body = await request.json()
+        except ValueError:
+            return None
+        email = body.get("email") if isinstance(body, dict) else None
+    return email.strip().lower() if isinstance(email, str) and email else None
+
+
+class RateLimiter:
+    """
+    Route dependency checking the token buckets of the client ip and email in a single Lua call.
+    Should be listed in the route dependencies, so it's resolved before the database ones.
+    """
+
+    KEY_PREFIX = "rate_limit"
+
+    def __init__(self, name: str, *limits: RateLimit):
+        self.name = name
+        self.limits = limits
+        # Limiters are made on import, before there's a client to register the script with, so it's run with
+        # the client of the request. Encoded beforehand, as the digest would take the encoder of the client.
+        self.token_bucket_script = Script(None, TOKEN_BUCKET_SCRIPT.encode())
+
+    async def get_identifier(self, request: Request, scope: str) -> Optional[str]:
+        if scope == "ip":
+            return request.client.host if request.client else None
+        if scope == "email":
+            return await get_request_email(request)
+        raise ValueError(f"Unknown rate limit scope {scope}")
+
+    async def __call__(self, request: Request, redis: Annotated[aioredis.Redis, Depends(get_redis)]) -> None:
+        if not settings.RATE_LIMIT_ENABLED:
+            return
+
+        limits, keys, args = [], [], [time.time()]
+        for limit in self.limits:
+            identifier = await self.get_identifier(request, limit.scope)
+            if identifier is None:
+                continue
+            limits.append(limit)
+            keys.append(f"{self.KEY_PREFIX}:{self.name}:{limit.scope}:{identifier}")
+            args.extend((limit.requests, limit.period_seconds))
+        if not keys:
+            return
+
+        rate_limit_checks.labels(self.name).inc()
+        exhausted_limit_number, retry_after = await self.token_bucket_script(keys=keys, args=args, client=redis)
+        if exhausted_limit_number:
+            rate_limited_requests.labels(self.name, limits[exhausted_limit_number - 1].scope).inc()
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail=ErrorDetails.TOO_MANY_REQUESTS,
+                headers={"Retry-After": str(max(1, round(float(retry_after) + 0.5)))},
+            )
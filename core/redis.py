@@ -1,5 +1,221 @@
+import asyncio
+import random
+import time
+from typing import Callable, Optional
+
 import aioredis
+from aioredis.client import Pipeline
+from aioredis.connection import BlockingConnectionPool
+from aioredis.exceptions import ConnectionError, TimeoutError
 
 from core.config import settings
+from core.metrics import Counter, Gauge, Histogram
+from core.request_stats import current_request_stats
+
+redis_command_duration_seconds = Histogram(
+    "redis_command_duration_seconds", "Time spent executing Redis commands and pipelines.", labelnames=("command",)
+)
+
+
+def record_redis_commands(command: str, commands_count: int, duration: float) -> None:
+    redis_command_duration_seconds.labels(command).observe(duration)
+    request_stats = current_request_stats.get()
+    if request_stats is not None:
+        request_stats.record_redis_commands(commands_count, duration)
+
+
+class PoolExhaustedError(ConnectionError):
+    """No connection of the pool got free within the pool timeout."""
+
+
+class ConnectionNotEstablishedError(ConnectionError):
+    """Connection of the pool failed to open or to get ready, so the command wasn't sent."""
+
+
+class InstrumentedBlockingConnectionPool(BlockingConnectionPool):
+    """
+    Pool of at most `max_connections` connections, where a command waits up to `timeout` seconds
+    for a free one, reporting the wait and how saturated the pool is.
+    """
+
+    checkout_wait_seconds = Histogram(
+        "redis_pool_checkout_wait_seconds",
+        "Time spent waiting for a Redis connection from the pool.",
+        buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0),
+    )
+    checkout_timeouts = Counter(
+        "redis_pool_checkout_timeouts_total", "Redis commands failed because no connection got free in time."
+    )
+
+    async def get_connection(self, command_name, *keys, **options):
+        start = time.perf_counter()
+        try:
+            return await super().get_connection(command_name, *keys, **options)
+        except ConnectionError as error:
+            # The only way BlockingConnectionPool tells that it ran out of connections
+            if str(error) == "No connection available.":
+                self.checkout_timeouts.inc()
+                raise PoolExhaustedError(str(error)) from error
+            raise ConnectionNotEstablishedError(str(error)) from error
+        except TimeoutError as error:
+            raise ConnectionNotEstablishedError(str(error)) from error
+        finally:
+            self.checkout_wait_seconds.observe(time.perf_counter() - start)
+
+    def size(self) -> int:
+        return self.max_connections
+
+    def created(self) -> int:
+        return len(self._connections)
+
+    def checkedout(self) -> int:
+        # The queue holds idle connections and placeholders of the ones not opened yet
+        return self.max_connections - self.pool.qsize()
+
+    def saturation(self) -> float:
+        return self.checkedout() / self.max_connections
+
+
+class InstrumentedPipeline(Pipeline):
+    async def execute(self, raise_on_error: bool = True):
+        commands_count = len(self.command_stack)
+        start = time.perf_counter()
+        try:
+            return await super().execute(raise_on_error)
+        finally:
+            record_redis_commands("PIPELINE", commands_count, time.perf_counter() - start)
+
+
+redis_command_retries = Counter(
+    "redis_command_retries_total", "Redis commands retried after a connection error or timeout."
+)
+
+# Commands which may run twice, as they don't change anything.
+# Others may have been executed by the server when the connection broke or the reply timed out.
+IDEMPOTENT_COMMANDS = frozenset(
+    {
+        "PING",
+        "GET",
+        "MGET",
+        "EXISTS",
+        "TTL",
+        "PTTL",
+        "SCARD",
+        "SISMEMBER",
+        "SMEMBERS",
+        "LLEN",
+        "LRANGE",
+        "ZCARD",
+        "ZSCORE",
+        "ZRANK",
+        "ZREVRANK",
+        "ZRANGE",
+        "ZREVRANGE",
+        "HGET",
+        "HGETALL",
+        "HMGET",
+        "SCRIPT",
+    }
+)
+
+
+class InstrumentedRedis(aioredis.Redis):
+    """
+    Redis client reporting command latency to metrics and to the stats of the request in flight.
+
+    Commands failed to get a connection, and idempotent ones failed with a connection error or timeout,
+    are retried up to `retries` times after an exponential backoff with full jitter.
+    Exhausted pool isn't retried, the command has waited already.
+    """
+
+    def __init__(
+        self,
+        *args,
+        retries: int = 0,
+        retry_backoff_base_seconds: float = 0.05,
+        retry_backoff_cap_seconds: float = 0.5,
+        **kwargs,
+    ):
+        super().__init__(*args, **kwargs)
+        self.retries = retries
+        self.retry_backoff_base_seconds = retry_backoff_base_seconds
+        self.retry_backoff_cap_seconds = retry_backoff_cap_seconds
+
+    def get_retry_backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.retry_backoff_cap_seconds, self.retry_backoff_base_seconds * 2**attempt))
+
+    @staticmethod
+    def is_retryable(command: str, error: Exception) -> bool:
+        if isinstance(error, PoolExhaustedError):
+            return False
+        return isinstance(error, ConnectionNotEstablishedError) or command in IDEMPOTENT_COMMANDS
+
+    async def execute_command(self, *args, **options):
+        command = str(args[0]).upper()
+        start = time.perf_counter()
+        try:
+            for attempt in range(self.retries + 1):
+                try:
+                    return await super().execute_command(*args, **options)
+                except (ConnectionError, TimeoutError) as error:
+                    if attempt == self.retries or not self.is_retryable(command, error):
+                        raise
+                redis_command_retries.inc()
+                await asyncio.sleep(self.get_retry_backoff(attempt))
+        finally:
+            record_redis_commands(command, 1, time.perf_counter() - start)
+
+    def pipeline(self, transaction: bool = True, shard_hint=None) -> InstrumentedPipeline:
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+def create_redis(url: str = settings.REDIS_URL) -> InstrumentedRedis:
+    connection_pool = InstrumentedBlockingConnectionPool.from_url(
+        url,
+        max_connections=settings.REDIS_MAX_CONNECTIONS,
+        timeout=settings.REDIS_POOL_TIMEOUT_SECONDS,
+        socket_timeout=settings.REDIS_SOCKET_TIMEOUT_SECONDS,
+        socket_connect_timeout=settings.REDIS_SOCKET_CONNECT_TIMEOUT_SECONDS,
+        socket_keepalive=True,
+        health_check_interval=settings.REDIS_HEALTH_CHECK_INTERVAL_SECONDS,
+    )
+    return InstrumentedRedis(
+        connection_pool=connection_pool,
+        retries=settings.REDIS_RETRIES,
+        retry_backoff_base_seconds=settings.REDIS_RETRY_BACKOFF_BASE_SECONDS,
+        retry_backoff_cap_seconds=settings.REDIS_RETRY_BACKOFF_CAP_SECONDS,
+    )
+
+
+# Created on first use, and closed with the app
+redis: Optional[InstrumentedRedis] = None
+
+
+def get_redis() -> aioredis.Redis:
+    global redis
+    if redis is None:
+        redis = create_redis()
+    return redis
+
+
+async def close_redis() -> None:
+    global redis
+    if redis is not None:
+        await redis.close()
+        # Pools passed to the client aren't closed with it
+        await redis.connection_pool.disconnect()
+        redis = None
+
+
+def get_pool_metric(name: str) -> Callable[[], float]:
+    return lambda: getattr(redis.connection_pool, name)() if redis is not None else 0
+
 
-redis = aioredis.from_url(settings.REDIS_URL)
+Gauge("redis_pool_size", "Maximum number of connections of the Redis pool.", function=get_pool_metric("size"))
+Gauge("redis_pool_created", "Number of connections opened by the Redis pool.", function=get_pool_metric("created"))
+Gauge("redis_pool_checked_out", "Number of Redis connections currently in use.", function=get_pool_metric("checkedout"))
+Gauge(
+    "redis_pool_saturation",
+    "Checked out Redis connections to the pool capacity ratio.",
+    function=get_pool_metric("saturation"),
+)
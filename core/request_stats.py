@@ -0,0 +1,39 @@
+"""
+Database and Redis work done while handling a request.
+
+The stats object of the request in flight lives in a context variable set by RequestStatsMiddleware,
+so the engine and Redis client hooks can add to it without having the request at hand.
+"""
+import contextvars
+from collections import Counter as StatementCounter
+from dataclasses import dataclass, field
+from typing import Optional
+
+from core.config import settings
+
+
+@dataclass
+class RequestStats:
+    db_queries: int = 0
+    db_seconds: float = 0.0
+    redis_commands: int = 0
+    redis_seconds: float = 0.0
+    statements: StatementCounter = field(default_factory=StatementCounter)
+
+    def record_query(self, statement: str, duration: float) -> None:
+        self.db_queries += 1
+        self.db_seconds += duration
+        self.statements[statement] += 1
+
+    def record_redis_commands(self, commands_count: int, duration: float) -> None:
+        self.redis_commands += commands_count
+        self.redis_seconds += duration
+
+    def repeated_statements(self, threshold: int = settings.N_PLUS_ONE_THRESHOLD) -> list[tuple[str, int]]:
+        """Statements executed at least `threshold` times, likely issued in a loop over results of another one."""
+        return [(statement, count) for statement, count in self.statements.items() if count >= threshold]
+
+
+current_request_stats: contextvars.ContextVar[Optional[RequestStats]] = contextvars.ContextVar(
+    "current_request_stats", default=None
+)
@@ -0,0 +1,124 @@
+import pytest
+from aioredis.exceptions import ConnectionError, TimeoutError
+from httpx import AsyncClient, Response
+from starlette import status
+
+from conftest import TEST_REDIS_URL
+from core.config import settings
+from core.metrics import Histogram, MetricsRegistry
+from core.redis import create_redis, redis_command_retries
+from core.request_stats import RequestStats
+
+
+class TestMetrics:
+    async def test_get_metrics(self, auth_client: AsyncClient):
+        response: Response = await auth_client.get("/metrics")
+
+        assert response.status_code == status.HTTP_200_OK
+        assert "# TYPE db_pool_checkout_wait_seconds histogram" in response.text
+        assert "db_pool_saturation 0.0" in response.text
+        assert "http_requests_in_flight 1.0" in response.text
+
+    async def test_server_timing(self, auth_client: AsyncClient, monkeypatch):
+        # Rate limit script may be loaded on first use, which would change the number of commands
+        monkeypatch.setattr(settings, "RATE_LIMIT_ENABLED", False)
+        response: Response = await auth_client.get("/referral_code/", params={"email": "user@example.com"})
+        metrics_response: Response = await auth_client.get("/metrics")
+
+        assert "db;dur=" in response.headers["Server-Timing"]
+        assert 'desc="1 queries"' in response.headers["Server-Timing"]
+        assert 'desc="2 commands"' in response.headers["Server-Timing"]
+        assert 'http_request_db_queries_count{route="get_referral_code_by_email"}' in metrics_response.text
+        assert (
+            'http_request_duration_seconds_count{route="get_referral_code_by_email",method="GET",status="200"}'
+            in metrics_response.text
+        )
+
+    def test_repeated_statements(self):
+        request_stats = RequestStats()
+        for _ in range(5):
+            request_stats.record_query("SELECT referral_code.code FROM referral_code WHERE referral_code.id = ?", 0.001)
+        request_stats.record_query("SELECT user.id FROM user", 0.001)
+
+        assert request_stats.repeated_statements(threshold=5) == [
+            ("SELECT referral_code.code FROM referral_code WHERE referral_code.id = ?", 5)
+        ]
+
+    def test_render_histogram(self):
+        metrics_registry = MetricsRegistry()
+        histogram = Histogram(
+            "latency_seconds", "Latency.", labelnames=("route",), buckets=(0.1, 1), metrics_registry=metrics_registry
+        )
+        histogram.labels("login").observe(0.05)
+        histogram.labels("login").observe(0.5)
+
+        assert metrics_registry.render().splitlines()[2:] == [
+            'latency_seconds_bucket{route="login",le="0.1"} 1',
+            'latency_seconds_bucket{route="login",le="1.0"} 2',
+            'latency_seconds_bucket{route="login",le="+Inf"} 2',
+            'latency_seconds_sum{route="login"} 0.55',
+            'latency_seconds_count{route="login"} 2',
+        ]
+
+
+class TestRedis:
+    async def test_ready(self, auth_client: AsyncClient):
+        response: Response = await auth_client.get("/health/ready")
+
+        assert response.status_code == status.HTTP_200_OK
+        assert response.json() == {"redis": "ok"}
+
+    async def test_not_ready_when_pool_saturated(self, auth_client: AsyncClient, monkeypatch):
+        monkeypatch.setattr(settings, "REDIS_READINESS_MAX_SATURATION", 0)
+        response: Response = await auth_client.get("/health/ready")
+
+        assert response.status_code == status.HTTP_503_SERVICE_UNAVAILABLE
+        assert response.json() == {"redis": "pool saturated"}
+
+    async def test_retry_command_after_connection_error(self, monkeypatch):
+        redis = create_redis(TEST_REDIS_URL)
+        connect = redis.connection_pool.connection_class.connect
+        failures = iter([ConnectionError("Connection reset by peer")])
+
+        async def flaky_connect(connection):
+            error = next(failures, None)
+            if error is not None:
+                raise error
+            await connect(connection)
+
+        monkeypatch.setattr(redis.connection_pool.connection_class, "connect", flaky_connect)
+        retries = redis_command_retries.value.value
+        try:
+            assert await redis.ping()
+        finally:
+            await redis.close()
+            await redis.connection_pool.disconnect()
+
+        assert redis_command_retries.value.value == retries + 1
+
+    async def test_dont_retry_non_idempotent_command_after_timeout(self, monkeypatch):
+        redis = create_redis(TEST_REDIS_URL)
+        read_response = redis.connection_pool.connection_class.read_response
+        failures = iter([TimeoutError("Timeout reading from socket")])
+
+        async def slow_read_response(connection):
+            response = await read_response(connection)
+            error = next(failures, None)
+            if error is not None:
+                raise error
+            return response
+
+        await redis.delete("counter")
+        monkeypatch.setattr(redis.connection_pool.connection_class, "read_response", slow_read_response)
+        retries = redis_command_retries.value.value
+        try:
+            with pytest.raises(TimeoutError):
+                await redis.incr("counter")
+            counter = await redis.get("counter")
+        finally:
+            await redis.delete("counter")
+            await redis.close()
+            await redis.connection_pool.disconnect()
+
+        assert counter == b"1"
+        assert redis_command_retries.value.value == retries
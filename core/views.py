@@ -0,0 +1,39 @@
+import asyncio
+from typing import Annotated
+
+import aioredis
+from fastapi import APIRouter, Depends, status
+from fastapi.responses import PlainTextResponse, JSONResponse
+
+from core.config import settings
+from core.metrics import registry
+from core.redis import get_redis
+
+router = APIRouter(tags=["metrics"])
+
+
+@router.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+async def get_metrics():
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+
+async def check_redis(redis: aioredis.Redis) -> str:
+    pool = redis.connection_pool
+    if hasattr(pool, "saturation") and pool.saturation() >= settings.REDIS_READINESS_MAX_SATURATION:
+        return "pool saturated"
+    try:
+        # Bounded as a whole, so retries of a degraded Redis don't hold the probe
+        await asyncio.wait_for(redis.ping(), timeout=settings.REDIS_READINESS_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        return "timeout"
+    except aioredis.RedisError as error:
+        return type(error).__name__
+    return "ok"
+
+
+@router.get("/health/ready", include_in_schema=False)
+async def get_readiness(redis: Annotated[aioredis.Redis, Depends(get_redis)]):
+    """Whether the worker can serve requests, fails fast when Redis is down or its pool is exhausted."""
+    checks = {"redis": await check_redis(redis)}
+    ready = all(result == "ok" for result in checks.values())
+    return JSONResponse(checks, status_code=status.HTTP_200_OK if ready else status.HTTP_503_SERVICE_UNAVAILABLE)
@@ -1,23 +1,59 @@
-from fastapi import FastAPI
+import asyncio
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
 
-from auth.backend import auth_backend
-from auth.fastapi_users import fastapi_users
-from auth.schema import UserRead, UserCreate
-from core.redis import redis
-from referral_program.views import router
+from fastapi import FastAPI, Depends
 
-app = FastAPI(title="Referral system")
+from auth.password import password_hashing_pool
+from auth.principal import listen_for_principal_invalidations
+from core.db import get_async_session_maker, dispose_engine
+from core.middleware import RequestStatsMiddleware
+from core.redis import get_redis, close_redis
+from referral_program.issued_codes import rebuild_issued_referral_codes
 
 
-@app.on_event("shutdown")
-async def shutdown_event():
-    await redis.close()
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    """Open the database engine and Redis client for the worker, and close them on shutdown."""
+    redis = get_redis()
+    session_maker = get_async_session_maker()
+    background_tasks = [
+        # Signups check codes in the database until the set is built, so the startup doesn't wait for it
+        asyncio.create_task(rebuild_issued_referral_codes(redis, session_maker)),
+        asyncio.create_task(listen_for_principal_invalidations(redis)),
+    ]
+    try:
+        yield
+    finally:
+        for task in background_tasks:
+            task.cancel()
+        await asyncio.gather(*background_tasks, return_exceptions=True)
+        await close_redis()
+        await dispose_engine()
+        password_hashing_pool.shutdown()
 
 
-app.include_router(router)
-app.include_router(
-    fastapi_users.get_register_router(UserRead, UserCreate),
-    prefix="/auth",
-    tags=["auth"],
-)
-app.include_router(fastapi_users.get_auth_router(auth_backend), prefix="/auth", tags=["auth"])
+def create_app() -> FastAPI:
+    """App factory, served with `uvicorn --factory main:create_app`."""
+    # Views are imported here, so their routes are built with the app rather than on import of main
+    from auth.backend import auth_backend
+    from auth.fastapi_users import fastapi_users
+    from auth.schema import UserRead, UserCreate
+    from auth.views import register_rate_limiter
+    from core.views import router as metrics_router
+    from referral_program.views import router, leaderboard_router
+
+    app = FastAPI(title="Referral system", lifespan=lifespan)
+    app.add_middleware(RequestStatsMiddleware)
+
+    app.include_router(metrics_router)
+    app.include_router(router)
+    app.include_router(leaderboard_router)
+    app.include_router(
+        fastapi_users.get_register_router(UserRead, UserCreate),
+        prefix="/auth",
+        tags=["auth"],
+        dependencies=[Depends(register_rate_limiter)],
+    )
+    app.include_router(fastapi_users.get_auth_router(auth_backend), prefix="/auth", tags=["auth"])
+    return app
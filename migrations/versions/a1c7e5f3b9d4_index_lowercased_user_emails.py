@@ -0,0 +1,31 @@
+"""+ Index lowercased user emails
+
+Revision ID: a1c7e5f3b9d4
+Revises: d8c4a2f6e9b1
+Create Date: 2026-10-18 23:41:09.215736
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "a1c7e5f3b9d4"
+down_revision: Union[str, None] = "d8c4a2f6e9b1"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Referral code lookups compare lower(email), as do fastapi-users ones
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_user_email_lower", "user", [sa.text("lower(email)")], unique=False, postgresql_concurrently=True
+        )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index("ix_user_email_lower", table_name="user", postgresql_concurrently=True)
@@ -0,0 +1,46 @@
+"""+ Referrer stats
+
+Revision ID: a5d9e3f7c2b4
+Revises: f4b8c2e6a1d9
+Create Date: 2026-10-18 17:34:12.604519
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "a5d9e3f7c2b4"
+down_revision: Union[str, None] = "f4b8c2e6a1d9"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "referrer_stats",
+        sa.Column("referrer_id", sa.Integer(), nullable=False),
+        sa.Column("referrals_count", sa.Integer(), nullable=False),
+        sa.Column("active_codes_count", sa.Integer(), nullable=False),
+        sa.Column("last_referral_at", sa.TIMESTAMP(), nullable=True),
+        sa.ForeignKeyConstraint(["referrer_id"], ["user.id"], ondelete="CASCADE"),
+        sa.PrimaryKeyConstraint("referrer_id"),
+    )
+    op.execute(
+        """
+        INSERT INTO referrer_stats (referrer_id, referrals_count, active_codes_count, last_referral_at)
+        SELECT referrer_id,
+               count(*) FILTER (WHERE used_at IS NOT NULL),
+               count(*) FILTER (WHERE used_at IS NULL AND expired_at >= now() AT TIME ZONE 'utc'),
+               max(used_at)
+        FROM referral_code
+        WHERE referrer_id IS NOT NULL
+        GROUP BY referrer_id
+        """
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("referrer_stats")
@@ -0,0 +1,47 @@
+"""+ Referral code archive
+
+Revision ID: b6e1f8a3d5c7
+Revises: a5d9e3f7c2b4
+Create Date: 2026-10-18 19:12:40.287316
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "b6e1f8a3d5c7"
+down_revision: Union[str, None] = "a5d9e3f7c2b4"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "referral_code_archive",
+        sa.Column("id", sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column("referrer_id", sa.Integer(), nullable=True),
+        sa.Column("code", sa.String(length=16), nullable=False),
+        sa.Column("created_at", sa.TIMESTAMP(), nullable=False),
+        sa.Column("expired_at", sa.TIMESTAMP(), nullable=True),
+        sa.Column("archived_at", sa.TIMESTAMP(), nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    # Lets the sweeper find expired unused codes without scanning the whole table
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_referral_code_unused_expired_at",
+            "referral_code",
+            ["expired_at"],
+            unique=False,
+            postgresql_where=sa.text("used_at IS NULL"),
+            postgresql_concurrently=True,
+        )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index("ix_referral_code_unused_expired_at", table_name="referral_code", postgresql_concurrently=True)
+    op.drop_table("referral_code_archive")
@@ -0,0 +1,47 @@
+"""+ Indexes for referral queries
+
+Revision ID: c3f1a9e5b8d2
+Revises: 9b1e6c2d4a7f
+Create Date: 2026-10-18 13:02:17.904611
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "c3f1a9e5b8d2"
+down_revision: Union[str, None] = "9b1e6c2d4a7f"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Built concurrently so that registrations and code lookups are not blocked on large tables
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_referral_code_referrer_id_expired_at",
+            "referral_code",
+            ["referrer_id", "expired_at"],
+            unique=False,
+            postgresql_concurrently=True,
+        )
+        op.create_index(
+            "ix_referral_code_referrer_id_created_at",
+            "referral_code",
+            ["referrer_id", sa.text("created_at DESC")],
+            unique=False,
+            postgresql_concurrently=True,
+        )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index(
+            "ix_referral_code_referrer_id_created_at", table_name="referral_code", postgresql_concurrently=True
+        )
+        op.drop_index(
+            "ix_referral_code_referrer_id_expired_at", table_name="referral_code", postgresql_concurrently=True
+        )
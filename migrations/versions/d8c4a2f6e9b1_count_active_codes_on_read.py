@@ -0,0 +1,39 @@
+"""+ Count active referral codes on read
+
+Revision ID: d8c4a2f6e9b1
+Revises: b6e1f8a3d5c7
+Create Date: 2026-10-18 21:05:18.730142
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "d8c4a2f6e9b1"
+down_revision: Union[str, None] = "b6e1f8a3d5c7"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Codes expire without a write, so the stored count went stale until the sweeper ran.
+    # Active codes are counted with ix_referral_code_active instead.
+    op.drop_column("referrer_stats", "active_codes_count")
+
+
+def downgrade() -> None:
+    op.add_column("referrer_stats", sa.Column("active_codes_count", sa.Integer(), nullable=False, server_default="0"))
+    op.execute(
+        """
+        INSERT INTO referrer_stats (referrer_id, referrals_count, active_codes_count)
+        SELECT referrer_id, 0, count(*)
+        FROM referral_code
+        WHERE referrer_id IS NOT NULL AND used_at IS NULL AND expired_at >= now() AT TIME ZONE 'utc'
+        GROUP BY referrer_id
+        ON CONFLICT (referrer_id) DO UPDATE SET active_codes_count = excluded.active_codes_count
+        """
+    )
+    op.alter_column("referrer_stats", "active_codes_count", server_default=None)
@@ -0,0 +1,84 @@
+"""+ Used state of referral codes
+
+Revision ID: e7a2d4c91f35
+Revises: c3f1a9e5b8d2
+Create Date: 2026-10-18 14:21:05.371942
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "e7a2d4c91f35"
+down_revision: Union[str, None] = "c3f1a9e5b8d2"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+BACKFILL_BATCH_SIZE = 10000
+
+
+def upgrade() -> None:
+    op.add_column("referral_code", sa.Column("used_at", sa.TIMESTAMP(), nullable=True))
+    op.add_column("referral_code", sa.Column("used_by_id", sa.Integer(), nullable=True))
+    op.create_foreign_key(
+        "referral_code_used_by_id_fkey", "referral_code", "user", ["used_by_id"], ["id"], ondelete="SET NULL"
+    )
+    # Committed batch by batch and built concurrently, so registrations and code lookups are not blocked on large tables
+    with op.get_context().autocommit_block():
+        # Registration time of referrals isn't stored anywhere, creation time of the code is the closest one known.
+        # It keeps old referrals out of the recent leaderboards instead of dating all of them by the migration.
+        backfill_batch_query = sa.text(
+            """
+            UPDATE referral_code
+            SET used_at = referral_code.created_at, used_by_id = "user".id
+            FROM "user"
+            WHERE "user".referrer_id = referral_code.id
+              AND referral_code.id IN (
+                  SELECT referral_code.id
+                  FROM referral_code
+                  JOIN "user" ON "user".referrer_id = referral_code.id
+                  WHERE referral_code.used_by_id IS NULL
+                  LIMIT :batch_size
+              )
+            """
+        )
+        while op.get_bind().execute(backfill_batch_query, {"batch_size": BACKFILL_BATCH_SIZE}).rowcount:
+            pass
+        op.create_index(
+            op.f("ix_referral_code_used_by_id"),
+            "referral_code",
+            ["used_by_id"],
+            unique=False,
+            postgresql_concurrently=True,
+        )
+        op.create_index(
+            "ix_referral_code_active",
+            "referral_code",
+            ["referrer_id", "expired_at"],
+            unique=False,
+            postgresql_where=sa.text("used_at IS NULL"),
+            postgresql_concurrently=True,
+        )
+        op.drop_index(
+            "ix_referral_code_referrer_id_expired_at", table_name="referral_code", postgresql_concurrently=True
+        )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_referral_code_referrer_id_expired_at",
+            "referral_code",
+            ["referrer_id", "expired_at"],
+            unique=False,
+            postgresql_concurrently=True,
+        )
+        op.drop_index("ix_referral_code_active", table_name="referral_code", postgresql_concurrently=True)
+        op.drop_index(op.f("ix_referral_code_used_by_id"), table_name="referral_code", postgresql_concurrently=True)
+    op.drop_constraint("referral_code_used_by_id_fkey", "referral_code", type_="foreignkey")
+    op.drop_column("referral_code", "used_by_id")
+    op.drop_column("referral_code", "used_at")
@@ -0,0 +1,54 @@
+"""+ Referral closure table
+
+Revision ID: f4b8c2e6a1d9
+Revises: e7a2d4c91f35
+Create Date: 2026-10-18 16:02:47.118204
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "f4b8c2e6a1d9"
+down_revision: Union[str, None] = "e7a2d4c91f35"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "referral_closure",
+        sa.Column("ancestor_id", sa.Integer(), nullable=False),
+        sa.Column("descendant_id", sa.Integer(), nullable=False),
+        sa.Column("depth", sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(["ancestor_id"], ["user.id"], ondelete="CASCADE"),
+        sa.ForeignKeyConstraint(["descendant_id"], ["user.id"], ondelete="CASCADE"),
+        sa.PrimaryKeyConstraint("ancestor_id", "descendant_id"),
+    )
+    op.execute(
+        """
+        INSERT INTO referral_closure (ancestor_id, descendant_id, depth)
+        WITH RECURSIVE referral_tree (ancestor_id, descendant_id, depth) AS (
+            SELECT referral_code.referrer_id, "user".id, 1
+            FROM "user" JOIN referral_code ON "user".referrer_id = referral_code.id
+            WHERE referral_code.referrer_id IS NOT NULL
+            UNION ALL
+            SELECT referral_tree.ancestor_id, "user".id, referral_tree.depth + 1
+            FROM referral_tree
+            JOIN referral_code ON referral_code.referrer_id = referral_tree.descendant_id
+            JOIN "user" ON "user".referrer_id = referral_code.id
+        )
+        SELECT ancestor_id, descendant_id, depth FROM referral_tree
+        """
+    )
+    op.create_index("ix_referral_closure_ancestor_id_depth", "referral_closure", ["ancestor_id", "depth"], unique=False)
+    op.create_index("ix_referral_closure_descendant_id", "referral_closure", ["descendant_id"], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index("ix_referral_closure_descendant_id", table_name="referral_closure")
+    op.drop_index("ix_referral_closure_ancestor_id_depth", table_name="referral_closure")
+    op.drop_table("referral_closure")
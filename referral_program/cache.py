@@ -0,0 +1,108 @@
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Annotated, Optional
+
+import aioredis
+from aioredis.client import Script
+from fastapi import Depends
+
+from core.config import settings
+from core.metrics import Counter
+from core.redis import get_redis
+from referral_program.schema import ReferralCodeRead
+
+# Drops the code -> email mapping together with the cached lookup of that email
+INVALIDATE_BY_CODE_SCRIPT = """
+local email = redis.call('GET', KEYS[1])
+if email then
+    redis.call('DEL', ARGV[1] .. email)
+end
+return redis.call('DEL', KEYS[1])
+"""
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+
+
+referral_code_cache_stats = CacheStats()
+Counter(
+    "referral_code_cache_hits_total",
+    "Referral code lookups by email served from cache.",
+    function=lambda: referral_code_cache_stats.hits,
+)
+Counter(
+    "referral_code_cache_misses_total",
+    "Referral code lookups by email served from database.",
+    function=lambda: referral_code_cache_stats.misses,
+)
+
+
+class ReferralCodeCache:
+    """
+    Read-through cache of ReferralCodeRead resolved by referrer email.
+
+    Negative results (no active unused code) are cached as an empty ReferralCodeRead.
+    Positive results additionally store a code -> email mapping, so the entry can be dropped
+    when the code is used by someone who only knows the code.
+    """
+
+    EMAIL_KEY_PREFIX = "referral_code:email:"
+    CODE_KEY_PREFIX = "referral_code:code:"
+    # The cache is made for every request, the script is hashed only on import
+    invalidate_by_code_script = Script(None, INVALIDATE_BY_CODE_SCRIPT.encode())
+
+    def __init__(self, redis: aioredis.Redis, ttl_seconds: int = settings.REFERRAL_CODE_CACHE_TTL_SECONDS):
+        self.redis = redis
+        self.ttl_seconds = ttl_seconds
+        self.stats = referral_code_cache_stats
+
+    def get_email_key(self, email: str) -> str:
+        return f"{self.EMAIL_KEY_PREFIX}{email.lower()}"
+
+    def get_code_key(self, code: str) -> str:
+        return f"{self.CODE_KEY_PREFIX}{code}"
+
+    async def get(self, email: str) -> Optional[ReferralCodeRead]:
+        cached_value = await self.redis.get(self.get_email_key(email))
+        if cached_value is None:
+            self.stats.misses += 1
+            return None
+
+        self.stats.hits += 1
+        return ReferralCodeRead.model_validate_json(cached_value)
+
+    async def set(self, email: str, referral_code: ReferralCodeRead, expired_at: Optional[datetime] = None) -> None:
+        ttl_seconds = self.ttl_seconds
+        if expired_at is not None:
+            ttl_seconds = min(ttl_seconds, int((expired_at - datetime.utcnow()).total_seconds()))
+        if ttl_seconds <= 0:
+            return
+
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.set(self.get_email_key(email), referral_code.model_dump_json(), ex=ttl_seconds)
+            if referral_code.referral_code is not None:
+                pipe.set(self.get_code_key(referral_code.referral_code), email.lower(), ex=ttl_seconds)
+            await pipe.execute()
+
+    async def invalidate(self, email: str) -> None:
+        await self.redis.delete(self.get_email_key(email))
+
+    async def invalidate_by_code(self, code: str) -> None:
+        await self.invalidate_by_code_script(
+            keys=[self.get_code_key(code)], args=[self.EMAIL_KEY_PREFIX], client=self.redis
+        )
+
+    async def invalidate_by_codes(self, *codes: str) -> None:
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for code in codes:
+                await self.invalidate_by_code_script(
+                    keys=[self.get_code_key(code)], args=[self.EMAIL_KEY_PREFIX], client=pipe
+                )
+            await pipe.execute()
+
+
+def get_referral_code_cache(redis: Annotated[aioredis.Redis, Depends(get_redis)]) -> ReferralCodeCache:
+    return ReferralCodeCache(redis)
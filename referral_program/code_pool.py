@@ -0,0 +1,82 @@
+import logging
+from typing import Annotated, Iterable, Optional
+
+import aioredis
+from aioredis.client import Script
+from fastapi import Depends
+
+from core.config import settings
+from core.metrics import Counter, Gauge
+from core.redis import get_redis
+
+logger = logging.getLogger(__name__)
+
+# Takes the next code off the list and drops it from the membership set, returns it with the remaining size
+POP_SCRIPT = """
+local code = redis.call('LPOP', KEYS[1])
+if code then
+    redis.call('SREM', KEYS[2], code)
+end
+return {code, redis.call('LLEN', KEYS[1])}
+"""
+
+# Appends the codes that aren't in the pool yet, returns the new size
+FILL_SCRIPT = """
+for _, code in ipairs(ARGV) do
+    if redis.call('SADD', KEYS[2], code) == 1 then
+        redis.call('RPUSH', KEYS[1], code)
+    end
+end
+return redis.call('LLEN', KEYS[1])
+"""
+
+referral_code_pool_size = Gauge("referral_code_pool_size", "Pre-generated referral codes left in the pool, last seen.")
+referral_code_pool_misses = Counter(
+    "referral_code_pool_misses_total", "Referral codes generated in request because the pool was empty."
+)
+
+
+class ReferralCodePool:
+    """
+    Pre-generated referral codes checked against the database, kept in a Redis list for O(1) issuance.
+    A set mirrors the list, so the same code never enters the pool twice.
+    """
+
+    LIST_KEY = "referral_code_pool"
+    MEMBERS_KEY = "referral_code_pool:members"
+    # Pools are made per request, so the scripts are shared by all of them and run with their client
+    pop_script = Script(None, POP_SCRIPT.encode())
+    fill_script = Script(None, FILL_SCRIPT.encode())
+
+    def __init__(self, redis: aioredis.Redis, low_water: int = settings.REFERRAL_CODE_POOL_LOW_WATER):
+        self.redis = redis
+        self.low_water = low_water
+
+    async def pop(self) -> Optional[str]:
+        code, size = await self.pop_script(keys=[self.LIST_KEY, self.MEMBERS_KEY], client=self.redis)
+        referral_code_pool_size.set(size)
+        if code is None:
+            referral_code_pool_misses.inc()
+            logger.warning("Referral code pool is empty, codes are generated in request")
+            return None
+
+        # Every size is returned by exactly one pop, so crossing the low-water mark is reported once
+        if size == self.low_water - 1:
+            logger.warning("Referral code pool is below low-water mark of %d codes", self.low_water)
+        return code.decode()
+
+    async def fill(self, codes: Iterable[str]) -> int:
+        codes = list(codes)
+        if not codes:
+            return await self.size()
+
+        size = await self.fill_script(keys=[self.LIST_KEY, self.MEMBERS_KEY], args=codes, client=self.redis)
+        referral_code_pool_size.set(size)
+        return size
+
+    async def size(self) -> int:
+        return await self.redis.llen(self.LIST_KEY)
+
+
+def get_referral_code_pool(redis: Annotated[aioredis.Redis, Depends(get_redis)]) -> ReferralCodePool:
+    return ReferralCodePool(redis)
@@ -0,0 +1,183 @@
+"""
+Maintenance commands of the referral program.
+
+    python -m referral_program.commands rebuild-referrer-stats
+    python -m referral_program.commands rebuild-leaderboard --forever
+    python -m referral_program.commands sweep-expired-codes --forever
+    python -m referral_program.commands fill-code-pool --forever
+    python -m referral_program.commands rebuild-issued-codes
+"""
+import argparse
+import asyncio
+import time
+from datetime import datetime
+from functools import partial
+
+from core.config import settings
+from core.db import get_async_session_maker, unit_of_work, add_after_commit_callback, dispose_engine
+from core.redis import get_redis, close_redis
+from referral_program.code_pool import ReferralCodePool
+from referral_program.db import ReferralProgramRepository
+from referral_program.issued_codes import IssuedReferralCodes, rebuild_issued_referral_codes
+from referral_program.leaderboard import Leaderboard, LeaderboardPeriod, get_period_start
+from referral_program.services import generate_referral_code
+
+
+async def rebuild_referrer_stats(args: argparse.Namespace) -> None:
+    async with get_async_session_maker()() as session, unit_of_work(session):
+        referrers_count = await ReferralProgramRepository(session).rebuild_referrer_stats()
+    print(f"Rebuilt stats of {referrers_count} referrers")
+
+
+async def rebuild_leaderboard(args: argparse.Namespace) -> None:
+    leaderboard = Leaderboard(get_redis())
+    while True:
+        now = datetime.utcnow()
+        async with get_async_session_maker()() as session:
+            repository = ReferralProgramRepository(session)
+            for period in LeaderboardPeriod:
+                await leaderboard.start_rebuild(period, now)
+                referrals_counts = await repository.stream_referrals_counts(
+                    since=get_period_start(period, now), batch_size=args.batch_size
+                )
+                referrers_count = await leaderboard.rebuild(period, now, referrals_counts.partitions())
+                print(f"{now.isoformat()} rebuilt {period.value} leaderboard of {referrers_count} referrers")
+        if not args.forever:
+            return
+        await asyncio.sleep(args.interval)
+
+
+async def sweep_expired_codes_once(args: argparse.Namespace) -> int:
+    issued_codes = IssuedReferralCodes(get_redis())
+    swept_codes_count = 0
+    while True:
+        # Every batch is committed on its own, so row locks are held only for one batch
+        async with get_async_session_maker()() as session, unit_of_work(session):
+            swept_codes = await ReferralProgramRepository(session).sweep_expired_referral_codes(
+                args.batch_size, archive=args.archive
+            )
+            add_after_commit_callback(session, partial(issued_codes.remove, *swept_codes))
+        swept_codes_count += len(swept_codes)
+        if len(swept_codes) < args.batch_size:
+            return swept_codes_count
+        await asyncio.sleep(args.pause)
+
+
+async def sweep_expired_codes(args: argparse.Namespace) -> None:
+    action = "archived" if args.archive else "deleted"
+    while True:
+        start = time.perf_counter()
+        swept_codes_count = await sweep_expired_codes_once(args)
+        elapsed_seconds = time.perf_counter() - start
+        print(
+            f"{datetime.utcnow().isoformat()} {action} {swept_codes_count} expired referral codes "
+            f"in {elapsed_seconds:.2f}s ({swept_codes_count / elapsed_seconds:.0f} codes/s)"
+        )
+        if not args.forever:
+            return
+        await asyncio.sleep(args.interval)
+
+
+async def fill_code_pool(args: argparse.Namespace) -> None:
+    code_pool = ReferralCodePool(get_redis())
+    while True:
+        size = await code_pool.size()
+        while size < args.target_size:
+            candidates = {generate_referral_code() for _ in range(min(args.batch_size, args.target_size - size))}
+            async with get_async_session_maker()() as session:
+                candidates -= await ReferralProgramRepository(session).fetch_existing_codes(list(candidates))
+            size = await code_pool.fill(candidates)
+        print(f"{datetime.utcnow().isoformat()} referral code pool holds {size} codes")
+        if not args.forever:
+            return
+        await asyncio.sleep(args.interval)
+
+
+async def rebuild_issued_codes(args: argparse.Namespace) -> None:
+    codes_count = await rebuild_issued_referral_codes(
+        get_redis(), get_async_session_maker(), batch_size=args.batch_size
+    )
+    if codes_count is None:
+        print("Set of issued referral codes is being rebuilt by another process")
+    else:
+        print(f"Rebuilt set of {codes_count} issued referral codes")
+
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    rebuild_referrer_stats_parser = subparsers.add_parser(
+        "rebuild-referrer-stats", help="recompute referrer_stats from referral codes"
+    )
+    rebuild_referrer_stats_parser.set_defaults(handler=rebuild_referrer_stats)
+
+    rebuild_leaderboard_parser = subparsers.add_parser(
+        "rebuild-leaderboard", help="recompute leaderboard sorted sets from referral codes"
+    )
+    rebuild_leaderboard_parser.add_argument("--batch-size", type=int, default=settings.LEADERBOARD_REBUILD_BATCH_SIZE)
+    rebuild_leaderboard_parser.add_argument(
+        "--forever", action="store_true", help="repeat the rebuild every interval, correcting the drift of increments"
+    )
+    rebuild_leaderboard_parser.add_argument(
+        "--interval", type=float, default=settings.LEADERBOARD_REBUILD_INTERVAL_SECONDS, help="seconds between rebuilds"
+    )
+    rebuild_leaderboard_parser.set_defaults(handler=rebuild_leaderboard)
+
+    sweep_expired_codes_parser = subparsers.add_parser(
+        "sweep-expired-codes", help="delete or archive expired unused referral codes in batches"
+    )
+    sweep_expired_codes_parser.add_argument("--batch-size", type=int, default=settings.REFERRAL_CODES_SWEEP_BATCH_SIZE)
+    sweep_expired_codes_parser.add_argument(
+        "--pause",
+        type=float,
+        default=settings.REFERRAL_CODES_SWEEP_PAUSE_SECONDS,
+        help="seconds to sleep between batches",
+    )
+    sweep_expired_codes_parser.add_argument(
+        "--archive",
+        action=argparse.BooleanOptionalAction,
+        default=settings.REFERRAL_CODES_SWEEP_ARCHIVE,
+        help="move codes to referral_code_archive instead of deleting them",
+    )
+    sweep_expired_codes_parser.add_argument("--forever", action="store_true", help="repeat the sweep every interval")
+    sweep_expired_codes_parser.add_argument(
+        "--interval", type=float, default=settings.REFERRAL_CODES_SWEEP_INTERVAL_SECONDS, help="seconds between sweeps"
+    )
+    sweep_expired_codes_parser.set_defaults(handler=sweep_expired_codes)
+
+    fill_code_pool_parser = subparsers.add_parser(
+        "fill-code-pool", help="top up the pool of pre-generated referral codes in Redis"
+    )
+    fill_code_pool_parser.add_argument("--target-size", type=int, default=settings.REFERRAL_CODE_POOL_TARGET_SIZE)
+    fill_code_pool_parser.add_argument("--batch-size", type=int, default=settings.REFERRAL_CODE_POOL_FILL_BATCH_SIZE)
+    fill_code_pool_parser.add_argument("--forever", action="store_true", help="top up the pool every interval")
+    fill_code_pool_parser.add_argument(
+        "--interval",
+        type=float,
+        default=settings.REFERRAL_CODE_POOL_FILL_INTERVAL_SECONDS,
+        help="seconds between top-ups",
+    )
+    fill_code_pool_parser.set_defaults(handler=fill_code_pool)
+
+    rebuild_issued_codes_parser = subparsers.add_parser(
+        "rebuild-issued-codes", help="rebuild the Redis set of issued referral codes checked at signup"
+    )
+    rebuild_issued_codes_parser.add_argument(
+        "--batch-size", type=int, default=settings.REFERRAL_CODE_ISSUED_REBUILD_BATCH_SIZE
+    )
+    rebuild_issued_codes_parser.set_defaults(handler=rebuild_issued_codes)
+
+    return parser
+
+
+async def run(args: argparse.Namespace) -> None:
+    try:
+        await args.handler(args)
+    finally:
+        await close_redis()
+        await dispose_engine()
+
+
+if __name__ == "__main__":
+    asyncio.run(run(get_parser().parse_args()))
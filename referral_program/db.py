@@ -1,14 +1,31 @@
 from datetime import datetime
-from typing import Annotated, Optional
+from typing import Annotated, Any, Optional
 
 from fastapi import Depends
-from sqlalchemy import select, exists, delete
+from sqlalchemy import select, exists, delete, func, insert, text, update, Row
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import contains_eager
 
 from auth.models import User
 from core.db import get_async_session
-from referral_program.models import ReferralCode
+from referral_program.models import ReferralCode, ReferrerStats, ReferralCodeArchive
+from referral_program.services import generate_referral_code
+
+DIALECT_INSERTS = {"postgresql": postgresql.insert, "sqlite": sqlite.insert}
+CODE_COLLISION_ATTEMPTS = 3
+
+
+def add_referrer_stats_deltas(query):
+    """Make the insert of (referrer id, referrals count, last referral at) rows add them to the existing stats."""
+    return query.on_conflict_do_update(
+        index_elements=[ReferrerStats.referrer_id],
+        set_={
+            "referrals_count": ReferrerStats.referrals_count + query.excluded.referrals_count,
+            "last_referral_at": func.coalesce(query.excluded.last_referral_at, ReferrerStats.last_referral_at),
+        },
+    )
 
 
 class ReferralProgramRepository:
@@ -16,37 +33,119 @@ class ReferralProgramRepository:
         self.session: AsyncSession = session
 
     async def check_whether_active_referral_code_exists(self, user_id: int):
-        query = (
-            select(ReferralCode)
-            .join(User, ReferralCode.id == User.referrer_id, isouter=True)
-            .where(ReferralCode.referrer_id == user_id, ReferralCode.expired_at >= datetime.utcnow(), User.id == None)
+        query = select(ReferralCode).where(
+            ReferralCode.referrer_id == user_id,
+            ReferralCode.expired_at >= datetime.utcnow(),
+            ReferralCode.used_at.is_(None),
         )
         query_result = await self.session.execute(exists(query).select())
 
         return query_result.scalar()
 
     async def create_referral_code(self, referral_code: ReferralCode):
-        self.session.add(referral_code)
-
-        await self.session.commit()
-
-    async def check_whether_referral_code_exists_by_id(self, user_id: int, id: int):
-        query = exists(ReferralCode).where(ReferralCode.referrer_id == user_id, ReferralCode.id == id).select()
+        """Insert the code, replacing it with a freshly generated one if it's already taken."""
+        for attempt in range(1, CODE_COLLISION_ATTEMPTS + 1):
+            try:
+                async with self.session.begin_nested():
+                    self.session.add(referral_code)
+                    await self.session.flush()
+                return
+            except IntegrityError:
+                if attempt == CODE_COLLISION_ATTEMPTS:
+                    raise
+                referral_code.code = generate_referral_code()
+
+    async def fetch_existing_codes(self, codes: list[str]) -> set[str]:
+        return set(await self.session.scalars(select(ReferralCode.code).where(ReferralCode.code.in_(codes))))
+
+    async def create_referral_codes(
+        self, referrer_id: int, expired_at: datetime, count: int, batch_size: int
+    ) -> list[str]:
+        """
+        Issue `count` codes with multi-row INSERT ... ON CONFLICT DO NOTHING batches.
+        Codes clashing with existing ones are skipped by the database and generated again in the next batch.
+        """
+        insert = DIALECT_INSERTS[self.session.get_bind().dialect.name]
+        created_at = datetime.utcnow()
+        codes: list[str] = []
+
+        while len(codes) < count:
+            batch = {generate_referral_code() for _ in range(min(count - len(codes), batch_size))}
+            query = (
+                insert(ReferralCode)
+                .values(
+                    [
+                        {"referrer_id": referrer_id, "code": code, "created_at": created_at, "expired_at": expired_at}
+                        for code in batch
+                    ]
+                )
+                .on_conflict_do_nothing(index_elements=[ReferralCode.code])
+                .returning(ReferralCode.code)
+            )
+            codes.extend(await self.session.scalars(query))
+
+        return codes
+
+    async def count_active_referral_codes(self, user_id: int) -> int:
+        query = select(func.count()).where(
+            ReferralCode.referrer_id == user_id,
+            ReferralCode.expired_at >= datetime.utcnow(),
+            ReferralCode.used_at.is_(None),
+        )
 
         return await self.session.scalar(query)
 
-    async def delete_referral_code_by_id(self, user_id: int, id: int):
-        query = delete(ReferralCode).where(ReferralCode.referrer_id == user_id, ReferralCode.id == id)
+    async def delete_referral_code_by_id(self, user_id: int, id: int) -> Optional[Row]:
+        """Delete the code and return its (code, used_at, used_by_id) row, None if there was no such code."""
+        query = (
+            delete(ReferralCode)
+            .where(ReferralCode.referrer_id == user_id, ReferralCode.id == id)
+            .returning(ReferralCode.code, ReferralCode.used_at, ReferralCode.used_by_id)
+        )
+        return (await self.session.execute(query)).first()
+
+    async def sweep_expired_referral_codes(self, batch_size: int, archive: bool = False) -> list[str]:
+        """
+        Delete a batch of expired unused codes, optionally moving them to referral_code_archive.
+        Returns the swept codes.
+
+        Rows locked by other sweepers are skipped, so several of them can run at once.
+        """
+        expired_referral_codes_query = (
+            select(ReferralCode.id)
+            .where(ReferralCode.used_at.is_(None), ReferralCode.expired_at < datetime.utcnow())
+            .limit(batch_size)
+            .with_for_update(skip_locked=True)
+        )
+        query = (
+            delete(ReferralCode)
+            .where(ReferralCode.id.in_(expired_referral_codes_query.scalar_subquery()))
+            .returning(
+                ReferralCode.id,
+                ReferralCode.referrer_id,
+                ReferralCode.code,
+                ReferralCode.created_at,
+                ReferralCode.expired_at,
+            )
+        )
+        swept_referral_codes = (await self.session.execute(query)).mappings().all()
+        if not swept_referral_codes:
+            return []
+
+        if archive:
+            await self.session.execute(
+                insert(ReferralCodeArchive), [dict(referral_code) for referral_code in swept_referral_codes]
+            )
 
-        await self.session.execute(query)
-        await self.session.commit()
+        return [referral_code["code"] for referral_code in swept_referral_codes]
 
     async def fetch_referral_code_by_email(self, email) -> Optional[ReferralCode]:
+        """Latest unexpired code of the referrer, emails are compared case-insensitively like the cache keys."""
         query = (
             select(ReferralCode)
             .join(ReferralCode.referrer)
             .options(contains_eager(ReferralCode.referrer))
-            .where(User.email == email, ReferralCode.expired_at >= datetime.utcnow())
+            .where(func.lower(User.email) == email.lower(), ReferralCode.expired_at >= datetime.utcnow())
             .order_by(ReferralCode.created_at.desc())
             .limit(1)
         )
@@ -54,7 +153,94 @@ class ReferralProgramRepository:
         return await self.session.scalar(query)
 
     async def check_whether_referral_code_was_used(self, referral_code: ReferralCode) -> bool:
-        return await self.session.scalar(select(User).where(User.referrer_id == referral_code.id).exists().select())
+        query = exists().where(ReferralCode.id == referral_code.id, ReferralCode.used_at.is_not(None)).select()
+
+        return await self.session.scalar(query)
+
+    async def update_referrer_stats(
+        self,
+        referrer_id: int,
+        referrals_count: int = 0,
+        last_referral_at: Optional[datetime] = None,
+    ) -> None:
+        """Add the deltas to the stats of the referrer in a single upsert."""
+        await self.update_referrers_stats(
+            [
+                {
+                    "referrer_id": referrer_id,
+                    "referrals_count": referrals_count,
+                    "last_referral_at": last_referral_at,
+                }
+            ]
+        )
+
+    async def update_referrers_stats(self, deltas: list[dict[str, Any]]) -> None:
+        """
+        Add the deltas to the stats of several referrers in a single multi-row upsert.
+        Every dict holds all of the `update_referrer_stats` arguments, and a referrer may appear only once.
+        """
+        insert = DIALECT_INSERTS[self.session.get_bind().dialect.name]
+        await self.session.execute(add_referrer_stats_deltas(insert(ReferrerStats).values(deltas)))
+
+    async def remove_referral_from_referrer_stats(self, referrer_id: int) -> None:
+        """
+        Subtract a referral whose used code was deleted from the stats of the referrer,
+        so they keep matching the ones `rebuild_referrer_stats` computes from the remaining codes.
+        """
+        last_referral_at_query = (
+            select(func.max(ReferralCode.used_at)).where(ReferralCode.referrer_id == referrer_id).scalar_subquery()
+        )
+        await self.session.execute(
+            update(ReferrerStats)
+            .where(ReferrerStats.referrer_id == referrer_id)
+            .values(referrals_count=ReferrerStats.referrals_count - 1, last_referral_at=last_referral_at_query)
+        )
+
+    async def stream_referrals_counts(self, since: Optional[datetime] = None, batch_size: int = 1000):
+        """Stream (referrer id, referrals count) rows of referrals made since the given moment."""
+        query = (
+            select(ReferralCode.referrer_id, func.count())
+            .where(ReferralCode.referrer_id.is_not(None), ReferralCode.used_at.is_not(None))
+            .group_by(ReferralCode.referrer_id)
+            .execution_options(yield_per=batch_size)
+        )
+        if since is not None:
+            query = query.where(ReferralCode.used_at >= since)
+        return await self.session.stream(query)
+
+    async def stream_codes(self, batch_size: int = 1000):
+        """Stream all codes, used ones included."""
+        return await self.session.stream_scalars(select(ReferralCode.code).execution_options(yield_per=batch_size))
+
+    async def fetch_referrer_stats(self, referrer_id: int) -> Optional[ReferrerStats]:
+        return await self.session.get(ReferrerStats, referrer_id)
+
+    async def rebuild_referrer_stats(self) -> int:
+        """
+        Recompute the stats of all referrers from referral codes, returns the number of referrers.
+        On PostgreSQL the table is locked against writes until the commit, so referrals claimed meanwhile
+        are either committed before the codes are read or added to the rebuilt stats after it.
+        """
+        stats_query = (
+            select(
+                ReferralCode.referrer_id,
+                func.count(),
+                func.max(ReferralCode.used_at),
+            )
+            .where(ReferralCode.referrer_id.is_not(None), ReferralCode.used_at.is_not(None))
+            .group_by(ReferralCode.referrer_id)
+        )
+        query = (
+            insert(ReferrerStats)
+            .from_select(["referrer_id", "referrals_count", "last_referral_at"], stats_query)
+            .returning(ReferrerStats.referrer_id)
+        )
+
+        if self.session.get_bind().dialect.name == "postgresql":
+            # Conflicts with the row exclusive lock of the upserts, not with reads of the stats
+            await self.session.execute(text(f"LOCK TABLE {ReferrerStats.__tablename__} IN SHARE ROW EXCLUSIVE MODE"))
+        await self.session.execute(delete(ReferrerStats))
+        return len((await self.session.scalars(query)).all())
 
 
 def get_referral_program_repository(session: Annotated[AsyncSession, Depends(get_async_session)]):
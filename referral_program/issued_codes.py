@@ -0,0 +1,152 @@
+import logging
+from typing import Annotated, AsyncIterator, Optional, Sequence
+
+import aioredis
+from aioredis.client import Script
+from fastapi import Depends
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from core.config import settings
+from core.enums import ErrorDetails
+from core.redis import get_redis
+from referral_program.db import ReferralProgramRepository
+
+logger = logging.getLogger(__name__)
+
+# Returns the name of the reason to reject the code with, or nil if it has to be checked in the database.
+# A missing set isn't trusted even with the ready marker, as it may have been evicted.
+CHECK_SCRIPT = """
+local reason = redis.call('GET', KEYS[1])
+if reason then
+    return reason
+end
+if redis.call('EXISTS', KEYS[2]) == 1 and redis.call('EXISTS', KEYS[3]) == 1
+    and redis.call('SISMEMBER', KEYS[3], ARGV[1]) == 0 then
+    return ARGV[2]
+end
+return false
+"""
+
+# Codes issued while the set is rebuilt go to the set being built as well, so the rename doesn't lose them.
+# Cached rejections of the codes are dropped, a guessed code may be issued later.
+ADD_SCRIPT = """
+local rebuilding = redis.call('EXISTS', KEYS[2]) == 1
+for index = 2, #ARGV do
+    local code = ARGV[index]
+    redis.call('SADD', KEYS[1], code)
+    if rebuilding then
+        redis.call('SADD', KEYS[2], code)
+    end
+    redis.call('DEL', ARGV[1] .. code)
+end
+"""
+
+FINISH_REBUILD_SCRIPT = """
+redis.call('SREM', KEYS[2], ARGV[1])
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    redis.call('RENAME', KEYS[2], KEYS[1])
+else
+    redis.call('DEL', KEYS[1])
+end
+redis.call('SET', KEYS[3], 1)
+"""
+
+
+class IssuedReferralCodes:
+    """
+    Redis set of every code in referral_code, so that registrations with guessed codes are rejected
+    without a database lookup, and a short-lived cache of the reasons codes were recently rejected for.
+
+    Until the set is built for the first time, the ready marker is missing and codes are checked in the database,
+    as they are when the set itself is missing.
+    """
+
+    SET_KEY = "referral_code:issued"
+    REBUILD_KEY = "referral_code:issued:rebuild"
+    READY_KEY = "referral_code:issued:ready"
+    REBUILD_LOCK_KEY = "referral_code:issued:rebuild_lock"
+    REJECTED_KEY_PREFIX = "referral_code:rejected:"
+    # Keeps the set being built existing from the start, no code can be empty
+    REBUILD_SENTINEL = ""
+    ADD_BATCH_SIZE = 1000
+    # An instance is made for every signup, so the scripts are hashed once and run with its client
+    check_script = Script(None, CHECK_SCRIPT.encode())
+    add_script = Script(None, ADD_SCRIPT.encode())
+    finish_rebuild_script = Script(None, FINISH_REBUILD_SCRIPT.encode())
+
+    def __init__(
+        self, redis: aioredis.Redis, rejection_ttl_seconds: int = settings.REFERRAL_CODE_REJECTION_TTL_SECONDS
+    ):
+        self.redis = redis
+        self.rejection_ttl_seconds = rejection_ttl_seconds
+
+    def get_rejected_key(self, code: str) -> str:
+        return f"{self.REJECTED_KEY_PREFIX}{code}"
+
+    async def check(self, code: str) -> Optional[ErrorDetails]:
+        """Reason to reject the code with if it's known without the database."""
+        reason = await self.check_script(
+            keys=[self.get_rejected_key(code), self.READY_KEY, self.SET_KEY],
+            args=[code, ErrorDetails.REFERRAL_CODE_DOESNT_EXIST.name],
+            client=self.redis,
+        )
+        return ErrorDetails[reason.decode()] if reason is not None else None
+
+    async def reject(self, code: str, reason: ErrorDetails) -> None:
+        await self.redis.set(self.get_rejected_key(code), reason.name, ex=self.rejection_ttl_seconds)
+
+    async def add(self, *codes: str) -> None:
+        for start in range(0, len(codes), self.ADD_BATCH_SIZE):
+            await self.add_script(
+                keys=[self.SET_KEY, self.REBUILD_KEY],
+                args=[self.REJECTED_KEY_PREFIX, *codes[start : start + self.ADD_BATCH_SIZE]],
+                client=self.redis,
+            )
+
+    async def remove(self, *codes: str) -> None:
+        if not codes:
+            return
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.srem(self.SET_KEY, *codes)
+            pipe.srem(self.REBUILD_KEY, *codes)
+            await pipe.execute()
+
+    async def rebuild(self, partitions: AsyncIterator[Sequence[str]]) -> int:
+        """Replace the set with the given codes, returns their number."""
+        await self.redis.delete(self.REBUILD_KEY)
+        await self.redis.sadd(self.REBUILD_KEY, self.REBUILD_SENTINEL)
+
+        codes_count = 0
+        async for partition in partitions:
+            await self.redis.sadd(self.REBUILD_KEY, *partition)
+            codes_count += len(partition)
+
+        await self.finish_rebuild_script(
+            keys=[self.SET_KEY, self.REBUILD_KEY, self.READY_KEY], args=[self.REBUILD_SENTINEL], client=self.redis
+        )
+        return codes_count
+
+
+async def rebuild_issued_referral_codes(
+    redis: aioredis.Redis,
+    session_maker: async_sessionmaker[AsyncSession],
+    batch_size: int = settings.REFERRAL_CODE_ISSUED_REBUILD_BATCH_SIZE,
+) -> Optional[int]:
+    """Rebuild the set from referral_code unless another instance is already doing it."""
+    if not await redis.set(
+        IssuedReferralCodes.REBUILD_LOCK_KEY, 1, nx=True, ex=settings.REFERRAL_CODE_ISSUED_REBUILD_LOCK_SECONDS
+    ):
+        return None
+
+    try:
+        async with session_maker() as session:
+            codes = await ReferralProgramRepository(session).stream_codes(batch_size)
+            codes_count = await IssuedReferralCodes(redis).rebuild(codes.partitions())
+        logger.info("Rebuilt set of %d issued referral codes", codes_count)
+        return codes_count
+    finally:
+        await redis.delete(IssuedReferralCodes.REBUILD_LOCK_KEY)
+
+
+def get_issued_referral_codes(redis: Annotated[aioredis.Redis, Depends(get_redis)]) -> IssuedReferralCodes:
+    return IssuedReferralCodes(redis)
@@ -0,0 +1,159 @@
+import enum
+from datetime import datetime, timedelta, timezone
+from typing import Annotated, AsyncIterator, Optional, Sequence
+
+import aioredis
+from aioredis.client import Script
+from fastapi import Depends
+
+from core.redis import get_redis
+
+# KEYS are pairs of the set of a period and the set being rebuilt for it, ARGV[1] and ARGV[2] are the increment
+# and the referrer id, followed by the expiration time of every period set, or 0.
+# Increments made while a set is rebuilt go to the set being built as well, so the rename doesn't lose them.
+# Referrers left without referrals by a negative increment are removed from the set of the period.
+INCREMENT_SCRIPT = """
+for index = 1, #KEYS, 2 do
+    if tonumber(redis.call('ZINCRBY', KEYS[index], ARGV[1], ARGV[2])) <= 0 then
+        redis.call('ZREM', KEYS[index], ARGV[2])
+    end
+    if redis.call('EXISTS', KEYS[index + 1]) == 1 then
+        redis.call('ZINCRBY', KEYS[index + 1], ARGV[1], ARGV[2])
+    end
+    local expire_at = tonumber(ARGV[2 + (index + 1) / 2])
+    if expire_at > 0 then
+        redis.call('EXPIREAT', KEYS[index], expire_at)
+    end
+end
+"""
+
+FINISH_REBUILD_SCRIPT = """
+redis.call('ZREM', KEYS[2], ARGV[1])
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', 0)
+if redis.call('EXISTS', KEYS[2]) == 0 then
+    redis.call('DEL', KEYS[1])
+    return
+end
+redis.call('RENAME', KEYS[2], KEYS[1])
+if tonumber(ARGV[2]) > 0 then
+    redis.call('EXPIREAT', KEYS[1], ARGV[2])
+end
+"""
+
+
+class LeaderboardPeriod(str, enum.Enum):
+    ALL_TIME = "all_time"
+    MONTH = "month"
+    WEEK = "week"
+
+
+def get_period_start(period: LeaderboardPeriod, at: datetime) -> Optional[datetime]:
+    if period is LeaderboardPeriod.ALL_TIME:
+        return None
+
+    day = at.replace(hour=0, minute=0, second=0, microsecond=0)
+    if period is LeaderboardPeriod.WEEK:
+        return day - timedelta(days=day.weekday())
+    return day.replace(day=1)
+
+
+class Leaderboard:
+    """
+    Referrers ranked by number of referrals, kept in a Redis sorted set per period.
+
+    Weekly and monthly sets are keyed by the first day of the period and expire
+    one period after it's over, the all-time set is kept forever.
+    """
+
+    KEY_PREFIX = "leaderboard:"
+    RETENTION = {LeaderboardPeriod.MONTH: timedelta(days=62), LeaderboardPeriod.WEEK: timedelta(weeks=2)}
+    # Keeps the set being built existing from the start, referrer ids are never empty
+    REBUILD_SENTINEL = ""
+    # Leaderboards are made per request, so the scripts are hashed once and run with the client of the request
+    increment_script = Script(None, INCREMENT_SCRIPT.encode())
+    finish_rebuild_script = Script(None, FINISH_REBUILD_SCRIPT.encode())
+
+    def __init__(self, redis: aioredis.Redis):
+        self.redis = redis
+
+    def get_key(self, period: LeaderboardPeriod, at: datetime) -> str:
+        period_start = get_period_start(period, at)
+        if period_start is None:
+            return f"{self.KEY_PREFIX}{period.value}"
+        return f"{self.KEY_PREFIX}{period.value}:{period_start.date().isoformat()}"
+
+    def get_rebuild_key(self, period: LeaderboardPeriod, at: datetime) -> str:
+        return f"{self.get_key(period, at)}:rebuild"
+
+    def get_expire_at(self, period: LeaderboardPeriod, at: datetime) -> Optional[int]:
+        if period not in self.RETENTION:
+            return None
+        expire_at = get_period_start(period, at) + self.RETENTION[period]
+        return int(expire_at.replace(tzinfo=timezone.utc).timestamp())
+
+    async def increment(self, referrer_id: int, at: datetime, referrals_count: int = 1) -> None:
+        keys, expire_ats = [], []
+        for period in LeaderboardPeriod:
+            keys.extend((self.get_key(period, at), self.get_rebuild_key(period, at)))
+            expire_ats.append(self.get_expire_at(period, at) or 0)
+        await self.increment_script(keys=keys, args=[referrals_count, referrer_id, *expire_ats], client=self.redis)
+
+    async def top(self, period: LeaderboardPeriod, offset: int, limit: int) -> list[tuple[int, int]]:
+        """Page of (referrer id, referrals count) pairs, starting with the best referrer."""
+        entries = await self.redis.zrevrange(
+            self.get_key(period, datetime.utcnow()), offset, offset + limit - 1, withscores=True
+        )
+        return [(int(referrer_id), int(referrals_count)) for referrer_id, referrals_count in entries]
+
+    async def rank(self, period: LeaderboardPeriod, referrer_id: int) -> tuple[Optional[int], int]:
+        """Zero-based rank of the referrer with their referrals count, rank is None if they have no referrals."""
+        key = self.get_key(period, datetime.utcnow())
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.zrevrank(key, referrer_id)
+            pipe.zscore(key, referrer_id)
+            rank, referrals_count = await pipe.execute()
+        return rank, int(referrals_count or 0)
+
+    async def start_rebuild(self, period: LeaderboardPeriod, at: datetime) -> None:
+        """
+        Start collecting increments of the period for `rebuild`, has to be called before the referrals counts
+        are read, so that referrals counted by neither of them can't be made in between.
+        """
+        rebuild_key = self.get_rebuild_key(period, at)
+        await self.redis.delete(rebuild_key)
+        await self.redis.zadd(rebuild_key, {self.REBUILD_SENTINEL: 0})
+
+    async def rebuild(
+        self, period: LeaderboardPeriod, at: datetime, partitions: AsyncIterator[Sequence[tuple[int, int]]]
+    ) -> int:
+        """
+        Replace the set of the period with (referrer id, referrals count) pairs, returns the number of referrers.
+        The new set is filled under a temporary key and renamed, so readers never see it half-built.
+
+        Increments made since `start_rebuild` are in the new set already, so the counts are added to them
+        rather than set, and they aren't lost with the rename.
+
+        Increments are made after the commit of the referral, so one committed before the counts are read
+        but made after `start_rebuild` is counted twice, and the same goes for the decrements of deleted codes.
+        The sets drift by these few referrals until the next rebuild, which runs periodically for that reason.
+        """
+        key = self.get_key(period, at)
+        rebuild_key = self.get_rebuild_key(period, at)
+        referrers_count = 0
+        async for partition in partitions:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for referrer_id, referrals_count in partition:
+                    pipe.zincrby(rebuild_key, referrals_count, referrer_id)
+                await pipe.execute()
+            referrers_count += len(partition)
+
+        await self.finish_rebuild_script(
+            keys=[key, rebuild_key],
+            args=[self.REBUILD_SENTINEL, self.get_expire_at(period, at) or 0],
+            client=self.redis,
+        )
+        return referrers_count
+
+
+def get_leaderboard(redis: Annotated[aioredis.Redis, Depends(get_redis)]) -> Leaderboard:
+    return Leaderboard(redis)
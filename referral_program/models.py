@@ -1,7 +1,7 @@
 from datetime import datetime
 from typing import Optional
 
-from sqlalchemy import ForeignKey, String, TIMESTAMP
+from sqlalchemy import ForeignKey, String, TIMESTAMP, Index, Integer
 from sqlalchemy.orm import mapped_column, Mapped, relationship
 
 from core.models import Base
@@ -15,5 +15,62 @@ class ReferralCode(Base):
     code: Mapped[str] = mapped_column(String(length=16), default=generate_referral_code, unique=True)
     created_at: Mapped[datetime] = mapped_column(TIMESTAMP, default=datetime.utcnow)
     expired_at: Mapped[Optional[datetime]] = mapped_column(TIMESTAMP)
+    used_at: Mapped[Optional[datetime]] = mapped_column(TIMESTAMP, nullable=True, default=None)
+    used_by_id: Mapped[Optional[int]] = mapped_column(
+        ForeignKey("user.id", ondelete="SET NULL", use_alter=True), nullable=True, default=None, index=True
+    )
 
     referrer = relationship("User", back_populates="referral_codes", primaryjoin="ReferralCode.referrer_id == User.id")
+
+
+Index(
+    "ix_referral_code_active",
+    ReferralCode.referrer_id,
+    ReferralCode.expired_at,
+    postgresql_where=ReferralCode.used_at.is_(None),
+    sqlite_where=ReferralCode.used_at.is_(None),
+)
+Index("ix_referral_code_referrer_id_created_at", ReferralCode.referrer_id, ReferralCode.created_at.desc())
+Index(
+    "ix_referral_code_unused_expired_at",
+    ReferralCode.expired_at,
+    postgresql_where=ReferralCode.used_at.is_(None),
+    sqlite_where=ReferralCode.used_at.is_(None),
+)
+
+
+class ReferralCodeArchive(Base):
+    """Expired unused referral codes moved out of referral_code by the sweeper."""
+
+    __tablename__ = "referral_code_archive"
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=False)
+    referrer_id: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    code: Mapped[str] = mapped_column(String(length=16))
+    created_at: Mapped[datetime] = mapped_column(TIMESTAMP)
+    expired_at: Mapped[Optional[datetime]] = mapped_column(TIMESTAMP)
+    archived_at: Mapped[datetime] = mapped_column(TIMESTAMP, default=datetime.utcnow)
+
+
+class ReferralClosure(Base):
+    """Materialized referral tree: a row for every user and each of their referrers up the chain."""
+
+    __tablename__ = "referral_closure"
+    ancestor_id: Mapped[int] = mapped_column(ForeignKey("user.id", ondelete="CASCADE"), primary_key=True)
+    descendant_id: Mapped[int] = mapped_column(ForeignKey("user.id", ondelete="CASCADE"), primary_key=True)
+    depth: Mapped[int] = mapped_column(Integer)
+
+
+Index("ix_referral_closure_ancestor_id_depth", ReferralClosure.ancestor_id, ReferralClosure.depth)
+Index("ix_referral_closure_descendant_id", ReferralClosure.descendant_id)
+
+
+class ReferrerStats(Base):
+    """
+    Per-referrer aggregates updated along with the referral codes.
+    Active codes aren't stored, as codes expire without a write, they're counted with ix_referral_code_active instead.
+    """
+
+    __tablename__ = "referrer_stats"
+    referrer_id: Mapped[int] = mapped_column(ForeignKey("user.id", ondelete="CASCADE"), primary_key=True)
+    referrals_count: Mapped[int] = mapped_column(Integer, default=0)
+    last_referral_at: Mapped[Optional[datetime]] = mapped_column(TIMESTAMP, nullable=True, default=None)
@@ -2,7 +2,10 @@ from datetime import datetime, timedelta
 from typing import Optional
 
 from fastapi import Query
-from pydantic import BaseModel, Field, field_validator, EmailStr
+from pydantic import BaseModel, ConfigDict, Field, field_validator, EmailStr
+
+from auth.schema import UserRead
+from core.config import settings
 
 
 class ReferralCodeCreate(BaseModel):
@@ -16,6 +19,17 @@ class ReferralCodeCreate(BaseModel):
         return v
 
 
+class ReferralCodeBulkCreate(ReferralCodeCreate):
+    referrer_id: int
+    count: int = Field(ge=1, le=settings.REFERRAL_CODES_BULK_MAX_COUNT)
+
+
+class ReferralCodeBulkRead(BaseModel):
+    codes: list[str]
+    elapsed_seconds: float
+    codes_per_second: float
+
+
 class ReferralCodeRead(BaseModel):
     id: Optional[int] = None
     referral_code: Optional[str] = Field(max_length=16, default=None)
@@ -23,3 +37,72 @@ class ReferralCodeRead(BaseModel):
 
 class GetReferralCodeQueryParams(BaseModel):
     email: EmailStr = Field(Query(description="email address", example="user@example.com"))
+
+
+class GetReferralsQueryParams(BaseModel):
+    after_id: Optional[int] = Field(Query(default=None, description="return referrals with id greater than this one"))
+    limit: int = Field(
+        Query(default=settings.REFERRALS_PAGE_SIZE, ge=1, le=settings.REFERRALS_MAX_PAGE_SIZE, description="page size")
+    )
+    stream: bool = Field(Query(default=False, description="stream all referrals after cursor as NDJSON"))
+
+
+class GetReferralTreeQueryParams(BaseModel):
+    depth: int = Field(
+        Query(default=settings.REFERRAL_TREE_MAX_DEPTH, ge=1, le=settings.REFERRAL_TREE_MAX_DEPTH, description="depth")
+    )
+    after: Optional[str] = Field(
+        Query(default=None, pattern=r"^\d+:\d+$", description="next_cursor of the previous page, depth:id")
+    )
+    limit: int = Field(
+        Query(
+            default=settings.REFERRAL_TREE_PAGE_SIZE,
+            ge=1,
+            le=settings.REFERRAL_TREE_MAX_PAGE_SIZE,
+            description="page size",
+        )
+    )
+
+    def get_after(self) -> Optional[tuple[int, int]]:
+        if self.after is None:
+            return None
+        depth, id = self.after.split(":")
+        return int(depth), int(id)
+
+
+class ReferralTreeLevel(BaseModel):
+    depth: int
+    count: int
+
+
+class ReferralTreeNode(UserRead):
+    depth: int
+
+
+class ReferralTreeRead(BaseModel):
+    levels: list[ReferralTreeLevel] = Field(description="sizes of the levels of the referrals on the page")
+    referrals: list[ReferralTreeNode]
+    next_cursor: Optional[str] = Field(default=None, description="cursor of the next page if there may be more of it")
+
+
+class ReferrerStatsRead(BaseModel):
+    referrals_count: int = 0
+    active_codes_count: int = 0
+    last_referral_at: Optional[datetime] = None
+
+    model_config = ConfigDict(from_attributes=True)
+
+
+class GetLeaderboardQueryParams(BaseModel):
+    offset: int = Field(Query(default=0, ge=0, description="number of top referrers to skip"))
+    limit: int = Field(
+        Query(
+            default=settings.LEADERBOARD_PAGE_SIZE, ge=1, le=settings.LEADERBOARD_MAX_PAGE_SIZE, description="page size"
+        )
+    )
+
+
+class LeaderboardEntry(BaseModel):
+    rank: Optional[int] = Field(default=None, description="one-based rank, absent if the referrer has no referrals")
+    referrer_id: int
+    referrals_count: int
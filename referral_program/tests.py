@@ -1,3 +1,5 @@
+import json
+from datetime import datetime
 from typing import Callable
 from urllib.parse import quote
 
@@ -5,12 +7,20 @@ import pytest
 from fastapi_users.schemas import BaseUser
 from httpx import AsyncClient
 from httpx import Response
-from sqlalchemy import func
+from sqlalchemy import func, select
 from sqlalchemy.ext.asyncio import AsyncSession
 from starlette import status
 
-from conftest import DateTimeBetweenKwargs
-from referral_program.models import ReferralCode
+from conftest import DateTimeBetweenKwargs, test_redis
+from core.config import settings
+from core.rate_limit import RateLimit
+from factories import TestUser
+from referral_program.cache import referral_code_cache_stats
+from referral_program.code_pool import ReferralCodePool
+from referral_program.db import ReferralProgramRepository
+from referral_program.leaderboard import Leaderboard, LeaderboardPeriod, get_period_start
+from referral_program.models import ReferralCode, ReferralCodeArchive
+from referral_program.views import referral_code_lookup_rate_limiter
 
 
 class TestReferralCode:
@@ -20,12 +30,63 @@ class TestReferralCode:
         assert response.status_code == status.HTTP_201_CREATED
         assert await get_test_async_session.scalar(func.count(ReferralCode.id)) == 1
 
+    async def test_create_referral_code_from_pool(self, auth_client: AsyncClient, get_test_async_session: AsyncSession):
+        code_pool = ReferralCodePool(test_redis)
+        await code_pool.fill(["pooled-code"])
+        response: Response = await auth_client.post("/referral_code", follow_redirects=True, json={})
+
+        assert response.status_code == status.HTTP_201_CREATED
+        assert await get_test_async_session.scalar(select(ReferralCode.code)) == "pooled-code"
+        assert await code_pool.size() == 0
+
+    async def test_create_referral_code_with_taken_code(
+        self, get_test_referral_program_repository: ReferralProgramRepository, referral_code: ReferralCode
+    ):
+        colliding_referral_code = ReferralCode(
+            referrer_id=referral_code.referrer_id, expired_at=referral_code.expired_at, code=referral_code.code
+        )
+        await get_test_referral_program_repository.create_referral_code(colliding_referral_code)
+
+        assert colliding_referral_code.id is not None
+        assert colliding_referral_code.code != referral_code.code
+
     async def test_create_referral_code_twice(self, auth_client: AsyncClient):
         first_response: Response = await auth_client.post("/referral_code", follow_redirects=True, json={})
         second_response: Response = await auth_client.post("/referral_code", follow_redirects=True, json={})
 
         assert second_response.status_code == status.HTTP_400_BAD_REQUEST
 
+    async def test_create_referral_codes_in_bulk(
+        self, auth_client: AsyncClient, superuser: BaseUser, get_test_async_session: AsyncSession
+    ):
+        response: Response = await auth_client.post(
+            "/referral_code/bulk", json={"referrer_id": superuser.id, "count": 25}, follow_redirects=True
+        )
+
+        assert response.status_code == status.HTTP_201_CREATED
+        assert len(set(response.json()["codes"])) == 25
+        assert response.json()["codes_per_second"] > 0
+        assert await get_test_async_session.scalar(func.count(ReferralCode.id)) == 25
+
+    async def test_create_referral_codes_in_bulk_retries_collisions(
+        self, auth_client: AsyncClient, superuser: BaseUser, referral_code: ReferralCode, monkeypatch
+    ):
+        generated_codes = iter([referral_code.code, "first", "second", "third"])
+        monkeypatch.setattr("referral_program.db.generate_referral_code", lambda: next(generated_codes))
+        response: Response = await auth_client.post(
+            "/referral_code/bulk", json={"referrer_id": superuser.id, "count": 3}, follow_redirects=True
+        )
+
+        assert response.status_code == status.HTTP_201_CREATED
+        assert sorted(response.json()["codes"]) == ["first", "second", "third"]
+
+    async def test_create_referral_codes_in_bulk_requires_superuser(self, auth_client: AsyncClient, user: BaseUser):
+        response: Response = await auth_client.post(
+            "/referral_code/bulk", json={"referrer_id": user.id, "count": 1}, follow_redirects=True
+        )
+
+        assert response.status_code == status.HTTP_403_FORBIDDEN
+
     async def test_delete_referral_code(self, auth_client: AsyncClient, referral_code: ReferralCode):
         response: Response = await auth_client.delete(f"/referral_code/{referral_code.id}", follow_redirects=True)
 
@@ -58,6 +119,45 @@ class TestReferralCode:
         assert response.json()["referral_code"] is None
         assert response.json()["id"] is None
 
+    async def test_get_referral_code_by_email_is_cached(self, auth_client: AsyncClient, referral_code: ReferralCode):
+        hits = referral_code_cache_stats.hits
+        params = {"email": referral_code.referrer.email}
+        first_response: Response = await auth_client.get("/referral_code", params=params, follow_redirects=True)
+        second_response: Response = await auth_client.get("/referral_code", params=params, follow_redirects=True)
+
+        assert second_response.json() == first_response.json()
+        assert referral_code_cache_stats.hits == hits + 1
+
+    async def test_get_referral_code_by_email_ignores_case(self, auth_client: AsyncClient, referral_code: ReferralCode):
+        email = referral_code.referrer.email
+        upper_response: Response = await auth_client.get("/referral_code/", params={"email": email.upper()})
+        response: Response = await auth_client.get("/referral_code/", params={"email": email})
+
+        assert upper_response.json()["referral_code"] == referral_code.code
+        assert response.json() == upper_response.json()
+
+    async def test_get_referral_code_by_email_is_rate_limited(
+        self, auth_client: AsyncClient, referral_code: ReferralCode, monkeypatch
+    ):
+        monkeypatch.setattr(referral_code_lookup_rate_limiter, "limits", (RateLimit("ip", 2, 60),))
+        params = {"email": referral_code.referrer.email}
+        responses = [await auth_client.get("/referral_code/", params=params) for _ in range(3)]
+
+        assert [response.status_code for response in responses] == [
+            status.HTTP_200_OK,
+            status.HTTP_200_OK,
+            status.HTTP_429_TOO_MANY_REQUESTS,
+        ]
+        assert int(responses[-1].headers["Retry-After"]) >= 1
+
+    async def test_used_referral_code_invalidates_cache(self, auth_client: AsyncClient, referral_code: ReferralCode):
+        params = {"email": referral_code.referrer.email}
+        await auth_client.get("/referral_code", params=params, follow_redirects=True)
+        await auth_client.post("/auth/register", json=TestUser(referral_code=referral_code.code).model_dump())
+        response: Response = await auth_client.get("/referral_code", params=params, follow_redirects=True)
+
+        assert response.json()["referral_code"] is None
+
     async def test_get_referrals_by_referrer_id(
         self, auth_client: AsyncClient, get_referral_user: Callable, referral_code: ReferralCode
     ):
@@ -68,7 +168,305 @@ class TestReferralCode:
         assert response.json()[0]["id"] == user.id
         assert response.json()[0]["email"] == user.email
 
+    async def test_get_referrals_by_referrer_id_paginated(
+        self,
+        auth_client: AsyncClient,
+        get_referral_user: Callable,
+        get_test_referral_program_repository: ReferralProgramRepository,
+        referral_code: ReferralCode,
+    ):
+        another_referral_code = ReferralCode(referrer_id=referral_code.referrer_id, expired_at=referral_code.expired_at)
+        await get_test_referral_program_repository.create_referral_code(another_referral_code)
+        first_user: BaseUser = await get_referral_user(referral_code.code)
+        second_user: BaseUser = await get_referral_user(another_referral_code.code)
+
+        first_response: Response = await auth_client.get(
+            f"/referral_code/referrals/{referral_code.referrer.id}", params={"limit": 1}
+        )
+        second_response: Response = await auth_client.get(
+            f"/referral_code/referrals/{referral_code.referrer.id}",
+            params={"limit": 1, "after_id": first_response.headers["X-Next-Cursor"]},
+        )
+
+        assert [user["id"] for user in first_response.json()] == [first_user.id]
+        assert [user["id"] for user in second_response.json()] == [second_user.id]
+
+    async def test_stream_referrals_by_referrer_id(
+        self, auth_client: AsyncClient, get_referral_user: Callable, referral_code: ReferralCode
+    ):
+        user: BaseUser = await get_referral_user(referral_code.code)
+        response: Response = await auth_client.get(
+            f"/referral_code/referrals/{referral_code.referrer.id}", params={"stream": True}
+        )
+
+        assert response.status_code == status.HTTP_200_OK
+        assert response.headers["content-type"] == "application/x-ndjson"
+        assert [json.loads(line)["id"] for line in response.text.splitlines()] == [user.id]
+
+    @pytest.mark.parametrize("from_closure_table", [False, True])
+    async def test_get_referral_tree_by_referrer_id(
+        self,
+        auth_client: AsyncClient,
+        get_referral_user: Callable,
+        get_test_referral_program_repository: ReferralProgramRepository,
+        referral_code: ReferralCode,
+        from_closure_table: bool,
+        monkeypatch,
+    ):
+        monkeypatch.setattr(settings, "REFERRAL_TREE_FROM_CLOSURE_TABLE", from_closure_table)
+        first_level_user: BaseUser = await get_referral_user(referral_code.code)
+        first_level_referral_code = ReferralCode(referrer_id=first_level_user.id, expired_at=referral_code.expired_at)
+        await get_test_referral_program_repository.create_referral_code(first_level_referral_code)
+        second_level_user: BaseUser = await get_referral_user(first_level_referral_code.code)
+
+        response: Response = await auth_client.get(f"/referral_code/referrals/{referral_code.referrer_id}/tree")
+        shallow_response: Response = await auth_client.get(
+            f"/referral_code/referrals/{referral_code.referrer_id}/tree", params={"depth": 1}
+        )
+
+        assert response.status_code == status.HTTP_200_OK
+        assert response.json()["levels"] == [{"depth": 1, "count": 1}, {"depth": 2, "count": 1}]
+        assert [(user["id"], user["depth"]) for user in response.json()["referrals"]] == [
+            (first_level_user.id, 1),
+            (second_level_user.id, 2),
+        ]
+        assert [user["id"] for user in shallow_response.json()["referrals"]] == [first_level_user.id]
+        assert response.json()["next_cursor"] is None
+
+    @pytest.mark.parametrize("from_closure_table", [False, True])
+    async def test_get_referral_tree_by_referrer_id_paginated(
+        self,
+        auth_client: AsyncClient,
+        get_referral_user: Callable,
+        get_test_referral_program_repository: ReferralProgramRepository,
+        referral_code: ReferralCode,
+        from_closure_table: bool,
+        monkeypatch,
+    ):
+        monkeypatch.setattr(settings, "REFERRAL_TREE_FROM_CLOSURE_TABLE", from_closure_table)
+        another_referral_code = ReferralCode(referrer_id=referral_code.referrer_id, expired_at=referral_code.expired_at)
+        await get_test_referral_program_repository.create_referral_code(another_referral_code)
+        first_user: BaseUser = await get_referral_user(referral_code.code)
+        second_user: BaseUser = await get_referral_user(another_referral_code.code)
+        second_level_referral_code = ReferralCode(referrer_id=first_user.id, expired_at=referral_code.expired_at)
+        await get_test_referral_program_repository.create_referral_code(second_level_referral_code)
+        second_level_user: BaseUser = await get_referral_user(second_level_referral_code.code)
+
+        pages = []
+        params = {"limit": 2}
+        while params is not None:
+            response: Response = await auth_client.get(
+                f"/referral_code/referrals/{referral_code.referrer_id}/tree", params=params
+            )
+            pages.append(response.json())
+            params = {"limit": 2, "after": response.json()["next_cursor"]} if response.json()["next_cursor"] else None
+
+        assert [[user["id"] for user in page["referrals"]] for page in pages] == [
+            [first_user.id, second_user.id],
+            [second_level_user.id],
+        ]
+        assert [page["levels"] for page in pages] == [[{"depth": 1, "count": 2}], [{"depth": 2, "count": 1}]]
+
+    async def test_get_referral_tree_after_deleting_used_referral_code(
+        self,
+        auth_client: AsyncClient,
+        get_referral_user: Callable,
+        get_test_referral_program_repository: ReferralProgramRepository,
+        referral_code: ReferralCode,
+        monkeypatch,
+    ):
+        first_level_user: BaseUser = await get_referral_user(referral_code.code)
+        first_level_referral_code = ReferralCode(referrer_id=first_level_user.id, expired_at=referral_code.expired_at)
+        await get_test_referral_program_repository.create_referral_code(first_level_referral_code)
+        second_level_user: BaseUser = await get_referral_user(first_level_referral_code.code)
+        await auth_client.delete(f"/referral_code/{referral_code.id}", follow_redirects=True)
+
+        trees = {}
+        for from_closure_table in (False, True):
+            monkeypatch.setattr(settings, "REFERRAL_TREE_FROM_CLOSURE_TABLE", from_closure_table)
+            trees[from_closure_table] = [
+                (await auth_client.get(f"/referral_code/referrals/{user_id}/tree")).json()
+                for user_id in (referral_code.referrer_id, first_level_user.id)
+            ]
+
+        assert trees[True] == trees[False]
+        assert trees[True][0]["referrals"] == []
+        assert [user["id"] for user in trees[True][1]["referrals"]] == [second_level_user.id]
+
+    async def test_get_referrer_stats(
+        self,
+        auth_client: AsyncClient,
+        get_referral_user: Callable,
+        get_test_referral_program_repository: ReferralProgramRepository,
+        referral_code: ReferralCode,
+    ):
+        await get_referral_user(referral_code.code)
+        await auth_client.post("/referral_code", follow_redirects=True, json={})
+        response: Response = await auth_client.get(f"/referral_code/referrals/{referral_code.referrer_id}/stats")
+
+        assert response.status_code == status.HTTP_200_OK
+        assert response.json()["referrals_count"] == 1
+        assert response.json()["active_codes_count"] == 1
+        assert response.json()["last_referral_at"] is not None
+
+        stats = response.json()
+        await get_test_referral_program_repository.rebuild_referrer_stats()
+        await get_test_referral_program_repository.session.commit()
+        rebuilt_response: Response = await auth_client.get(
+            f"/referral_code/referrals/{referral_code.referrer_id}/stats"
+        )
+
+        assert rebuilt_response.json() == stats
+
+    async def test_get_referrer_stats_after_deleting_referral_code(self, auth_client: AsyncClient, user: BaseUser):
+        create_response: Response = await auth_client.post("/referral_code", follow_redirects=True, json={})
+        await auth_client.delete(f"/referral_code/{create_response.json()['id']}", follow_redirects=True)
+        response: Response = await auth_client.get(f"/referral_code/referrals/{user.id}/stats")
+
+        assert response.json() == {"referrals_count": 0, "active_codes_count": 0, "last_referral_at": None}
+
+    async def test_get_referrer_stats_after_deleting_used_referral_code(
+        self,
+        auth_client: AsyncClient,
+        get_referral_user: Callable,
+        get_test_referral_program_repository: ReferralProgramRepository,
+        referral_code: ReferralCode,
+    ):
+        await get_referral_user(referral_code.code)
+        await auth_client.delete(f"/referral_code/{referral_code.id}", follow_redirects=True)
+        response: Response = await auth_client.get(f"/referral_code/referrals/{referral_code.referrer_id}/stats")
+
+        await get_test_referral_program_repository.rebuild_referrer_stats()
+        await get_test_referral_program_repository.session.commit()
+        rebuilt_response: Response = await auth_client.get(
+            f"/referral_code/referrals/{referral_code.referrer_id}/stats"
+        )
+
+        assert response.json() == {"referrals_count": 0, "active_codes_count": 0, "last_referral_at": None}
+        assert rebuilt_response.json() == response.json()
+
+    @pytest.mark.parametrize("referral_code", [DateTimeBetweenKwargs(start_date="-10d", end_date="-1d")], indirect=True)
+    async def test_get_referrer_stats_with_expired_referral_code(
+        self, auth_client: AsyncClient, referral_code: ReferralCode
+    ):
+        response: Response = await auth_client.get(f"/referral_code/referrals/{referral_code.referrer_id}/stats")
+
+        assert response.status_code == status.HTTP_200_OK
+        assert response.json()["active_codes_count"] == 0
+
+    @pytest.mark.parametrize("archive", [False, True])
+    @pytest.mark.parametrize("referral_code", [DateTimeBetweenKwargs(start_date="-10d", end_date="-1d")], indirect=True)
+    async def test_sweep_expired_referral_codes(
+        self,
+        auth_client: AsyncClient,
+        get_test_referral_program_repository: ReferralProgramRepository,
+        referral_code: ReferralCode,
+        archive: bool,
+    ):
+        session = get_test_referral_program_repository.session
+        active_referral_code = ReferralCode(referrer_id=referral_code.referrer_id, expired_at=datetime(2100, 1, 1))
+        await get_test_referral_program_repository.create_referral_code(active_referral_code)
+
+        swept_codes = await get_test_referral_program_repository.sweep_expired_referral_codes(10, archive=archive)
+        await session.commit()
+        response: Response = await auth_client.get(f"/referral_code/referrals/{referral_code.referrer_id}/stats")
+
+        assert swept_codes == [referral_code.code]
+        assert await session.scalar(select(ReferralCode.id)) == active_referral_code.id
+        assert await session.scalar(func.count(ReferralCodeArchive.id)) == int(archive)
+        assert response.json()["active_codes_count"] == 1
+
     async def test_get_referrals_non_existing_user(self, auth_client: AsyncClient, referral_code: ReferralCode):
         response: Response = await auth_client.get(f"/referral_code/referrals/{referral_code.referrer.id + 1}")
 
         assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
+class TestLeaderboard:
+    async def test_get_leaderboard(
+        self, auth_client: AsyncClient, get_referral_user: Callable, referral_code: ReferralCode
+    ):
+        await get_referral_user(referral_code.code)
+
+        for period in LeaderboardPeriod:
+            response: Response = await auth_client.get(f"/leaderboard/{period.value}")
+
+            assert response.status_code == status.HTTP_200_OK
+            assert response.json() == [{"rank": 1, "referrer_id": referral_code.referrer_id, "referrals_count": 1}]
+
+    async def test_get_leaderboard_rank(
+        self, auth_client: AsyncClient, get_referral_user: Callable, referral_code: ReferralCode
+    ):
+        referral: BaseUser = await get_referral_user(referral_code.code)
+        response: Response = await auth_client.get(f"/leaderboard/week/referrers/{referral_code.referrer_id}")
+        referral_response: Response = await auth_client.get(f"/leaderboard/week/referrers/{referral.id}")
+
+        assert response.json() == {"rank": 1, "referrer_id": referral_code.referrer_id, "referrals_count": 1}
+        assert referral_response.json() == {"rank": None, "referrer_id": referral.id, "referrals_count": 0}
+
+    async def test_get_leaderboard_after_deleting_used_referral_code(
+        self, auth_client: AsyncClient, get_referral_user: Callable, referral_code: ReferralCode
+    ):
+        await get_referral_user(referral_code.code)
+        await auth_client.delete(f"/referral_code/{referral_code.id}", follow_redirects=True)
+
+        for period in LeaderboardPeriod:
+            response: Response = await auth_client.get(f"/leaderboard/{period.value}")
+
+            assert response.json() == []
+
+    async def test_rebuild_leaderboard(
+        self,
+        auth_client: AsyncClient,
+        get_referral_user: Callable,
+        get_test_referral_program_repository: ReferralProgramRepository,
+        referral_code: ReferralCode,
+    ):
+        await get_referral_user(referral_code.code)
+        leaderboard = Leaderboard(test_redis)
+        now = datetime.utcnow()
+        await test_redis.flushdb()
+
+        for period in LeaderboardPeriod:
+            await leaderboard.start_rebuild(period, now)
+            referrals_counts = await get_test_referral_program_repository.stream_referrals_counts(
+                since=get_period_start(period, now)
+            )
+            await leaderboard.rebuild(period, now, referrals_counts.partitions())
+
+        response: Response = await auth_client.get("/leaderboard/month")
+
+        assert response.json() == [{"rank": 1, "referrer_id": referral_code.referrer_id, "referrals_count": 1}]
+
+    async def test_rebuild_leaderboard_keeps_increments_made_during_rebuild(
+        self,
+        auth_client: AsyncClient,
+        get_referral_user: Callable,
+        get_test_referral_program_repository: ReferralProgramRepository,
+        referral_code: ReferralCode,
+    ):
+        await get_referral_user(referral_code.code)
+        leaderboard = Leaderboard(test_redis)
+        now = datetime.utcnow()
+        await test_redis.flushdb()
+
+        await leaderboard.start_rebuild(LeaderboardPeriod.WEEK, now)
+        referrals_counts = await get_test_referral_program_repository.stream_referrals_counts(
+            since=get_period_start(LeaderboardPeriod.WEEK, now)
+        )
+
+        async def partitions():
+            async for partition in referrals_counts.partitions():
+                # Referrals made after the counts were read
+                await leaderboard.increment(referral_code.referrer_id, now)
+                await leaderboard.increment(referral_code.referrer_id + 1, now)
+                yield partition
+
+        referrers_count = await leaderboard.rebuild(LeaderboardPeriod.WEEK, now, partitions())
+        response: Response = await auth_client.get("/leaderboard/week")
+
+        assert referrers_count == 1
+        assert response.json() == [
+            {"rank": 1, "referrer_id": referral_code.referrer_id, "referrals_count": 2},
+            {"rank": 2, "referrer_id": referral_code.referrer_id + 1, "referrals_count": 1},
+        ]
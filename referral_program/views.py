@@ -1,17 +1,49 @@
-from typing import Annotated
+import time
+from functools import partial
+from typing import Annotated, AsyncIterator, Optional
 
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Response, status
+from fastapi.responses import StreamingResponse
 from fastapi_users.router.common import ErrorModel
+from sqlalchemy.ext.asyncio import async_sessionmaker, AsyncSession
 
 from auth.db import get_user_db, SQLAlchemyUserDatabase
-from auth.fastapi_users import get_current_user
+from auth.fastapi_users import get_current_user, get_current_superuser
+from auth.models import User
 from auth.schema import UserRead
+from core.config import settings
+from core.db import get_async_session_maker, add_after_commit_callback
 from core.enums import ErrorDetails
+from core.rate_limit import RateLimiter, RateLimit
+from referral_program.cache import ReferralCodeCache, get_referral_code_cache
+from referral_program.code_pool import ReferralCodePool, get_referral_code_pool
+from referral_program.issued_codes import IssuedReferralCodes, get_issued_referral_codes
 from referral_program.db import get_referral_program_repository, ReferralProgramRepository
+from referral_program.leaderboard import Leaderboard, LeaderboardPeriod, get_leaderboard
 from referral_program.models import ReferralCode
-from referral_program.schema import ReferralCodeCreate, ReferralCodeRead, GetReferralCodeQueryParams
+from referral_program.services import generate_referral_code
+from referral_program.schema import (
+    ReferralCodeCreate,
+    ReferralCodeRead,
+    ReferralCodeBulkCreate,
+    ReferralCodeBulkRead,
+    GetReferralCodeQueryParams,
+    GetReferralsQueryParams,
+    GetReferralTreeQueryParams,
+    ReferralTreeLevel,
+    ReferralTreeNode,
+    ReferralTreeRead,
+    ReferrerStatsRead,
+    GetLeaderboardQueryParams,
+    LeaderboardEntry,
+)
 
 router = APIRouter(prefix="/referral_code", tags=["referral_code"])
+referral_code_lookup_rate_limiter = RateLimiter(
+    "referral_code_lookup",
+    RateLimit("ip", settings.RATE_LIMIT_REFERRAL_CODE_LOOKUP_PER_IP, settings.RATE_LIMIT_PERIOD_SECONDS),
+)
+leaderboard_router = APIRouter(prefix="/leaderboard", tags=["leaderboard"], dependencies=[Depends(get_current_user)])
 
 
 @router.post(
@@ -36,6 +68,9 @@ router = APIRouter(prefix="/referral_code", tags=["referral_code"])
 async def create_referral_code(
     referral_code_create: ReferralCodeCreate,
     repository: Annotated[ReferralProgramRepository, Depends(get_referral_program_repository)],
+    cache: Annotated[ReferralCodeCache, Depends(get_referral_code_cache)],
+    code_pool: Annotated[ReferralCodePool, Depends(get_referral_code_pool)],
+    issued_codes: Annotated[IssuedReferralCodes, Depends(get_issued_referral_codes)],
     current_user=Depends(get_current_user),
 ):
     if await repository.check_whether_active_referral_code_exists(current_user.id):
@@ -46,13 +81,65 @@ async def create_referral_code(
     referral_code = ReferralCode(
         referrer_id=current_user.id,
         expired_at=referral_code_create.expired_at.replace(tzinfo=None),
+        code=await code_pool.pop() or generate_referral_code(),
     )
 
     await repository.create_referral_code(referral_code)
+    # Added before the commit, so the code is never missing from the set while it exists
+    await issued_codes.add(referral_code.code)
+    add_after_commit_callback(repository.session, partial(cache.invalidate, current_user.email))
 
     return referral_code
 
 
+@router.post(
+    "/bulk",
+    status_code=status.HTTP_201_CREATED,
+    response_model=ReferralCodeBulkRead,
+    dependencies=[Depends(get_current_superuser)],
+    responses={
+        status.HTTP_404_NOT_FOUND: {
+            "model": ErrorModel,
+            "content": {
+                "application/json": {
+                    "examples": {
+                        ErrorDetails.USER_NOT_FOUND: {
+                            "summary": ErrorDetails.USER_NOT_FOUND,
+                            "value": {"detail": ErrorDetails.USER_NOT_FOUND},
+                        },
+                    }
+                }
+            },
+        },
+    },
+)
+async def create_referral_codes_in_bulk(
+    referral_code_bulk_create: ReferralCodeBulkCreate,
+    repository: Annotated[ReferralProgramRepository, Depends(get_referral_program_repository)],
+    user_db: Annotated[SQLAlchemyUserDatabase, Depends(get_user_db)],
+    cache: Annotated[ReferralCodeCache, Depends(get_referral_code_cache)],
+    issued_codes: Annotated[IssuedReferralCodes, Depends(get_issued_referral_codes)],
+):
+    referrer = await user_db.get(referral_code_bulk_create.referrer_id)
+    if referrer is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=ErrorDetails.USER_NOT_FOUND)
+
+    start = time.perf_counter()
+    codes = await repository.create_referral_codes(
+        referrer_id=referrer.id,
+        expired_at=referral_code_bulk_create.expired_at.replace(tzinfo=None),
+        count=referral_code_bulk_create.count,
+        batch_size=settings.REFERRAL_CODES_BULK_BATCH_SIZE,
+    )
+    elapsed_seconds = time.perf_counter() - start
+    await issued_codes.add(*codes)
+    add_after_commit_callback(repository.session, partial(cache.invalidate, referrer.email))
+
+    return ReferralCodeBulkRead(
+        codes=codes, elapsed_seconds=elapsed_seconds, codes_per_second=len(codes) / elapsed_seconds
+    )
+
+
 @router.delete(
     "/{id}",
     status_code=status.HTTP_204_NO_CONTENT,
@@ -75,31 +162,115 @@ async def create_referral_code(
 async def delete_referral_code(
     id: int,
     repository: Annotated[ReferralProgramRepository, Depends(get_referral_program_repository)],
+    user_db: Annotated[SQLAlchemyUserDatabase, Depends(get_user_db)],
+    cache: Annotated[ReferralCodeCache, Depends(get_referral_code_cache)],
+    issued_codes: Annotated[IssuedReferralCodes, Depends(get_issued_referral_codes)],
+    leaderboard: Annotated[Leaderboard, Depends(get_leaderboard)],
     current_user=Depends(get_current_user),
 ):
-    if not await repository.check_whether_referral_code_exists_by_id(user_id=current_user.id, id=id):
+    deleted_referral_code = await repository.delete_referral_code_by_id(user_id=current_user.id, id=id)
+    if deleted_referral_code is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=ErrorDetails.REFERRAL_CODE_NOT_FOUND)
 
-    await repository.delete_referral_code_by_id(user_id=current_user.id, id=id)
+    if deleted_referral_code.used_at is not None:
+        await repository.remove_referral_from_referrer_stats(current_user.id)
+        add_after_commit_callback(
+            repository.session,
+            partial(leaderboard.increment, current_user.id, deleted_referral_code.used_at, referrals_count=-1),
+        )
+        if deleted_referral_code.used_by_id is not None:
+            # The referred user loses their referrer, so the closure stops linking their subtree to the current user
+            await user_db.remove_from_referral_closure(deleted_referral_code.used_by_id)
+    add_after_commit_callback(repository.session, partial(issued_codes.remove, deleted_referral_code.code))
+    add_after_commit_callback(repository.session, partial(cache.invalidate, current_user.email))
 
 
-@router.get("/", response_model=ReferralCodeRead)
+@router.get("/", response_model=ReferralCodeRead, dependencies=[Depends(referral_code_lookup_rate_limiter)])
 async def get_referral_code_by_email(
     repository: Annotated[ReferralProgramRepository, Depends(get_referral_program_repository)],
     query_params: Annotated[GetReferralCodeQueryParams, Depends(GetReferralCodeQueryParams)],
+    cache: Annotated[ReferralCodeCache, Depends(get_referral_code_cache)],
 ):
+    cached_referral_code = await cache.get(query_params.email)
+    if cached_referral_code is not None:
+        return cached_referral_code
+
     referral_code = await repository.fetch_referral_code_by_email(query_params.email)
 
-    if not referral_code or await repository.check_whether_referral_code_was_used(referral_code):
+    if not referral_code or referral_code.used_at is not None:
+        await cache.set(query_params.email, ReferralCodeRead())
         return ReferralCodeRead()
 
-    return ReferralCodeRead(referral_code=referral_code.code, id=referral_code.id)
+    referral_code_read = ReferralCodeRead(referral_code=referral_code.code, id=referral_code.id)
+    await cache.set(query_params.email, referral_code_read, expired_at=referral_code.expired_at)
+
+    return referral_code_read
+
+
+async def stream_referrals(
+    session_maker: async_sessionmaker[AsyncSession], id: int, after_id: Optional[int]
+) -> AsyncIterator[bytes]:
+    # Request dependencies are closed before the body is sent, so the stream owns its session
+    async with session_maker() as session:
+        user_db = SQLAlchemyUserDatabase(session, User)
+        referrals = await user_db.stream_referrals(id, after_id, batch_size=settings.REFERRALS_STREAM_BATCH_SIZE)
+        async for referral in referrals:
+            yield UserRead.model_validate(referral).model_dump_json().encode() + b"\n"
 
 
 @router.get(
     "/referrals/{id}",
     dependencies=[Depends(get_current_user)],
     response_model=list[UserRead],
+    responses={
+        status.HTTP_200_OK: {
+            "description": "Page of referrals ordered by id. "
+            "X-Next-Cursor header holds after_id for the next page if there may be more of them.",
+            "content": {"application/x-ndjson": {}},
+        },
+        status.HTTP_404_NOT_FOUND: {
+            "model": ErrorModel,
+            "content": {
+                "application/json": {
+                    "examples": {
+                        ErrorDetails.USER_NOT_FOUND: {
+                            "summary": ErrorDetails.USER_NOT_FOUND,
+                            "value": {"detail": ErrorDetails.USER_NOT_FOUND},
+                        },
+                    }
+                }
+            },
+        },
+    },
+)
+async def get_referrals_by_referrer_id(
+    id: int,
+    response: Response,
+    user_db: Annotated[SQLAlchemyUserDatabase, Depends(get_user_db)],
+    query_params: Annotated[GetReferralsQueryParams, Depends(GetReferralsQueryParams)],
+    session_maker: Annotated[async_sessionmaker[AsyncSession], Depends(get_async_session_maker)],
+):
+    is_user_existing = await user_db.check_whether_user_exists(id)
+
+    if not is_user_existing:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=ErrorDetails.USER_NOT_FOUND)
+
+    if query_params.stream:
+        return StreamingResponse(
+            stream_referrals(session_maker, id, query_params.after_id), media_type="application/x-ndjson"
+        )
+
+    referrals = (await user_db.fetch_referrals(id, after_id=query_params.after_id, limit=query_params.limit)).all()
+    if len(referrals) == query_params.limit:
+        response.headers["X-Next-Cursor"] = str(referrals[-1].id)
+
+    return referrals
+
+
+@router.get(
+    "/referrals/{id}/tree",
+    dependencies=[Depends(get_current_user)],
+    response_model=ReferralTreeRead,
     responses={
         status.HTTP_404_NOT_FOUND: {
             "model": ErrorModel,
@@ -116,12 +287,95 @@ async def get_referral_code_by_email(
         },
     },
 )
-async def get_referrals_by_referrer_id(id: int, user_db: Annotated[SQLAlchemyUserDatabase, Depends(get_user_db)]):
+async def get_referral_tree_by_referrer_id(
+    id: int,
+    user_db: Annotated[SQLAlchemyUserDatabase, Depends(get_user_db)],
+    query_params: Annotated[GetReferralTreeQueryParams, Depends(GetReferralTreeQueryParams)],
+):
     is_user_existing = await user_db.check_whether_user_exists(id)
 
     if not is_user_existing:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=ErrorDetails.USER_NOT_FOUND)
 
-    referrals = await user_db.fetch_referrals(id)
+    referrals = (
+        await user_db.fetch_referral_tree(
+            id, query_params.depth, after=query_params.get_after(), limit=query_params.limit
+        )
+    ).all()
+    levels = {depth: level_count for _, depth, level_count in referrals}
+
+    return ReferralTreeRead(
+        levels=[ReferralTreeLevel(depth=depth, count=count) for depth, count in levels.items()],
+        referrals=[
+            ReferralTreeNode(id=referral.id, email=referral.email, depth=depth) for referral, depth, _ in referrals
+        ],
+        next_cursor=f"{referrals[-1][1]}:{referrals[-1][0].id}" if len(referrals) == query_params.limit else None,
+    )
+
+
+@router.get(
+    "/referrals/{id}/stats",
+    dependencies=[Depends(get_current_user)],
+    response_model=ReferrerStatsRead,
+    responses={
+        status.HTTP_404_NOT_FOUND: {
+            "model": ErrorModel,
+            "content": {
+                "application/json": {
+                    "examples": {
+                        ErrorDetails.USER_NOT_FOUND: {
+                            "summary": ErrorDetails.USER_NOT_FOUND,
+                            "value": {"detail": ErrorDetails.USER_NOT_FOUND},
+                        },
+                    }
+                }
+            },
+        },
+    },
+)
+async def get_referrer_stats(
+    id: int,
+    repository: Annotated[ReferralProgramRepository, Depends(get_referral_program_repository)],
+    user_db: Annotated[SQLAlchemyUserDatabase, Depends(get_user_db)],
+):
+    referrer_stats = await repository.fetch_referrer_stats(id)
+    active_codes_count = await repository.count_active_referral_codes(id)
+
+    # Users without referrals have no stats row
+    if referrer_stats is None:
+        if not active_codes_count and not await user_db.check_whether_user_exists(id):
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=ErrorDetails.USER_NOT_FOUND)
+        return ReferrerStatsRead(active_codes_count=active_codes_count)
 
-    return referrals.all()
+    return ReferrerStatsRead(
+        referrals_count=referrer_stats.referrals_count,
+        active_codes_count=active_codes_count,
+        last_referral_at=referrer_stats.last_referral_at,
+    )
+
+
+@leaderboard_router.get("/{period}", response_model=list[LeaderboardEntry])
+async def get_leaderboard_top(
+    period: LeaderboardPeriod,
+    query_params: Annotated[GetLeaderboardQueryParams, Depends(GetLeaderboardQueryParams)],
+    leaderboard: Annotated[Leaderboard, Depends(get_leaderboard)],
+):
+    entries = await leaderboard.top(period, query_params.offset, query_params.limit)
+
+    return [
+        LeaderboardEntry(rank=query_params.offset + index + 1, referrer_id=referrer_id, referrals_count=referrals_count)
+        for index, (referrer_id, referrals_count) in enumerate(entries)
+    ]
+
+
+@leaderboard_router.get("/{period}/referrers/{referrer_id}", response_model=LeaderboardEntry)
+async def get_leaderboard_rank(
+    period: LeaderboardPeriod,
+    referrer_id: int,
+    leaderboard: Annotated[Leaderboard, Depends(get_leaderboard)],
+):
+    rank, referrals_count = await leaderboard.rank(period, referrer_id)
+
+    return LeaderboardEntry(
+        rank=rank + 1 if rank is not None else None, referrer_id=referrer_id, referrals_count=referrals_count
+    )